@@ -8,7 +8,8 @@ from arcana.data.file_format import FileFormat, Converter
 from banana.interfaces.mrtrix import MRConvert
 from banana.requirement import (
     dcm2niix_req, mrtrix_req)
-from banana.interfaces.converters import Dcm2niix  # @UnusedImport
+from banana.interfaces.converters import (
+    Dcm2niix, MotionMatsToStack, MotionStackToMats)  # @UnusedImport
 import nibabel
 # Import base file formats from Arcana for convenience
 from arcana.data.file_format.standard import (
@@ -38,6 +39,20 @@ class Dcm2niixConverter(Converter):
     requirements = [dcm2niix_req.v('1.0.2')]
 
 
+class MotionMatsToStackConverter(Converter):
+
+    interface = MotionMatsToStack()
+    input = 'in_dir'
+    output = 'out_file'
+
+
+class MotionStackToMatsConverter(Converter):
+
+    interface = MotionStackToMats()
+    input = 'in_file'
+    output = 'out_dir'
+
+
 class MrtrixConverter(Converter):
 
     input = 'in_file'
@@ -143,8 +158,25 @@ ica_format = FileFormat(name='ica', extension='.ica', directory=True)
 par_format = FileFormat(name='parameters', extension='.par')
 motion_mats_format = FileFormat(
     name='motion_mats', directory=True, within_dir_exts=['.mat'],
+    converters={'motion_mat_stack': MotionStackToMatsConverter},
     desc=("Format used for storing motion matrices produced during "
           "motion detection pipeline"))
+motion_mat_stack_format = FileFormat(
+    name='motion_mat_stack', extension='.mats.npz',
+    converters={'motion_mats': MotionMatsToStackConverter},
+    desc=("Motion matrices produced during motion detection pipeline "
+          "stacked into a single (N, 4, 4) array, together with the name "
+          "of each matrix (see banana.utils.motion_mat_stack"
+          ".MotionMatStack)"))
+numpy_array_format = FileFormat(
+    name='numpy_array', extension='.npy',
+    desc=("Binary NumPy array, which can be memory-mapped. Used as an "
+          "alternative to text files for the intermediate outputs of the "
+          "motion detection pipeline"))
+numpy_bundle_format = FileFormat(
+    name='numpy_bundle', extension='.npz',
+    desc=("Bundle of named binary NumPy arrays, e.g. the real clock "
+          "intervals produced by the motion detection pipeline"))
 
 
 # General image formats
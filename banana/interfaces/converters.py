@@ -10,6 +10,7 @@ import re
 from arcana.exceptions import ArcanaError
 import numpy as np
 from nipype.utils.filemanip import split_filename
+from banana.utils.motion_mat_stack import MotionMatStack
 
 
 class Dcm2niixInputSpec(CommandLineInputSpec):
@@ -174,3 +175,72 @@ class Nii2Dicom(BaseInterface):
                 '_dicom')
             fpath = os.path.join(os.getcwd(), fname)
         return fpath
+
+
+class MotionMatsToStackInputSpec(TraitedSpec):
+    in_dir = Directory(exists=True, mandatory=True,
+                       desc='directory with one motion matrix per file')
+
+
+class MotionMatsToStackOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the motion matrices stacked in a '
+                    'single .npz file')
+
+
+class MotionMatsToStack(BaseInterface):
+    """Converts a motion_mats directory into a single motion_mat_stack
+    file"""
+
+    input_spec = MotionMatsToStackInputSpec
+    output_spec = MotionMatsToStackOutputSpec
+
+    def _run_interface(self, runtime):
+        MotionMatStack.from_dir(self.inputs.in_dir).save(
+            self._gen_outfilename())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_outfilename()
+        return outputs
+
+    def _gen_outfilename(self):
+        return os.path.join(
+            os.getcwd(),
+            os.path.basename(self.inputs.in_dir.rstrip('/')) +
+            MotionMatStack.EXT)
+
+
+class MotionStackToMatsInputSpec(TraitedSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='motion_mat_stack (.npz) file')
+
+
+class MotionStackToMatsOutputSpec(TraitedSpec):
+    out_dir = Directory(exists=True, desc='directory with one motion matrix '
+                        'per file')
+
+
+class MotionStackToMats(BaseInterface):
+    """Converts a motion_mat_stack file into a motion_mats directory"""
+
+    input_spec = MotionStackToMatsInputSpec
+    output_spec = MotionStackToMatsOutputSpec
+
+    def _run_interface(self, runtime):
+        MotionMatStack.load(self.inputs.in_file).to_dir(
+            self._gen_outdirname())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_dir'] = self._gen_outdirname()
+        return outputs
+
+    def _gen_outdirname(self):
+        fname = os.path.basename(self.inputs.in_file)
+        if fname.endswith(MotionMatStack.EXT):
+            dname = fname[:-len(MotionMatStack.EXT)]
+        else:
+            dname = split_extension(fname)[0]
+        return os.path.join(os.getcwd(), dname)
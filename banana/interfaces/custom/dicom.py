@@ -11,9 +11,10 @@ import datetime as dt
 import os.path
 import nibabel as nib
 from arcana.utils import split_extension
-import nibabel.nicom.csareader as csareader
 from logging import getLogger
 from banana.exceptions import BananaMissingHeaderValue
+from banana.utils.siemens import find_value
+from banana.utils.header_index import HeaderIndex
 
 
 logger = getLogger('banana')
@@ -30,6 +31,11 @@ class DicomHeaderInfoExtractionInputSpec(BaseInterfaceInputSpec):
                            default=False)
     reference = traits.Bool(desc='Specify whether the input scan is the motion'
                             ' correction reference.')
+    header_index = traits.Str(
+        desc='Path to the SQLite header index (see banana.utils.header_index) '
+        'shared with the other interfaces reading the session (not hashed as '
+        'a file, as it changes as they index the headers). If not given the '
+        'headers are indexed in memory')
 
 
 class DicomHeaderInfoExtractionOutputSpec(TraitedSpec):
@@ -67,40 +73,49 @@ class DicomHeaderInfoExtraction(BaseInterface):
         self.dict_output = {}
         dwi_directions = None
 
+        # Header fields of the first DICOM file in list, from the session
+        # header index (see banana.utils.header_index)
+        index = HeaderIndex(self.inputs.header_index
+                            if isdefined(self.inputs.header_index) else None)
+        # Non-DICOM files in the folder (e.g. JSON sidecars) are skipped
+        not_dicom = []
+        for fname in list_dicom:
+            hd = index[fname]
+            if hd is not None:
+                break
+            not_dicom.append(fname)
+        else:
+            raise BananaMissingHeaderValue(
+                'No DICOM files found in {}'.format(self.inputs.dicom_folder))
+        list_dicom = [f for f in list_dicom if f not in not_dicom]
         try:
-            phase_offset, ped = self.get_phase_encoding_direction(
-                list_dicom[0])
+            phase_offset, ped = self.get_phase_encoding_direction(hd)
         except KeyError:
             pass  # image does not have ped info in the header
 
-        with open(list_dicom[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'TotalScan' in line:
-                    total_duration = line.split('=')[-1].strip()
-                    if not multivol:
-                        real_duration = total_duration
-                elif 'alTR[0]' in line:
-                    tr = float(line.split('=')[-1].strip()) / 1000000
-                elif ('SliceArray.asSlice[0].dInPlaneRot' in line and
-                        (not phase_offset or not ped)):
-                    if len(line.split('=')) > 1:
-                        phase_offset = float(line.split('=')[-1].strip())
-                        if (np.abs(phase_offset) > 1 and
-                                np.abs(phase_offset) < 3):
-                            ped = 'ROW'
-                        elif (np.abs(phase_offset) < 1 or
-                                np.abs(phase_offset) > 3):
-                            ped = 'COL'
-                            if np.abs(phase_offset) > 3:
-                                phase_offset = -1
-                            else:
-                                phase_offset = 1
-                elif 'lDiffDirections' in line:
-                    dwi_directions = float(line.split('=')[-1].strip())
+        # Parameters of the Siemens protocol stored in the CSA header
+        protocol = hd['protocol']
+        total_duration = find_value(protocol, 'TotalScan')
+        if total_duration is not None and not multivol:
+            real_duration = total_duration
+        if find_value(protocol, 'alTR[0]') is not None:
+            tr = float(find_value(protocol, 'alTR[0]')) / 1000000
+        in_plane_rot = find_value(protocol,
+                                  'SliceArray.asSlice[0].dInPlaneRot')
+        if in_plane_rot and (not phase_offset or not ped):
+            phase_offset = float(in_plane_rot)
+            if (np.abs(phase_offset) > 1 and
+                    np.abs(phase_offset) < 3):
+                ped = 'ROW'
+            elif (np.abs(phase_offset) < 1 or
+                    np.abs(phase_offset) > 3):
+                ped = 'COL'
+                if np.abs(phase_offset) > 3:
+                    phase_offset = -1
+                else:
+                    phase_offset = 1
+        if find_value(protocol, 'lDiffDirections') is not None:
+            dwi_directions = float(find_value(protocol, 'lDiffDirections'))
         if multivol:
             if dwi_directions:
                 n_vols = dwi_directions
@@ -108,35 +123,27 @@ class DicomHeaderInfoExtraction(BaseInterface):
                 n_vols = len(list_dicom)
             real_duration = n_vols * tr
 
-        # Read header from first DICOM file in list
-        hd = pydicom.read_file(list_dicom[0])
         try:
-            start_time = hd.AcquisitionTime
-        except AttributeError:
+            start_time = hd['AcquisitionTime']
+        except KeyError:
             try:
-                start_time = str(hd.AcquisitionDateTime)[8:]
-            except AttributeError:
+                start_time = str(hd['AcquisitionDateTime'])[8:]
+            except KeyError:
                 raise BananaMissingHeaderValue(
                     'No acquisition time found for this scan.')
         # Get echo times
-        num_echoes = hd.EchoTrainLength
+        num_echoes = hd['EchoTrainLength']
         if num_echoes == 1:
-            echo_times = [hd.EchoTime]
+            echo_times = [hd['EchoTime']]
         else:
-            echo_times = set()
-            for f in list_dicom:
-                hdr = pydicom.read_file(f)
-                echo_times.add(hdr.EchoTime)
-                if len(echo_times) == num_echoes:
-                    break
-            echo_times = list(echo_times)
+            echo_times = index.echo_times(list_dicom, num_echoes)
         # Get the orientation of the main magnetic field as a vector
-        img_orient = np.reshape(np.asarray(hd.ImageOrientationPatient),
+        img_orient = np.reshape(np.asarray(hd['ImageOrientationPatient']),
                                 newshape=(2, 3))
         b0_orient = np.cross(img_orient[0], img_orient[1])
         # Get voxel sizes
-        vox_sizes = list(hd.PixelSpacing)
-        vox_sizes.append(hd.SliceThickness)
+        vox_sizes = list(hd['PixelSpacing'])
+        vox_sizes.append(hd['SliceThickness'])
         # Save extracted values to output dictionary
         self.dict_output['start_time'] = float(start_time)
         self.dict_output['tr'] = float(tr) / 1000.0  # Convert to seconds
@@ -144,7 +151,7 @@ class DicomHeaderInfoExtraction(BaseInterface):
                                           for t in echo_times]
         self.dict_output['voxel_sizes'] = vox_sizes
         self.dict_output['H'] = list(b0_orient)
-        self.dict_output['B0'] = hd.MagneticFieldStrength
+        self.dict_output['B0'] = hd['MagneticFieldStrength']
         self.dict_output['total_duration'] = float(total_duration)
         self.dict_output['real_duration'] = float(real_duration)
         self.dict_output['ped'] = ped
@@ -180,13 +187,10 @@ class DicomHeaderInfoExtraction(BaseInterface):
 
         return outputs
 
-    def get_phase_encoding_direction(self, dicom_path):
+    def get_phase_encoding_direction(self, record):
 
-        dcm = pydicom.read_file(dicom_path)
-        inplane_pe_dir = dcm[int('00181312', 16)].value
-        csa_str = dcm[int('00291010', 16)].value
-        csa_tr = csareader.read(csa_str)
-        pedp = csa_tr['tags']['PhaseEncodingDirectionPositive']['items'][0]
+        inplane_pe_dir = record['InPlanePhaseEncodingDirection']
+        pedp = record['PhaseEncodingDirectionPositive']
         sign = PEDP_TO_SIGN[pedp]
         return sign, inplane_pe_dir
 
@@ -249,6 +253,11 @@ class ScanTimesInfo(BaseInterface):
 class PetTimeInfoInputSpec(BaseInterfaceInputSpec):
     pet_data_dir = Directory(exists=True,
                              desc='Directory the the list-mode data.')
+    header_index = traits.Str(
+        desc='Path to the SQLite header index (see banana.utils.header_index) '
+        'shared with the other interfaces reading the session (not hashed as '
+        'a file, as it changes as they index the headers). If not given the '
+        'headers are indexed in memory')
 
 
 class PetTimeInfoOutputSpec(TraitedSpec):
@@ -286,20 +295,17 @@ class PetTimeInfo(BaseInterface):
                     list_mode_file = os.path.join(root, bf)
 
             pet_image = list_mode_file.split('.bf')[0] + '.dcm'
-            try:
-                hd = pydicom.read_file(pet_image)
-                pet_start_time = hd.AcquisitionTime
-            except AttributeError:
-                pet_start_time = None
-            with open(pet_image, 'rb') as f:
-                for line in f:
-                    try:
-                        line = line[:-1].decode('utf-8')
-                    except UnicodeDecodeError:
-                        continue
-                    if 'image duration' in line:
-                        pet_duration = line.strip()
-                        pet_duration = int(pet_duration.split(':=')[-1])
+            hd = HeaderIndex(
+                self.inputs.header_index
+                if isdefined(self.inputs.header_index) else None)[pet_image]
+            if hd is None:
+                raise BananaMissingHeaderValue(
+                    '{} is not a DICOM file, cannot read the PET start time '
+                    'and duration from it'.format(pet_image))
+            pet_start_time = hd.get('AcquisitionTime')
+            image_duration = find_value(hd['interfile'], 'image duration')
+            if image_duration is not None:
+                pet_duration = int(image_duration)
             if pet_duration:
                 pet_endtime = ((
                     dt.datetime.strptime(pet_start_time, '%H%M%S.%f') +
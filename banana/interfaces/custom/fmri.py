@@ -1,12 +1,12 @@
 
 from nipype.interfaces.base import (
     BaseInterface, BaseInterfaceInputSpec, TraitedSpec, Directory, File,
-    traits)
+    traits, isdefined)
 import os
 import shutil
-import pydicom
 import numpy as np
 import glob
+from banana.utils.header_index import HeaderIndex
 
 
 class PrepareFIXInputSpec(BaseInterfaceInputSpec):
@@ -81,6 +81,11 @@ class PrepareFIX(BaseInterface):
 class FieldMapTimeInfoInputSpec(BaseInterfaceInputSpec):
 
     fm_mag = Directory()
+    header_index = traits.Str(
+        desc='Path to the SQLite header index (see banana.utils.header_index) '
+        'shared with the other interfaces reading the session (not hashed as '
+        'a file, as it changes as they index the headers). If not given the '
+        'headers are indexed in memory')
 
 
 class FieldMapTimeInfoOutputSpec(TraitedSpec):
@@ -96,7 +101,10 @@ class FieldMapTimeInfo(BaseInterface):
     def _run_interface(self, runtime):
 
         fm_mag = sorted(glob.glob(self.inputs.fm_mag+'/*'))
-        tes = [pydicom.read_file(x).EchoTime for x in fm_mag]
+        index = HeaderIndex(self.inputs.header_index
+                            if isdefined(self.inputs.header_index) else None)
+        tes = [r['EchoTime'] for r in index.records(fm_mag)
+               if r is not None]
         tes = list(set(tes))
         if len(tes) != 2:
             print('Something went wrong when trying to estimate '
@@ -10,6 +10,8 @@ import nibabel as nib
 from nipype.interfaces.base import isdefined
 import scipy.ndimage.measurements as snm
 import datetime as dt
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 try:
     import matplotlib
     matplotlib.use('Agg')
@@ -20,6 +22,13 @@ from nipype.interfaces import fsl
 import pydicom
 import math
 import subprocess as sp
+from banana.utils.real_clock import RealClock, time2us, seconds2us
+from banana.utils.motion_mat_stack import MotionMatStack
+from banana.utils.resample import apply_fsl_xfm, apply_fsl_xfm_file
+from banana.utils import transform
+from banana.utils.motion_io import (
+    save_array, load_array, array_ext, list_mats, export_text,
+    export_text_dir, save_timestamps)
 
 
 class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
@@ -33,12 +42,18 @@ class MotionMatCalculationInputSpec(BaseInterfaceInputSpec):
     reference = traits.Bool(desc='If True, the pipeline will save just an '
                             'identity matrix (motion mats for reference scan)',
                             default=False)
+    stack = traits.Bool(
+        False, usedefault=True, desc='If True, the motion matrices are saved '
+        'in a single motion_mat_stack file (motion_mat_stack output) instead '
+        'of one text file per matrix within a directory.')
 
 
 class MotionMatCalculationOutputSpec(TraitedSpec):
 
     motion_mats = Directory(exists=True, desc='Directory with resulting motion'
                             ' matrices')
+    motion_mat_stack = File(exists=True, desc='Resulting motion matrices '
+                            'stacked in a single file (if stack is True)')
 
 
 class MotionMatCalculation(BaseInterface):
@@ -48,6 +63,9 @@ class MotionMatCalculation(BaseInterface):
 
     def _run_interface(self, runtime):
 
+        if self.inputs.stack:
+            self.gen_motion_mat_stack().save(self._out_name())
+            return runtime
         reference = self.inputs.reference
         dummy = self.inputs.dummy_input
         if reference:
@@ -68,15 +86,14 @@ class MotionMatCalculation(BaseInterface):
                         raise Exception(
                             'Folder {} is empty!'.format(
                                 self.inputs.align_mats))
-                for mat in list_mats:
-                    m = np.loadtxt(mat)
-                    concat = np.dot(reg_mat, m)
-                    self.gen_motion_mat(concat, qform_mat, mat.split('.')[0])
-                mat_path, _, _ = split_filename(mat)
+                concats = transform.compose(
+                    reg_mat, np.stack([np.loadtxt(m) for m in list_mats]))
+                self.gen_motion_mats(concats, qform_mat,
+                                     [m.split('.')[0] for m in list_mats])
+                mat_path, _, _ = split_filename(list_mats[-1])
                 mm = glob.glob(mat_path+'/*motion_mat*.mat')
             else:
-                concat = reg_mat[:]
-                self.gen_motion_mat(concat, qform_mat, out_name)
+                self.gen_motion_mat(reg_mat, qform_mat, out_name)
                 mm = glob.glob('*motion_mat*.mat')
         os.mkdir(out_name)
 
@@ -85,25 +102,66 @@ class MotionMatCalculation(BaseInterface):
 
         return runtime
 
+    def gen_motion_mat_stack(self):
+        """Calculates the same motion matrices that are saved in the
+        directory, keeping them in memory"""
+        if self.inputs.reference:
+            return MotionMatStack(
+                [np.eye(4), np.eye(4)],
+                ['reference_motion_mat', 'reference_motion_mat_inv'])
+        reg_mat = np.loadtxt(self.inputs.reg_mat)
+        qform_mat = np.loadtxt(self.inputs.qform_mat)
+        if self.inputs.align_mats:
+            align_mats = MotionMatStack.from_dir(self.inputs.align_mats,
+                                                 'MAT*')
+            if not len(align_mats):
+                align_mats = MotionMatStack.from_dir(self.inputs.align_mats)
+                if not len(align_mats):
+                    raise Exception(
+                        'Folder {} is empty!'.format(self.inputs.align_mats))
+            names = [n.split('.')[0] for n in align_mats.names]
+            concats = transform.compose(reg_mat, align_mats.mats)
+        else:
+            names = [self._out_name()]
+            concats = reg_mat[None]
+        mats, mats_inv = transform.motion_mats(concats, qform_mat)
+        mat_names = (['{0}_motion_mat'.format(n) for n in names] +
+                     ['{0}_motion_mat_inv'.format(n) for n in names])
+        return MotionMatStack(np.concatenate((mats, mats_inv)),
+                              mat_names).select('*')
+
+    def calc_motion_mat(self, concat, qform):
+
+        mat, mat_inv = transform.motion_mats(concat, qform)
+        return mat[0], mat_inv[0]
+
     def gen_motion_mat(self, concat, qform, out_name):
 
-        concat_inv = np.linalg.inv(concat)
-        concat_inv_qform = np.dot(qform, concat_inv)
-        concat_inv_qform_inv = np.linalg.inv(concat_inv_qform)
-        np.savetxt('{0}_motion_mat_inv.mat'.format(out_name),
-                   concat_inv_qform_inv)
-        np.savetxt('{0}_motion_mat.mat'.format(out_name),
-                   concat_inv_qform)
+        self.gen_motion_mats(concat, qform, [out_name])
 
-    def _list_outputs(self):
-        outputs = self._outputs().get()
+    def gen_motion_mats(self, concats, qform, out_names):
+
+        mats, mats_inv = transform.motion_mats(concats, qform)
+        for out_name, mat, mat_inv in zip(out_names, mats, mats_inv):
+            np.savetxt('{0}_motion_mat_inv.mat'.format(out_name), mat_inv)
+            np.savetxt('{0}_motion_mat.mat'.format(out_name), mat)
 
+    def _out_name(self):
         if self.inputs.reference:
             out_name = 'ref_motion_mats'
         else:
             _, out_name, _ = split_filename(self.inputs.reg_mat)
+        return out_name
 
-        outputs["motion_mats"] = os.path.abspath(out_name)
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+
+        out_name = self._out_name()
+        if self.inputs.stack:
+            outputs["motion_mat_stack"] = os.path.abspath(
+                out_name + MotionMatStack.EXT)
+        else:
+            outputs["motion_mats"] = os.path.abspath(out_name)
 
         return outputs
 
@@ -348,12 +406,19 @@ class AffineMatrixGenerationInputSpec(BaseInterfaceInputSpec):
                              'paramters calculated by eddy.')
     reference_image = File(exists=True, desc='Reference used to calculate the '
                            'motion (usually is the first volume).')
+    stack = traits.Bool(
+        False, usedefault=True, desc='If True, the affine matrices are saved '
+        'at full precision in a single motion_mat_stack file '
+        '(affine_mat_stack output) instead of one text file per volume.')
 
 
 class AffineMatrixGenerationOutputSpec(TraitedSpec):
 
     affine_matrices = Directory(exists=True, desc='Directory containing all '
                                 'affine matrices calculated by the interface.')
+    affine_mat_stack = File(exists=True, desc='All the affine matrices '
+                            'calculated by the interface in a single file (if '
+                            'stack is True).')
 
 
 class AffineMatrixGeneration(BaseInterface):
@@ -381,8 +446,14 @@ class AffineMatrixGeneration(BaseInterface):
         hdr = ref.header
         resolution = list(hdr.get_zooms()[:3])
 
-        for i in range(len(motion_par)):
-            mat = self.create_affine_mat(motion_par[i, :], resolution*com)
+        mats = transform.params2mat(motion_par, resolution*com)
+        if self.inputs.stack:
+            MotionMatStack(
+                mats, ['affine_mat_{}'.format(str(i).zfill(4))
+                       for i in range(len(motion_par))]).save(out_name)
+            return runtime
+
+        for i, mat in enumerate(mats):
             np.savetxt(
                 'affine_mat_{}.mat'.format(str(i).zfill(4)), mat, fmt='%f')
 
@@ -395,58 +466,18 @@ class AffineMatrixGeneration(BaseInterface):
 
     def create_affine_mat(self, mp, cog):
 
-        T = np.eye(4)
-
-        T[0, -1] = cog[0]
-        T[1, -1] = cog[1]
-        T[2, -1] = cog[2]
-
-        T_1 = np.linalg.inv(T)
-
-        tx = mp[0]
-        ty = mp[1]
-        tz = mp[2]
-        rx = mp[3]
-        ry = mp[4]
-        rz = mp[5]
-
-        Rx = np.eye(3)
-        Rx[1, 1] = np.cos(rx)
-        Rx[1, 2] = np.sin(rx)
-        Rx[2, 1] = -np.sin(rx)
-        Rx[2, 2] = np.cos(rx)
-        Ry = np.eye(3)
-        Ry[0, 0] = np.cos(ry)
-        Ry[0, 2] = -np.sin(ry)
-        Ry[2, 0] = np.sin(ry)
-        Ry[2, 2] = np.cos(ry)
-        Rz = np.eye(3)
-        Rz[0, 0] = np.cos(rz)
-        Rz[0, 1] = np.sin(rz)
-        Rz[1, 0] = -np.sin(rz)
-        Rz[1, 1] = np.cos(rz)
-        R_3x3 = np.dot(np.dot(Rx, Ry), Rz)
-
-        m = np.eye(4)
-        m[:3, :3] = R_3x3
-        m[0, 3] = tx
-        m[1, 3] = ty
-        m[2, 3] = tz
-
-        new_orig = np.dot(T, np.dot(m, T_1))[:, -1]
-
-        m[0, 3] = new_orig[0]
-        m[1, 3] = new_orig[1]
-        m[2, 3] = new_orig[2]
-
-        return m
+        return transform.params2mat(mp, cog)[0]
 
     def _list_outputs(self):
         outputs = self._outputs().get()
 
         _, out_name, _ = split_filename(self.inputs.motion_parameters)
 
-        outputs["affine_matrices"] = os.path.abspath(out_name)
+        if self.inputs.stack:
+            outputs["affine_mat_stack"] = os.path.abspath(
+                out_name + MotionMatStack.EXT)
+        else:
+            outputs["affine_matrices"] = os.path.abspath(out_name)
 
         return outputs
 
@@ -462,6 +493,17 @@ class MeanDisplacementCalculationInputSpec(BaseInterfaceInputSpec):
                               'by the user. This is used for the severe motion'
                               'report in order to provide the real names of '
                               'possibly corrupted images.')
+    batch = traits.Bool(
+        True, usedefault=True, desc='If True (default), all the motion '
+        'matrices are loaded into a single (N, 4, 4) array and the mean '
+        'displacements and motion parameters are calculated for all the '
+        'volumes at once. If False, they are calculated one volume at a time.')
+    binary = traits.Bool(
+        False, usedefault=True, desc='If True, the outputs are saved as '
+        'binary NumPy files (.npy and .npz for the real clock intervals) '
+        'instead of text files. The binary files can be read natively by the '
+        'downstream motion correction interfaces and converted to text with '
+        'MotionDataTextExport.')
 
 
 class MeanDisplacementCalculationOutputSpec(TraitedSpec):
@@ -469,13 +511,15 @@ class MeanDisplacementCalculationOutputSpec(TraitedSpec):
     mean_displacement = File(exists=True, desc='mean displacement between each'
                              ' scan/volume and the reference.')
     mean_displacement_rc = File(exists=True, desc='mean displacement values '
-                                'used in the generate the plot. Essentially it'
-                                ' contains one mean displacement value per '
-                                'millisecond. If, for example, a study lasts '
-                                'for 60 minutes, this file will contain '
-                                '3600000 values. I created this file to be '
-                                'able to plot the entire scan time, including '
-                                'both real scan time and MR idling time.')
+                                'used in the generate the plot ("real '
+                                'clock"). It covers the entire scan time, '
+                                'including both real scan time and MR idling '
+                                'time, in milliseconds. Rather than storing '
+                                'one value per millisecond, it contains one '
+                                'row per volume (start, end, mean '
+                                'displacement), see banana.utils.real_clock.'
+                                'RealClock, which can also expand it into '
+                                'the dense array.')
     mean_displacement_consecutive = File(exists=True, desc='mean displacement '
                                          'between each pair of consecutive '
                                          'scans/volumes.')
@@ -485,9 +529,10 @@ class MeanDisplacementCalculationOutputSpec(TraitedSpec):
         'parameters.')
     motion_parameters = File(exists=True, desc='6 motion parameters (3 '
                              'rotation and 3 translation) per scan/volume.')
-    offset_indexes = File(exists=True, desc='indexes where the '
+    offset_indexes = File(exists=True, desc='start and end (in '
+                          'milliseconds) of the periods where the '
                           'mean_displacement_rc values reflect MR idling '
-                          'times. Used in the plot.')
+                          'times.')
     mats4average = File(exists=True, desc='location of all the motion matrices'
                         ' used to calculate the mean displacement. This will '
                         'be used to create an average motion mat per detected '
@@ -518,8 +563,6 @@ class MeanDisplacementCalculation(BaseInterface):
                     dt.datetime.strptime(list_inputs[0][1], '%H%M%S.%f'))
              .total_seconds(), x[2], x[3], x[4]) for x in list_inputs]
         study_len = int((list_inputs[-1][1]+float(list_inputs[-1][2]))*1000)
-        mean_displacement_rc = np.zeros(study_len)-1
-        motion_par_rc = np.zeros((6, study_len))-1
         mean_displacement = []
         motion_par = []
         idt_mat = np.eye(4)
@@ -534,62 +577,57 @@ class MeanDisplacementCalculation(BaseInterface):
             ' are scans with very different mean displacement with respect '
             'to the others.\nIn that case please check the registration of '
             'that particular scan.']
+        volumes = []
         for f in list_inputs:
             mats = sorted(glob.glob(f[0]+'/*inv.mat'))
             mats4averge = sorted(glob.glob(f[0]+'/*mat.mat'))
-            all_mats = all_mats+mats
             all_mats4average = all_mats4average+mats4averge
             start_scan = f[1]
             tr = f[3]
             if len(mats) > 1:  # for 4D files
                 for i, mat in enumerate(mats):
-                    volume_names.append(f[-1]+'_vol_{}'
-                                        .format(str(i+1).zfill(4)))
-                    start_times.append((
-                        dt.datetime.strptime(
-                            study_start_time, '%H%M%S.%f') +
-                        dt.timedelta(seconds=start_scan))
-                                       .strftime('%H%M%S.%f'))
                     end_scan = start_scan+tr
-                    m = np.loadtxt(mat)
-                    md = self.rmsdiff(ref_cog, m, idt_mat)
-                    mean_displacement_rc[
-                        int(start_scan*1000):int(end_scan*1000)] = md
-                    mean_displacement.append(md)
-                    mp = self.avscale(m, ref_cog)
-                    motion_par.append(mp)
-                    duration = int(end_scan*1000)-int(start_scan*1000)
-                    motion_par_rc[:, int(start_scan*1000):
-                                  int(end_scan*1000)] = np.array(
-                                      [mp, ]*duration).T
+                    volumes.append(
+                        (mat, f[-1]+'_vol_{}'.format(str(i+1).zfill(4)),
+                         start_scan, end_scan))
                     start_scan = end_scan
             elif len(mats) == 1:  # for 3D files
-                volume_names.append(f[-1])
-                start_times.append((
-                    dt.datetime.strptime(study_start_time,
-                                         '%H%M%S.%f') +
-                    dt.timedelta(seconds=start_scan)).strftime('%H%M%S.%f'))
                 end_scan = start_scan+float(f[2])
-                m = np.loadtxt(mats[0])
-                md = self.rmsdiff(ref_cog, m, idt_mat)
-                mean_displacement_rc[
-                    int(start_scan*1000):int(end_scan*1000)] = md
-                mean_displacement.append(md)
-                mp = self.avscale(m, ref_cog)
-                motion_par.append(mp)
-                duration = int(end_scan*1000)-int(start_scan*1000)
-                motion_par_rc[:, int(start_scan*1000):
-                              int(end_scan*1000)] = np.array(
-                                  [mp, ]*duration).T
+                volumes.append((mats[0], f[-1], start_scan, end_scan))
+        for mat, volume_name, start_scan, _ in volumes:
+            all_mats.append(mat)
+            volume_names.append(volume_name)
+            start_times.append((
+                dt.datetime.strptime(study_start_time, '%H%M%S.%f') +
+                dt.timedelta(seconds=start_scan)).strftime('%H%M%S.%f'))
         start_times.append((
             dt.datetime.strptime(study_start_time, '%H%M%S.%f') +
             dt.timedelta(seconds=end_scan)).strftime('%H%M%S.%f'))
-        mean_displacement_consecutive = []
-        for i in range(len(all_mats)-1):
-            m1 = np.loadtxt(all_mats[i])
-            m2 = np.loadtxt(all_mats[i+1])
-            md_consecutive = self.rmsdiff(ref_cog, m1, m2)
-            mean_displacement_consecutive.append(md_consecutive)
+
+        if self.inputs.batch:
+            mats = np.stack([np.loadtxt(m) for m in all_mats])
+            mean_displacement = self.rmsdiff_batch(ref_cog, mats)
+            motion_par = self.avscale_batch(mats, ref_cog)
+            mean_displacement_consecutive = self.rmsdiff_batch(
+                ref_cog, mats[:-1], mats[1:])
+        else:
+            for mat in all_mats:
+                m = np.loadtxt(mat)
+                mean_displacement.append(self.rmsdiff(ref_cog, m, idt_mat))
+                motion_par.append(self.avscale(m, ref_cog))
+            mean_displacement_consecutive = []
+            for i in range(len(all_mats)-1):
+                m1 = np.loadtxt(all_mats[i])
+                m2 = np.loadtxt(all_mats[i+1])
+                md_consecutive = self.rmsdiff(ref_cog, m1, m2)
+                mean_displacement_consecutive.append(md_consecutive)
+
+        rc_starts = [int(x[2]*1000) for x in volumes]
+        rc_ends = [int(x[3]*1000) for x in volumes]
+        mean_displacement_rc = RealClock(
+            rc_starts, rc_ends, mean_displacement, length=study_len)
+        motion_par_rc = RealClock(
+            rc_starts, rc_ends, motion_par, length=study_len)
 
         corrupted_volumes = self.check_max_motion(motion_par)
         if corrupted_volumes:
@@ -602,26 +640,22 @@ class MeanDisplacementCalculation(BaseInterface):
             corrupted_volume_names = (
                 corrupted_volume_names+[volume_names[x]
                                         for x in corrupted_volumes])
-        offset_indexes = np.where(mean_displacement_rc == -1)
-        for i in range(len(mean_displacement_rc)):
-            if (mean_displacement_rc[i] == -1 and
-                    mean_displacement_rc[i-1] != -1):
-                mean_displacement_rc[i] = mean_displacement_rc[i-1]
-        for i in range(motion_par_rc.shape[1]):
-            if (motion_par_rc[0, i] == -1 and motion_par_rc[0, i-1] != -1):
-                motion_par_rc[:, i] = motion_par_rc[:, i-1]
+        binary = self.inputs.binary
+        rc_ext = '.npz' if binary else '.txt'
+        mean_displacement_rc.save('mean_displacement_rc'+rc_ext)
+        motion_par_rc.save('motion_par_rc'+rc_ext)
+        save_array('offset_indexes', mean_displacement_rc.idle_periods(),
+                   binary=binary, fmt='%d')
 
         to_save = [mean_displacement, mean_displacement_consecutive,
-                   mean_displacement_rc, motion_par_rc, start_times,
-                   offset_indexes, all_mats4average, motion_par,
-                   corrupted_volume_names]
+                   start_times, all_mats4average, motion_par]
         to_save_name = ['mean_displacement', 'mean_displacement_consecutive',
-                        'mean_displacement_rc', 'motion_par_rc', 'start_times',
-                        'offset_indexes', 'mats4average', 'motion_par',
-                        'severe_motion_detection_report']
+                        'start_times', 'mats4average', 'motion_par']
         for i in range(len(to_save)):
-            np.savetxt(to_save_name[i]+'.txt', np.asarray(to_save[i]),
-                       fmt='%s')
+            save_array(to_save_name[i], to_save[i], binary=binary)
+        # The report is meant to be read by the user so it is always text
+        np.savetxt('severe_motion_detection_report.txt',
+                   np.asarray(corrupted_volume_names), fmt='%s')
 
         return runtime
 
@@ -639,6 +673,11 @@ class MeanDisplacementCalculation(BaseInterface):
 
         return rms
 
+    def rmsdiff_batch(self, cog, T1, T2=None):
+        """Vectorised version of rmsdiff (see banana.utils.transform.rmsdiff)
+        """
+        return transform.rmsdiff(cog, T1, T2)
+
     def avscale(self, mat, com, res=[1, 1, 1], moco=False):
         """Python implementation of the avscale function in fsl. However this
         works just with affine matrices from rigid body motion, i.e. it assumes
@@ -665,6 +704,12 @@ class MeanDisplacementCalculation(BaseInterface):
                    rot_y_moco, rot_z_moco])
         return [rot_x, rot_y, rot_z, trans_x, trans_y, trans_z]
 
+    def avscale_batch(self, mats, com, res=[1, 1, 1]):
+        """Vectorised version of avscale, which returns the (N, 6) rigid body
+        motion parameters (3 rotations and 3 translations) for a stack of
+        (N, 4, 4) matrices."""
+        return transform.decompose(mats, com, res)
+
     def rad2degree(self, alpha_rad):
         return alpha_rad*180/np.pi
 
@@ -697,6 +742,9 @@ class MeanDisplacementCalculation(BaseInterface):
             z = 0.0
         return np.array([x, y, z])
 
+    def rotationMatrixToEulerAngles_batch(self, R):
+        return transform.euler_angles(R)
+
     def check_max_motion(self, motion_par):
 
         corrupted_vol_rot = np.where(np.abs(
@@ -711,16 +759,18 @@ class MeanDisplacementCalculation(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["mean_displacement"] = os.getcwd()+'/mean_displacement.txt'
+        ext = array_ext(self.inputs.binary)
+        rc_ext = '.npz' if self.inputs.binary else '.txt'
+        outputs["mean_displacement"] = os.getcwd()+'/mean_displacement'+ext
         outputs["mean_displacement_rc"] = (
-            os.getcwd()+'/mean_displacement_rc.txt')
+            os.getcwd()+'/mean_displacement_rc'+rc_ext)
         outputs["mean_displacement_consecutive"] = (
-            os.getcwd()+'/mean_displacement_consecutive.txt')
-        outputs["start_times"] = os.getcwd()+'/start_times.txt'
-        outputs["motion_parameters"] = os.getcwd()+'/motion_par.txt'
-        outputs["motion_parameters_rc"] = os.getcwd()+'/motion_par_rc.txt'
-        outputs["offset_indexes"] = os.getcwd()+'/offset_indexes.txt'
-        outputs["mats4average"] = os.getcwd()+'/mats4average.txt'
+            os.getcwd()+'/mean_displacement_consecutive'+ext)
+        outputs["start_times"] = os.getcwd()+'/start_times'+ext
+        outputs["motion_parameters"] = os.getcwd()+'/motion_par'+ext
+        outputs["motion_parameters_rc"] = os.getcwd()+'/motion_par_rc'+rc_ext
+        outputs["offset_indexes"] = os.getcwd()+'/offset_indexes'+ext
+        outputs["mats4average"] = os.getcwd()+'/mats4average'+ext
         outputs["corrupted_volumes"] = (
             os.getcwd()+'/severe_motion_detection_report.txt')
 
@@ -748,6 +798,9 @@ class MotionFramingInputSpec(BaseInterfaceInputSpec):
     pet_duration = traits.Int(desc='Time, in seconds, the static PET '
                               'reconstruction lasts. Default is from '
                               'pet_start_time+pet_offest to the pet_end_time')
+    binary = traits.Bool(False, usedefault=True, desc='If True, the frame '
+                         'start times and volume numbers are saved as .npy '
+                         'files instead of text files.')
 
 
 class MotionFramingOutputSpec(TraitedSpec):
@@ -767,12 +820,12 @@ class MotionFraming(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        mean_displacement = np.loadtxt(self.inputs.mean_displacement,
+        mean_displacement = load_array(self.inputs.mean_displacement,
                                        dtype=float)
-        mean_displacement_consecutive = np.loadtxt(
+        mean_displacement_consecutive = load_array(
             self.inputs.mean_displacement_consec, dtype=float)
         th = self.inputs.motion_threshold
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
+        start_times = load_array(self.inputs.start_times, dtype=str)
         temporal_th = self.inputs.temporal_threshold
         pet_st = self.inputs.pet_start_time
         pet_endtime = self.inputs.pet_end_time
@@ -791,24 +844,35 @@ class MotionFraming(BaseInterface):
                                 dt.timedelta(seconds=pet_len))
                                .strftime('%H%M%S.%f'))
 
+        # Start times are converted only once, to microseconds from midnight,
+        # so that the scan durations are exactly the same as the ones
+        # obtained from the differences between datetimes
+        start_us = np.array([time2us(t) for t in start_times],
+                            dtype=np.int64)
+        scan_duration = np.diff(start_us) / 1e6
+        cum_duration = np.concatenate(([0.0], np.cumsum(scan_duration)))
+
+        def duration(start, end):
+            return self.duration(scan_duration, cum_duration, start, end,
+                                 temporal_th)
+
+        mean_displacement = np.atleast_1d(mean_displacement).tolist()
+        mean_displacement_consecutive = np.atleast_1d(
+            mean_displacement_consecutive).tolist()
         md_0 = mean_displacement[0]
         max_md = mean_displacement[0]
         frame_vol = [0]
         frame_st4pet = []
 
-        scan_duration = [
-            (dt.datetime.strptime(start_times[i], '%H%M%S.%f') -
-             dt.datetime.strptime(start_times[i-1], '%H%M%S.%f')
-             ).total_seconds() for i in range(1, len(start_times))]
-
+        # frame_vol is always sorted and its last element is never greater
+        # than i, so only the last element needs to be checked/removed
         for i, md in enumerate(mean_displacement[1:]):
 
             current_md = md
-            if (np.abs(md_0 - current_md) > th or
-                    np.abs(max_md - current_md) > th):
-                duration = np.sum(scan_duration[frame_vol[-1]:i+1])
-                if duration > temporal_th:
-                    if i+1 not in frame_vol:
+            if (abs(md_0 - current_md) > th or
+                    abs(max_md - current_md) > th):
+                if duration(frame_vol[-1], i+1) > temporal_th:
+                    if frame_vol[-1] != i+1:
                         frame_vol.append(i+1)
 
                     md_0 = current_md
@@ -816,14 +880,13 @@ class MotionFraming(BaseInterface):
                 else:
                     prev_md = mean_displacement[frame_vol[-1]]
                     if (prev_md - current_md) > th*2:
-                        frame_vol.remove(frame_vol[-1])
+                        frame_vol.pop()
                     elif (current_md - prev_md) > th:
-                        frame_vol.remove(frame_vol[-1])
+                        frame_vol.pop()
                         frame_vol.append(i)
             elif mean_displacement_consecutive[i] > th:
-                duration = np.sum(scan_duration[frame_vol[-1]:i+1])
-                if duration > temporal_th:
-                    if i+1 not in frame_vol:
+                if duration(frame_vol[-1], i+1) > temporal_th:
+                    if frame_vol[-1] != i+1:
                         frame_vol.append(i+1)
                     md_0 = current_md
                     max_md = current_md
@@ -832,23 +895,22 @@ class MotionFraming(BaseInterface):
             elif current_md < md_0:
                 md_0 = current_md
 
-        duration = np.sum(scan_duration[frame_vol[-1]:i+2])
-        if duration > temporal_th:
-            if (i + 2) not in frame_vol:
-                frame_vol.append(i + 2)
+        last_vol = len(mean_displacement)
+        if duration(frame_vol[-1], last_vol) > temporal_th:
+            if frame_vol[-1] != last_vol:
+                frame_vol.append(last_vol)
         else:
-            frame_vol.remove(frame_vol[-1])
-            frame_vol.append(i + 2)
+            frame_vol.pop()
+            frame_vol.append(last_vol)
 
         frame_vol = sorted(frame_vol)
         frame_start_times = [start_times[x] for x in frame_vol]
         if pet_st and pet_endtime:
+            pet_st_us = time2us(pet_st)
+            pet_end_us = time2us(pet_endtime)
             frame_st4pet = [
-                x for x in frame_start_times if
-                (dt.datetime.strptime(x, '%H%M%S.%f') >
-                 dt.datetime.strptime(pet_st, '%H%M%S.%f')
-                 and dt.datetime.strptime(x, '%H%M%S.%f') <
-                 dt.datetime.strptime(pet_endtime, '%H%M%S.%f'))]
+                x for x, x_us in zip(frame_start_times, start_us[frame_vol])
+                if pet_st_us < x_us < pet_end_us]
             if frame_start_times[0] in frame_st4pet:
                 frame_st4pet.remove(frame_start_times[0])
             if frame_start_times[-1] in frame_st4pet:
@@ -856,61 +918,69 @@ class MotionFraming(BaseInterface):
             frame_st4pet.append(pet_st)
             frame_st4pet.append(pet_endtime)
             frame_st4pet = sorted(frame_st4pet)
-            if ((dt.datetime.strptime(frame_st4pet[1], '%H%M%S.%f') -
-                    dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f'))
-                    .total_seconds() < 30):
+            if (time2us(frame_st4pet[1]) -
+                    time2us(frame_st4pet[0])) / 1e6 < 30:
                 frame_st4pet.remove(frame_st4pet[1])
-            if ((dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f') -
-                    dt.datetime.strptime(frame_st4pet[-2], '%H%M%S.%f'))
-                    .total_seconds() < 30):
+            if (time2us(frame_st4pet[-1]) -
+                    time2us(frame_st4pet[-2])) / 1e6 < 30:
                 frame_st4pet.remove(frame_st4pet[-2])
-            frame_vol = [i for i in range(len(start_times)) for j in
-                         range(len(frame_st4pet)) if start_times[i] ==
-                         frame_st4pet[j]]
-            if (dt.datetime.strptime(start_times[0], '%H%M%S.%f') >
-                    dt.datetime.strptime(pet_st, '%H%M%S.%f')):
+            n_matches = collections.Counter(frame_st4pet)
+            frame_vol = [i for i, t in enumerate(start_times)
+                         for _ in range(n_matches[t])]
+            if start_us[0] > pet_st_us:
                 frame_vol.append(0)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i+1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[0], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
-            if (dt.datetime.strptime(start_times[-1], '%H%M%S.%f') <
-                    dt.datetime.strptime(pet_endtime, '%H%M%S.%f')):
+                frame_vol.append(self.volume_before(
+                    start_us, time2us(frame_st4pet[0])))
+            if start_us[-1] < pet_end_us:
                 frame_vol.append(len(start_times)-1)
             else:
-                vol = [i for i in range(len(start_times)) if
-                       (dt.datetime.strptime(start_times[i], '%H%M%S.%f') <
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f') and
-                        dt.datetime.strptime(start_times[i+1], '%H%M%S.%f') >
-                        dt.datetime.strptime(frame_st4pet[-1], '%H%M%S.%f'))]
-                frame_vol.append(vol[0])
+                frame_vol.append(self.volume_before(
+                    start_us, time2us(frame_st4pet[-1])))
             frame_vol = sorted(frame_vol)
-        np.savetxt('frame_start_times.txt', np.asarray(frame_start_times),
-                   fmt='%s')
-        os.mkdir('timestamps')
+        save_array('frame_start_times', frame_start_times,
+                   binary=self.inputs.binary)
         if frame_st4pet:
-            timestamps_2save = frame_st4pet
+            save_timestamps(frame_st4pet)
         else:
-            timestamps_2save = frame_start_times
-        np.savetxt('timestamps/frame_start_times_4PET.txt',
-                   np.asarray(timestamps_2save), fmt='%s')
-        for i in range(len(timestamps_2save)-1):
-            with open('timestamps/timestamps_Frame{}.txt'
-                      .format(str(i).zfill(3)), 'w') as f:
-                f.write(timestamps_2save[i]+'\n'+timestamps_2save[i+1])
-            f.close()
-        np.savetxt('frame_vol_numbers.txt', np.asarray(frame_vol), fmt='%s')
+            save_timestamps(frame_start_times)
+        save_array('frame_vol_numbers', frame_vol, binary=self.inputs.binary)
 
         return runtime
 
+    def duration(self, scan_duration, cum_duration, start, end, threshold,
+                 tol=1e-3):
+        """Total duration of the volumes between start and end. This is
+        calculated from the cumulative durations unless it is within `tol`
+        seconds from the threshold it will be compared against, in which case
+        the durations are summed explicitly so that the comparison gives
+        exactly the same result as summing them"""
+        total = cum_duration[end] - cum_duration[start]
+        if abs(total - threshold) < tol:
+            total = np.sum(scan_duration[start:end])
+        return total
+
+    def volume_before(self, start_us, time_us):
+        """Returns the index of the volume that is being acquired at
+        `time_us`, i.e. the first volume starting before it and followed by
+        one starting after it"""
+        if np.all(start_us[1:] >= start_us[:-1]):
+            i = np.searchsorted(start_us, time_us) - 1
+            if (0 <= i < len(start_us) - 1 and start_us[i] < time_us and
+                    start_us[i+1] > time_us):
+                return int(i)
+        # Start times are not sorted (e.g. the session crossed midnight) or
+        # no volume was found
+        vol = [i for i in range(len(start_us)) if
+               (start_us[i] < time_us and start_us[i+1] > time_us)]
+        return vol[0]
+
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["frame_start_times"] = os.getcwd()+'/frame_start_times.txt'
-        outputs["frame_vol_numbers"] = os.getcwd()+'/frame_vol_numbers.txt'
+        ext = array_ext(self.inputs.binary)
+        outputs["frame_start_times"] = os.getcwd()+'/frame_start_times'+ext
+        outputs["frame_vol_numbers"] = os.getcwd()+'/frame_vol_numbers'+ext
         outputs["timestamps_dir"] = os.getcwd()+'/timestamps'
 
         return outputs
@@ -919,13 +989,11 @@ class MotionFraming(BaseInterface):
 class PlotMeanDisplacementRCInputSpec(BaseInterfaceInputSpec):
 
     mean_disp_rc = File(exists=True, desc='Text file containing the mean '
-                        'displacement real clock.')
+                        'displacement real clock intervals.')
     motion_par_rc = File(exists=True, desc='Text file containing the motion '
-                         'parameters real clock.')
+                         'parameters real clock intervals.')
     frame_start_times = File(exists=True, desc='Frame start times as detected'
                              'by the motion framing pipeline')
-    false_indexes = File(exists=True, desc='Time indexes were the scanner was '
-                         'idling, i.e. there is no motion information.')
     framing = traits.Bool(desc='If true, the frame start times will be plotted'
                           'in the final image.')
 
@@ -944,84 +1012,45 @@ class PlotMeanDisplacementRC(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        mean_disp_rc = np.loadtxt(self.inputs.mean_disp_rc)
-        false_indexes = np.loadtxt(self.inputs.false_indexes, dtype=int)
+        mean_disp_rc = RealClock.load(self.inputs.mean_disp_rc)
 
+        self.gen_plot(mean_disp_rc)
         if isdefined(self.inputs.motion_par_rc):
-            motion_par_rc = np.loadtxt(self.inputs.motion_par_rc)
-            plot_mp = True
-        else:
-            plot_mp = False
-        plot_offset = True
-        dates = np.arange(0, len(mean_disp_rc), 1)
-        indxs = np.zeros(len(mean_disp_rc), int)+1
-        indxs[false_indexes] = 0
-        start_true_period = [x for x in range(1, len(indxs)) if indxs[x] == 1
-                             and indxs[x-1] == 0]
-        end_true_period = [x for x in range(len(indxs)-1) if indxs[x] == 0 and
-                           indxs[x-1] == 1]
-        start_true_period.append(1)
-        end_true_period.append(len(dates))
-        start_true_period = sorted(start_true_period)
-        end_true_period = sorted(end_true_period)
-        if len(start_true_period) == len(end_true_period)-1:
-            end_true_period.remove(end_true_period[-1])
-        elif len(start_true_period) != len(end_true_period):
-            print ('Something went wrong in the identification of the MR '
-                   'idling time. It will not be plotted.')
-            plot_offset = False
-
-        self.gen_plot(dates, mean_disp_rc, plot_offset, start_true_period,
-                      end_true_period)
-        if plot_mp:
+            motion_par_rc = RealClock.load(self.inputs.motion_par_rc)
             for i in range(2):
-                mp = motion_par_rc[i*3:(i+1)*3, :]
-                self.gen_plot(
-                    dates, mp, plot_offset, start_true_period, end_true_period,
-                    plot_mp=plot_mp, mp_ind=i)
+                mp = motion_par_rc.select(slice(i*3, (i+1)*3))
+                self.gen_plot(mp, plot_mp=True, mp_ind=i)
 
         return runtime
 
-    def gen_plot(self, dates, to_plot, plot_offset, start_true_period,
-                 end_true_period, plot_mp=False, mp_ind=None):
+    def gen_plot(self, real_clock, plot_mp=False, mp_ind=None):
 
-        frame_start_times = np.loadtxt(self.inputs.frame_start_times)
+        frame_start_times = load_array(self.inputs.frame_start_times,
+                                       dtype=str)
         framing = self.inputs.framing
+        study_len = len(real_clock)
         font = {'weight': 'bold', 'size': 30}
         matplotlib.rc('font', **font)
         fig, ax = plot.subplots()
         fig.set_size_inches(21, 9)
-        ax.set_xlim(0, dates[-1])
+        ax.set_xlim(0, study_len-1)
         ax.set_ylim(25, 60)
         if plot_mp:
             col = ['b', 'g', 'r']
-        if plot_offset:
-            for i in range(0, len(start_true_period)):
-                if plot_mp:
-                    for ii in range(3):
-                        ax.plot(
-                            dates[start_true_period[i]-1:end_true_period[i]+1],
-                            to_plot[ii, start_true_period[i]-1:
-                                    end_true_period[i]+1],
-                            c=col[ii], linewidth=2)
-                else:
-                    ax.plot(dates[start_true_period[i]-1:end_true_period[i]+1],
-                            to_plot[start_true_period[i]-1:
-                                    end_true_period[i]+1], c='b', linewidth=2)
-            for i in range(0, len(end_true_period)-1):
-                if plot_mp:
-                    for ii in range(3):
-                        ax.plot(
-                            dates[end_true_period[i]-1:
-                                  start_true_period[i+1]+1],
-                            to_plot[ii, end_true_period[i]-1:
-                                    start_true_period[i+1]+1],
-                            c=col[ii], linewidth=2, ls='--', dashes=(2, 3))
-                else:
-                    ax.plot(
-                        dates[end_true_period[i]-1:start_true_period[i+1]+1],
-                        to_plot[end_true_period[i]-1:start_true_period[i+1]+1],
-                        c='b', linewidth=2, ls='--', dashes=(2, 3))
+        else:
+            col = ['b']
+        # The real clock is plotted as a step function, solid where the
+        # scanner was acquiring and dashed over the MR idling time
+        scan_steps, idle_steps = real_clock.step_coords()
+        for x, y in scan_steps:
+            y = y.reshape(len(x), -1)
+            for ii in range(y.shape[1]):
+                ax.plot(x, y[:, ii], c=col[ii], linewidth=2)
+        for x, y in idle_steps:
+            y = y.reshape(len(x), -1)
+            for ii in range(y.shape[1]):
+                ax.plot(x, y[:, ii], c=col[ii], linewidth=2, ls='--',
+                        dashes=(2, 3))
 
         if framing:
             cl = 'yellow'
@@ -1033,29 +1062,29 @@ class PlotMeanDisplacementRC(BaseInterface):
                      dt.datetime.strptime(str(frame_start_times[0]),
                                           '%H%M%S.%f'))
                     .total_seconds()*1000)
-                if tt >= len(dates):
-                    tt = len(dates)-1
-                plot.axvline(dates[int(tt)], c='b', alpha=0.3, ls='--')
+                if tt >= study_len:
+                    tt = study_len-1
+                plot.axvline(int(tt), c='b', alpha=0.3, ls='--')
 
                 tt1 = ((dt.datetime.strptime(str(frame_start_times[i+1]),
                                              '%H%M%S.%f') -
                        dt.datetime.strptime(str(frame_start_times[0]),
                                             '%H%M%S.%f'))
                        .total_seconds()*1000)
-                if tt1 >= len(dates):
-                    tt1 = len(dates)-1
-                plot.axvspan(dates[int(tt)], dates[int(tt1)], facecolor=cl,
-                             alpha=0.4, linewidth=0)
+                if tt1 >= study_len:
+                    tt1 = study_len-1
+                plot.axvspan(int(tt), int(tt1), facecolor=cl, alpha=0.4,
+                             linewidth=0)
 
                 if i % 2 == 0:
                     cl = 'w'
                 else:
                     cl = 'yellow'
 
-        indx = np.arange(0, len(dates), 300000)
-        my_thick = [str(i) for i in np.arange(0, len(dates)/60000, 5,
+        indx = np.arange(0, study_len, 300000)
+        my_thick = [str(i) for i in np.arange(0, study_len/60000, 5,
                                               dtype=int)]
-        plot.xticks(dates[indx], my_thick)
+        plot.xticks(indx, my_thick)
 #         ax.set_yscale('log')
 #         ax.set_yticks([10, 30, 50])
 #         ax.get_yaxis().set_major_formatter(matplotlib.ticker.ScalarFormatter())
@@ -1064,12 +1093,14 @@ class PlotMeanDisplacementRC(BaseInterface):
         plot.yticks(my_y_ticks, my_y_ticks)
         plot.xlabel('Time [min]', fontsize=25)
         if mp_ind == 0:
-            ax.set_ylim(np.min(to_plot)-0.1, np.max(to_plot)+0.1)
+            ax.set_ylim(np.min(real_clock.values)-0.1,
+                        np.max(real_clock.values)+0.1)
             plot.legend(['Rotation X', 'Rotation Y', 'Rotation Z'], loc=0)
             plot.ylabel('Rotation [rad]', fontsize=25)
             plot.savefig('Rotation_real_clock.png')
         elif mp_ind == 1:
-            ax.set_ylim(np.min(to_plot)-0.5, np.max(to_plot)+0.5)
+            ax.set_ylim(np.min(real_clock.values)-0.5,
+                        np.max(real_clock.values)+0.5)
             plot.legend(
                 ['Translation X', 'Translation Y', 'Translation Z'], loc=0)
             plot.ylabel('Translation [mm]', fontsize=25)
@@ -1096,6 +1127,18 @@ class AffineMatAveragingInputSpec(BaseInterfaceInputSpec):
 
     frame_vol_numbers = File(exists=True)
     all_mats4average = File(exists=True)
+    binary = traits.Bool(False, usedefault=True, desc='If True, the average '
+                         'matrices are saved as .npy files instead of text '
+                         'files.')
+    rotation_mean = traits.Enum(
+        'arithmetic', 'quaternion', usedefault=True, desc='How the rotations '
+        'are averaged. "arithmetic" averages the matrices element-wise, while '
+        '"quaternion" averages the rotations as quaternions so that the '
+        'average matrices are still rigid body transformations.')
+    stack = traits.Bool(
+        False, usedefault=True, desc='If True, the average matrices are saved '
+        'in a single motion_mat_stack file (average_mat_stack output) instead '
+        'of one file per frame within a directory.')
 
 
 class AffineMatAveragingOutputSpec(TraitedSpec):
@@ -1103,6 +1146,9 @@ class AffineMatAveragingOutputSpec(TraitedSpec):
     average_mats = Directory(exists=True, desc='directory with all the average'
                              ' transformation matrices for each detected '
                              'frame.')
+    average_mat_stack = File(exists=True, desc='The average transformation '
+                             'matrices for each detected frame stacked in a '
+                             'single file (if stack is True).')
 
 
 class AffineMatAveraging(BaseInterface):
@@ -1110,49 +1156,45 @@ class AffineMatAveraging(BaseInterface):
     input_spec = AffineMatAveragingInputSpec
     output_spec = AffineMatAveragingOutputSpec
 
-    def _run_interface(self, runtime):
-
-        frame_vol = np.loadtxt(self.inputs.frame_vol_numbers, dtype=int)
-        all_mats = np.loadtxt(self.inputs.all_mats4average, dtype=str)
-        idt = np.eye(4)
-
-        for v in range(len(frame_vol)-1):
-
-            v1 = frame_vol[v]
-            v2 = frame_vol[v + 1]
-            mat_tot = np.zeros((4, 4, (v2 - v1)))
-            n_vol = 0
+    out_name = 'frame_mean_transformation_mats'
 
-            for j, m in enumerate(all_mats[v1:v2]):
-                mat = np.loadtxt(m)
-                if (mat == idt).all():
-                    mat_tot[:, :, j] = np.zeros((4, 4))
-                else:
-                    mat_tot[:, :, j] = mat
-                    n_vol += 1
-            if n_vol > 0:
-                average_mat = np.sum(mat_tot, axis=2) / n_vol
-            else:
-                average_mat = idt
-
-            np.savetxt(
-                'average_matrix_vol_{0}-{1}.txt'
-                .format(str(v1).zfill(4), str(v2).zfill(4)), average_mat)
-
-        if os.path.isdir('frame_mean_transformation_mats') is False:
-            os.mkdir('frame_mean_transformation_mats')
+    def _run_interface(self, runtime):
 
-        mats = glob.glob('average_matrix_vol*')
-        for m in mats:
-            shutil.move(m, 'frame_mean_transformation_mats')
+        frame_vol = load_array(self.inputs.frame_vol_numbers, dtype=int)
+        all_mats = load_array(self.inputs.all_mats4average, dtype=str)
+        # Each matrix is loaded once, identities (i.e. volumes that have not
+        # been realigned) are excluded from the averages
+        first = frame_vol[0]
+        mats = np.asarray([load_array(m) for m in
+                           all_mats[first:frame_vol[-1]]]).reshape(-1, 4, 4)
+        valid = ~(mats == np.eye(4)).all(axis=(1, 2))
+        average_mats = transform.frame_means(
+            mats, frame_vol - first, valid=valid,
+            rotation_mean=self.inputs.rotation_mean)
+
+        names = ['average_matrix_vol_{0}-{1}'.format(
+            str(v1).zfill(4), str(v2).zfill(4))
+            for v1, v2 in zip(frame_vol[:-1], frame_vol[1:])]
+        if self.inputs.stack:
+            MotionMatStack(average_mats, names).save(self.out_name)
+            return runtime
+
+        if os.path.isdir(self.out_name) is False:
+            os.mkdir(self.out_name)
+        for name, average_mat in zip(names, average_mats):
+            save_array(os.path.join(self.out_name, name), average_mat,
+                       binary=self.inputs.binary, fmt='%.18e')
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["average_mats"] = (
-            os.getcwd()+'/frame_mean_transformation_mats')
+        if self.inputs.stack:
+            outputs["average_mat_stack"] = os.path.abspath(
+                self.out_name + MotionMatStack.EXT)
+        else:
+            outputs["average_mats"] = os.getcwd()+'/'+self.out_name
 
         return outputs
 
@@ -1207,7 +1249,11 @@ class UmapAlign2ReferenceInputSpec(BaseInterfaceInputSpec):
 
     average_mats = Directory(exists=True, desc='directory with all the average'
                              ' transformation matrices for each detected '
-                             'frame.')
+                             'frame.', xor=['average_mat_stack'])
+    average_mat_stack = File(exists=True, desc='motion_mat_stack file with '
+                             'the average transformation matrices for each '
+                             'detected frame. Alternative to average_mats.',
+                             xor=['average_mats'])
     ute_regmat = File(exists=True, desc='registration mat between ute image '
                       'and reference.')
     ute_qform_mat = File(exists=True, desc='qform mat between ute and '
@@ -1219,12 +1265,27 @@ class UmapAlign2ReferenceInputSpec(BaseInterfaceInputSpec):
                       'provided umap is continuos values, as the pseudo CT '
                       'umap. Otherwise, it will assume that the values are '
                       'discrete. Default is False.')
+    stack = traits.Bool(
+        False, usedefault=True, desc='If True, the matrices between the '
+        'reference and the ute image in each frame are saved in a single '
+        'motion_mat_stack file (ref_to_ute_mats output) instead of two text '
+        'files per frame.')
+    num_workers = traits.Int(
+        1, usedefault=True, desc='Number of frames that are realigned '
+        'concurrently, each one by a separate process. Default is 1 '
+        '(serial).')
+    resampler = traits.Enum(
+        'flirt', 'scipy', usedefault=True, desc='Tool used to realign the '
+        'umap. Either FLIRT (default) or an in-process scipy.ndimage '
+        'resampler (see banana.utils.resample).')
 
 
 class UmapAlign2ReferenceOutputSpec(TraitedSpec):
 
     umaps_align2ref = Directory(desc='directory with all the realigned umaps '
                                 '(if a umaps is provided as input).')
+    ref_to_ute_mats = File(desc='matrices between the reference and the ute '
+                           'image in each frame (if stack is True).')
 
 
 class UmapAlign2Reference(BaseInterface):
@@ -1234,16 +1295,71 @@ class UmapAlign2Reference(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        average_mats = sorted(glob.glob(self.inputs.average_mats+'/*.txt'))
+        if isdefined(self.inputs.average_mat_stack):
+            average_mats = MotionMatStack.load(
+                self.inputs.average_mat_stack).mats
+        else:
+            average_mats = [load_array(m) for m in
+                            list_mats(self.inputs.average_mats)]
         umap = self.inputs.umap
         pct = self.inputs.pct
-        ute_regmat = self.inputs.ute_regmat
-        ute_qform_mat = self.inputs.ute_qform_mat
         outname = 'Frame'
 
-        for i, mat in enumerate(average_mats):
-            self.UmapAlign2Reference_calc(mat, i, ute_regmat, ute_qform_mat,
-                                          outname, umap, pct=pct)
+        ref_to_ute_mats, ref_to_ute_inv_mats = self.ref_to_ute_mats(
+            np.asarray(average_mats), np.loadtxt(self.inputs.ute_regmat),
+            np.loadtxt(self.inputs.ute_qform_mat))
+        frames = [str(i).zfill(3) for i in range(len(ref_to_ute_mats))]
+        mat_fnames = []
+        for frame, mat, mat_inv in zip(frames, ref_to_ute_mats,
+                                       ref_to_ute_inv_mats):
+            mat_fname = os.path.abspath(
+                '{0}_{1}_ref_to_ute.mat'.format(outname, frame))
+            np.savetxt(mat_fname, mat)
+            np.savetxt('{0}_{1}_ref_to_ute_inv.mat'.format(outname, frame),
+                       mat_inv)
+            mat_fnames.append(mat_fname)
+
+        if self.inputs.resampler == 'scipy':
+            interp = 'trilinear' if pct else 'nearestneighbour'
+            out_fnames = [os.path.abspath('Frame_{0}_umap.nii.gz'.format(f))
+                          for f in frames]
+            if self.inputs.num_workers > 1:
+                with ProcessPoolExecutor(self.inputs.num_workers) as pool:
+                    list(pool.map(
+                        apply_fsl_xfm_file, [umap] * len(frames),
+                        [umap] * len(frames), mat_fnames, out_fnames,
+                        [interp] * len(frames)))
+            else:
+                umap_img = nib.load(umap)
+                for mat, out_fname in zip(ref_to_ute_mats, out_fnames):
+                    nib.save(apply_fsl_xfm(umap_img, umap_img, mat,
+                                           interp=interp), out_fname)
+        elif self.inputs.num_workers > 1:
+            # The resampling is done by separate FLIRT processes, so threads
+            # are enough to run several of them at the same time
+            with ThreadPoolExecutor(self.inputs.num_workers) as pool:
+                list(pool.map(
+                    lambda args: self.UmapAlign2Reference_calc(
+                        *args, umap=umap, pct=pct), zip(mat_fnames, frames)))
+        else:
+            for mat_fname, frame in zip(mat_fnames, frames):
+                self.UmapAlign2Reference_calc(mat_fname, frame, umap,
+                                              pct=pct)
+
+        if self.inputs.stack:
+            MotionMatStack(
+                np.stack((ref_to_ute_mats, ref_to_ute_inv_mats),
+                         axis=1).reshape(-1, 4, 4),
+                ['{0}_{1}_ref_to_ute{2}'.format(outname, frame, suffix)
+                 for frame in frames for suffix in ('', '_inv')]).save(
+                     'ref_to_ute_mats')
+            # The matrices were only needed by FLIRT as they are saved in the
+            # stack
+            for frame in frames:
+                for suffix in ('ref_to_ute', 'ref_to_ute_inv', 'umap_flirt'):
+                    fname = '{0}_{1}_{2}.mat'.format(outname, frame, suffix)
+                    if os.path.exists(fname):
+                        os.remove(fname)
 
         umaps = glob.glob('Frame_*_umap.nii.gz')
         if os.path.isdir('umaps_align2ref') is False:
@@ -1253,22 +1369,16 @@ class UmapAlign2Reference(BaseInterface):
 
         return runtime
 
-    def UmapAlign2Reference_calc(self, mat, i, ute_regmat, ute_qform_mat,
-                                 outname, umap, pct=False):
-
-        mat = np.loadtxt(mat)
-        utemat = np.loadtxt(ute_regmat)
-        utemat_qform = np.loadtxt(ute_qform_mat)
-        utemat_qform_inv = np.linalg.inv(utemat_qform)
-        ute2frame = np.dot(mat, utemat)
-        ute2frame_qform = np.dot(utemat_qform_inv, ute2frame)
+    def ref_to_ute_mats(self, mats, ute_regmat, ute_qform_mat):
+        """Calculates the matrices between the reference and the ute image in
+        each frame (and their inverse) for all the frames at once"""
+        utemat_qform_inv = np.linalg.inv(ute_qform_mat)
+        ute2frame = np.matmul(mats, ute_regmat)
+        ute2frame_qform = np.matmul(utemat_qform_inv, ute2frame)
         ute2frame_qform_inv = np.linalg.inv(ute2frame_qform)
+        return ute2frame_qform, ute2frame_qform_inv
 
-        np.savetxt('{0}_{1}_ref_to_ute.mat'.format(outname, str(i).zfill(3)),
-                   ute2frame_qform)
-        np.savetxt(
-            '{0}_{1}_ref_to_ute_inv.mat'.format(outname, str(i).zfill(3)),
-            ute2frame_qform_inv)
+    def UmapAlign2Reference_calc(self, mat_fname, frame, umap, pct=False):
 
         if pct:
             interp = 'trilinear'
@@ -1278,10 +1388,12 @@ class UmapAlign2Reference(BaseInterface):
         flt.inputs.reference = umap
         flt.inputs.in_file = umap
         flt.inputs.interp = interp
-        flt.inputs.in_matrix_file = ('Frame_{0}_ref_to_ute.mat'
-                                     .format(str(i).zfill(3)))
-        flt.inputs.out_file = 'Frame_{0}_umap.nii.gz'.format(
-            str(i).zfill(3))
+        flt.inputs.in_matrix_file = mat_fname
+        flt.inputs.out_file = os.path.abspath(
+            'Frame_{0}_umap.nii.gz'.format(frame))
+        # Otherwise all the frames would write to the same matrix file
+        flt.inputs.out_matrix_file = os.path.abspath(
+            'Frame_{0}_umap_flirt.mat'.format(frame))
         flt.inputs.apply_xfm = True
         flt.run()
 
@@ -1290,6 +1402,9 @@ class UmapAlign2Reference(BaseInterface):
 
         outputs["umaps_align2ref"] = (
             os.getcwd()+'/umaps_align2ref')
+        if self.inputs.stack:
+            outputs["ref_to_ute_mats"] = os.path.abspath(
+                'ref_to_ute_mats' + MotionMatStack.EXT)
 
         return outputs
 
@@ -1306,6 +1421,9 @@ class CreateMocoSeriesInputSpec(BaseInterfaceInputSpec):
                        'the sequences (or volumes) acquired in the study ('
                        'this is the output of the mean displacement calculatio'
                        'n pipeline).')
+    num_workers = traits.Int(
+        4, usedefault=True, desc='Number of threads used to write the volumes '
+        'of the new moco series.')
 
 
 class CreateMocoSeriesOutputSpec(TraitedSpec):
@@ -1319,57 +1437,63 @@ class CreateMocoSeries(BaseInterface):
     input_spec = CreateMocoSeriesInputSpec
     output_spec = CreateMocoSeriesOutputSpec
 
+    out_dir = 'new_moco_series'
+
     def _run_interface(self, runtime):
 
         moco_template = self.inputs.moco_template
-        motion_par = np.loadtxt(self.inputs.motion_par)
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
+        motion_par = load_array(self.inputs.motion_par)
+        start_times = load_array(self.inputs.start_times, dtype=str)
         start_times = start_times[:-1]
 
         if len(motion_par) != len(start_times):
             raise Exception('Detected a different number of motion parameters '
                             'and start times. This number must be the same in '
                             'order to create a new moco series. Please check.')
-        motion_par_moco = [self.fsl2moco(x) for x in motion_par]
+        motion_par_moco = transform.fsl2moco(motion_par)
         new_uid = pydicom.uid.generate_uid()
-        for i in range(len(start_times)):
-            hd = pydicom.read_file(moco_template)
+        os.mkdir(self.out_dir)
+        # Each thread parses the template once and then writes its share of
+        # the volumes, only changing the elements that differ between them
+        chunks = [c for c in np.array_split(np.arange(len(start_times)),
+                                            max(self.inputs.num_workers, 1))
+                  if len(c)]
+        with ThreadPoolExecutor(max(len(chunks), 1)) as pool:
+            list(pool.map(
+                lambda vols: self.write_volumes(
+                    moco_template, vols, motion_par_moco[vols],
+                    start_times[vols], new_uid), chunks))
+
+        return runtime
+
+    def write_volumes(self, moco_template, vols, motion_par_moco, start_times,
+                      uid):
+
+        hd = pydicom.dcmread(moco_template)
+        hd.SeriesInstanceUID = uid
+        hd.SeriesDescription = 'MoCoSeries'
+        hd.SeriesNumber = '150'
+        for i, mp, start_time in zip(vols, motion_par_moco, start_times):
             for n in range(3):
-                hd[0x19, 0x1025].value[n] = motion_par_moco[i][n]
+                hd[0x19, 0x1025].value[n] = mp[n]
             for n in range(3):
-                hd[0x19, 0x1026].value[n] = motion_par_moco[i][n+3]
-            hd.AcquisitionTime = start_times[i]
+                hd[0x19, 0x1026].value[n] = mp[n+3]
+            hd.AcquisitionTime = start_time
             hd.InstanceNumber = pydicom.valuerep.IS(i+1)
             hd.AcquisitionNumber = pydicom.valuerep.IS(i+1)
-            hd.SeriesInstanceUID = new_uid
-            hd.SeriesDescription = 'MoCoSeries'
-            hd.SeriesNumber = '150'
-            hd.save_as('{}.IMA'.format(str(i).zfill(6)))
-
-        os.mkdir('new_moco_series')
-        dicoms = sorted(glob.glob('*.IMA'))
-        for dcm in dicoms:
-            shutil.move(dcm, 'new_moco_series')
-
-        return runtime
+            hd.save_as(os.path.join(self.out_dir,
+                                    '{}.IMA'.format(str(i).zfill(6))))
 
     def fsl2moco(self, mp):
-        rot_x_moco = -self.rad2degree(mp[1])
-        rot_y_moco = self.rad2degree(mp[0])
-        rot_z_moco = -self.rad2degree(mp[2])
-        trans_x_moco = -mp[4]
-        trans_y_moco = mp[3]
-        trans_z_moco = -mp[5]
-        return [trans_x_moco, trans_y_moco, trans_z_moco, rot_x_moco,
-                rot_y_moco, rot_z_moco]
+        return transform.fsl2moco(mp)[0].tolist()
 
     def rad2degree(self, alpha_rad):
-        return alpha_rad*180/np.pi
+        return transform.rad2degree(alpha_rad)
 
     def _list_outputs(self):
         outputs = self._outputs().get()
 
-        outputs["modified_moco"] = os.getcwd()+'/new_moco_series'
+        outputs["modified_moco"] = os.getcwd()+'/'+self.out_dir
 
         return outputs
 
@@ -1388,6 +1512,9 @@ class FixedBinningInputSpec(BaseInterfaceInputSpec):
     pet_start_time = traits.Str(desc='PET start time')
     motion_mats = File(exists=True, desc='Text file with the list of all the '
                        'motion matrices.')
+    binary = traits.Bool(False, usedefault=True, desc='If True, the average '
+                         'bin matrices are saved as .npy files instead of '
+                         'text files.')
 
 
 class FixedBinningOutputSpec(TraitedSpec):
@@ -1407,10 +1534,10 @@ class FixedBinning(BaseInterface):
         n_frames = self.inputs.n_frames
         pet_offset = self.inputs.pet_offset
         bin_len = self.inputs.bin_len
-        start_times = np.loadtxt(self.inputs.start_times, dtype=str)
+        start_times = load_array(self.inputs.start_times, dtype=str)
         pet_duration = self.inputs.pet_duration
         pet_start_time = self.inputs.pet_start_time
-        motion_mats = np.loadtxt(self.inputs.motion_mats, dtype=str)
+        motion_mats = load_array(self.inputs.motion_mats, dtype=str)
         if n_frames == 0 and pet_offset == 0:
             pet_len = pet_duration
         elif n_frames == 0 and pet_offset != 0:
@@ -1418,100 +1545,98 @@ class FixedBinning(BaseInterface):
         elif n_frames != 0:
             pet_len = bin_len*n_frames
 
-        MR_start_time = dt.datetime.strptime(str(start_times[0]), '%H%M%S.%f')
-        start_times_diff = [
-            (dt.datetime.strptime(str(start_times[i+1]), '%H%M%S.%f') -
-             dt.datetime.strptime(
-                 str(start_times[i]), '%H%M%S.%f')).total_seconds()
-            for i in range(len(start_times)-1)]
-        scan_duration = np.cumsum(np.asarray(start_times_diff))
+        # All the times are handled as integer microseconds (from midnight of
+        # the MR start day), rounded in the same way as the datetimes
+        mr_start_us = time2us(str(start_times[0]))
+        start_us = np.array([time2us(str(t)) for t in start_times],
+                            dtype=np.int64)
+        scan_duration = np.cumsum(np.diff(start_us) / 1e6)
+        mr_bins = mr_start_us + seconds2us(scan_duration)
+        mr_start_points = mr_bins[:-1] + seconds2us(
+            (np.diff(mr_bins) / 1e6) / 2)
 
         pet_st = (dt.datetime.strptime(pet_start_time, '%H%M%S.%f') +
                   dt.timedelta(seconds=pet_offset))
-        PetBins = [pet_st+dt.timedelta(seconds=x) for x in
-                   range(0, pet_len, bin_len)]
-        MrBins = [MR_start_time+dt.timedelta(seconds=x)
-                  for x in scan_duration]
-        MrStartPoints = [MrBins[i]+dt.timedelta(
-            seconds=(MrBins[i+1]-MrBins[i]).total_seconds()/2) for i in
-                         range(len(MrBins)-1)]
-
-        indxs = []
-        PetBins.append(pet_st+dt.timedelta(seconds=pet_len))
+        pet_st_us = time2us(pet_st.strftime('%H%M%S.%f')) + (
+            pet_st.toordinal() - dt.datetime(1900, 1, 1).toordinal()
+        ) * 86400000000
+        pet_bins = pet_st_us + np.append(
+            np.arange(0, pet_len, bin_len), pet_len).astype(np.int64) * 1000000
+
         if pet_offset != 0:
             print(('PET start time offset of {0} seconds detected. '
                    'Fixed binning will start at {2} and will last '
                    'for {1} seconds.'.format(str(pet_offset), str(pet_len),
                                              pet_st.strftime('%H%M%S.%f'))))
-        for pet_bin in PetBins:
-
-            for i in range(len(MrStartPoints)-1):
-                if (pet_bin > MrStartPoints[i] and
-                        pet_bin < MrStartPoints[i+1]):
-                    MrDiff = (
-                        (MrStartPoints[i+1]-MrStartPoints[i]).total_seconds())
-                    w0 = (MrStartPoints[i+1]-pet_bin).total_seconds()/MrDiff
-                    w1 = (pet_bin-MrStartPoints[i]).total_seconds()/MrDiff
-                    indxs.append([[w0, i], [w1, i+1]])
-                    break
-                elif pet_bin < MrStartPoints[i]:
-                    indxs.append([[1, i], [0, i+1]])
-                    break
-        while len(indxs) < len(PetBins):
-            indxs.append([[0, len(MrStartPoints)-2],
-                          [1, len(MrStartPoints)-1]])
-        z = 0
-        for ii in range(len(indxs)-1):
-            start = indxs[ii]
-            end = indxs[ii+1]
-            s1 = start[0][1]
-            e1 = start[1][1]
-            s2 = end[0][1]
-            e2 = end[1][1]
+        indxs, weights = self.locate_bins(pet_bins, mr_start_points)
+
+        motion_mats = np.stack([load_array(m) for m in motion_mats])
+        # Interpolated motion matrix at each bin boundary
+        bin_mats = (weights[:, 0, None, None] * motion_mats[indxs[:, 0]] +
+                    weights[:, 1, None, None] * motion_mats[indxs[:, 1]])
+        for z in range(len(indxs)-1):
+            s1, e1 = indxs[z]
+            s2, e2 = indxs[z+1]
             if s1 == s2 and e1 == e2:
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                av_mat = start[0][0]*mat_s1 + start[1][0]*mat_e1
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'.format(str(z).zfill(3)),
-                    av_mat)
-                z = z+1
+                av_mat = bin_mats[z]
             elif (s1+1 == s2 and e1+1 == e2) or (s1+2 == s2 and e1+2 == e2):
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                mat_s2 = np.loadtxt(motion_mats[s2])
-                mat_e2 = np.loadtxt(motion_mats[e2])
-                av_mat_1 = start[0][0]*mat_s1 + start[1][0]*mat_e1
-                av_mat_2 = end[0][0]*mat_s2 + end[1][0]*mat_e2
-                mean_mat = (av_mat_1 + av_mat_2)/2
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'.format(str(z).zfill(3)),
-                    mean_mat)
-                z = z+1
+                av_mat = (bin_mats[z] + bin_mats[z+1])/2
             else:
-                mat_tot = np.zeros((4, 4, (s2-s1)))
-                mat_s1 = np.loadtxt(motion_mats[s1])
-                mat_e1 = np.loadtxt(motion_mats[e1])
-                mat_s2 = np.loadtxt(motion_mats[s2])
-                mat_e2 = np.loadtxt(motion_mats[e2])
-                mat_tot[:, :, 0] = (
-                    start[0][0]*mat_s1 + start[1][0]*mat_e1)
-                mat_tot[:, :, -1] = (
-                    end[0][0]*mat_s2 + end[1][0]*mat_e2)
-                for i, m in enumerate(range(e1+1, s2)):
-                    mat_tot[:, :, i+1] = np.loadtxt(motion_mats[m])
-                mean_mat = np.mean(mat_tot, axis=2)
-                np.savetxt(
-                    'average_motion_mat_bin_{0}.txt'
-                    .format(str(z).zfill(3)), mean_mat)
-                z = z+1
+                # Kept in the same (4, 4, N) layout as the motion matrices
+                # were averaged before, so that the means are identical
+                mat_tot = np.concatenate(
+                    (bin_mats[z:z+1], motion_mats[e1+1:s2],
+                     bin_mats[z+1:z+2]))
+                av_mat = np.mean(np.ascontiguousarray(
+                    np.moveaxis(mat_tot, 0, -1)), axis=2)
+            save_array(
+                'average_motion_mat_bin_{0}'.format(str(z).zfill(3)),
+                av_mat, binary=self.inputs.binary, fmt='%.18e')
         os.mkdir('average_bin_mats')
-        files = glob.glob('*bin*.txt')
+        files = glob.glob('*bin*'+array_ext(self.inputs.binary))
         for f in files:
             shutil.move(f, 'average_bin_mats')
 
         return runtime
 
+    def locate_bins(self, pet_bins, mr_start_points):
+        """
+        Finds, for each PET bin boundary, the two MR volumes (start points)
+        it falls between and the interpolation weights of each of them. The
+        start points are assumed to be sorted
+
+        Returns
+        -------
+        indxs : np.ndarray (n_bins, 2)
+            Indices of the volumes before and after each bin boundary
+        weights : np.ndarray (n_bins, 2)
+            Weights of the two volumes
+        """
+        n_points = len(mr_start_points)
+        left = np.searchsorted(mr_start_points, pet_bins, side='left')
+        right = np.searchsorted(mr_start_points, pet_bins, side='right')
+        # Boundaries strictly between two start points are interpolated,
+        # the ones before (or on) a start point take the following one
+        interp = (left == right) & (left >= 1) & (left <= n_points - 1)
+        before = ~interp & (right <= n_points - 2)
+        first = np.where(interp, left - 1, right)
+        prev_pt = mr_start_points[np.clip(first, 0, n_points - 1)]
+        next_pt = mr_start_points[np.clip(first + 1, 0, n_points - 1)]
+        mr_diff = (next_pt - prev_pt) / 1e6
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w0 = np.where(interp, ((next_pt - pet_bins) / 1e6) / mr_diff, 1)
+            w1 = np.where(interp, ((pet_bins - prev_pt) / 1e6) / mr_diff, 0)
+        matched = interp | before
+        indxs = np.stack((first, first + 1), axis=1)[matched]
+        weights = np.stack((w0, w1), axis=1)[matched]
+        # Boundaries after the last start point are assigned to the last
+        # volume
+        n_after = len(pet_bins) - len(indxs)
+        indxs = np.concatenate(
+            (indxs, np.tile([n_points - 2, n_points - 1], (n_after, 1))))
+        weights = np.concatenate((weights, np.tile([0.0, 1.0], (n_after, 1))))
+        return indxs.astype(int), weights
+
     def _list_outputs(self):
         outputs = self._outputs().get()
 
@@ -1561,3 +1686,52 @@ class ReorientUmap(BaseInterface):
             os.getcwd()+'/*_reorient.*'))
 
         return outputs
+
+
+class MotionDataTextExportInputSpec(BaseInterfaceInputSpec):
+
+    in_files = traits.List(File(exists=True), desc='Binary (.npy or .npz) '
+                           'files produced by the motion detection pipeline.')
+    in_dir = Directory(exists=True, desc='Directory containing binary motion '
+                       'matrices, e.g. the frame_mean_transformation_mats.')
+
+
+class MotionDataTextExportOutputSpec(TraitedSpec):
+
+    out_files = traits.List(File(exists=True), desc='Text version of the '
+                            'input files.')
+    out_dir = Directory(desc='Directory with the text version of the '
+                        'matrices in in_dir.')
+
+
+class MotionDataTextExport(BaseInterface):
+    """Exports the binary outputs of the motion detection pipeline (saved
+    when binary=True) into the text files that were produced before binary
+    storage was available, e.g. for inspection or external tools."""
+
+    input_spec = MotionDataTextExportInputSpec
+    output_spec = MotionDataTextExportOutputSpec
+
+    def _run_interface(self, runtime):
+
+        self.out_files = []
+        if isdefined(self.inputs.in_files):
+            for f in self.inputs.in_files:
+                _, base, _ = split_filename(f)
+                self.out_files.append(export_text(
+                    f, os.path.abspath(base+'.txt')))
+        if isdefined(self.inputs.in_dir):
+            _, base, _ = split_filename(self.inputs.in_dir)
+            self.out_dir = os.path.abspath(base+'_txt')
+            export_text_dir(self.inputs.in_dir, self.out_dir)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+
+        outputs["out_files"] = self.out_files
+        if isdefined(self.inputs.in_dir):
+            outputs["out_dir"] = self.out_dir
+
+        return outputs
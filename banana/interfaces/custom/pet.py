@@ -5,45 +5,67 @@ import nibabel as nib
 import numpy as np
 from nipype.utils.filemanip import split_filename
 import os
+import logging
 import matplotlib.pyplot as plot
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
 import subprocess as sp
 from nipype.interfaces.base.traits_extension import Directory, isdefined
 import shutil
 import glob
+import itertools
 import pydicom
+import datetime as dt
 from nipype.interfaces import fsl
+from banana.utils.motion_io import (
+    load_array, list_mats, save_array, array_ext, save_timestamps)
+from banana.utils.resample import apply_fsl_xfm
+from banana.utils.header import mrtrix_transform, qform
+from banana.utils.chunked import (
+    nifti_header, save_chunks, crop_chunks, memmap_dataobj, load_masked)
+from banana.utils.dual_regression import dual_regression
+from banana.utils.decomposition import temporal_components, remove_components
+from banana.utils.listmode import (
+    frame_sinograms, native_to_stir, save_sinogram, ssrb, ssrb_num_bins,
+    NUM_BINS)
 
 
+logger = logging.getLogger('banana')
+
 list_mode_framing_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', 'resources', 'C_C++',
                  'ListModeFraming'))
-interfile_path = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), '..', 'resources', 'pet',
-                 'biograph_mmr_short_int.hs'))
 
 
 class PETdrInputSpec(BaseInterfaceInputSpec):
 
     volume = File(exists=True, desc='4D input for the dual regression',
                   mandatory=True)
-    regression_map = File(exists=True, desc='3D map to use for the spatial '
-                          'regression (first step of the dr)', mandatory=True)
+    regression_map = File(exists=True, desc='3D map, or 4D image with one map '
+                          'per volume (e.g. ICA components), to use for the '
+                          'spatial regression (first step of the dr)',
+                          mandatory=True)
+    mask = File(exists=True, desc='Brain mask. If given the regression and '
+                'the z-scoring are restricted to the voxels within it')
     threshold = traits.Float(desc='Threshold to be applied to the abs(reg_map)'
                              ' before regression (default zero)', default=0.0)
     binarize = traits.Bool(desc='If True, all the voxels greater than '
                            'threshold will be set to 1 (default False)',
                            default=False)
+    chunk_size = traits.Int(
+        20000, usedefault=True, desc='Number of voxels regressed at once')
 
 
 class PETdrOutputSpec(TraitedSpec):
 
     spatial_map = File(
         exists=True, desc='Nifti file containing result for the temporal '
-        'regression')
+        'regression (z-scored, one volume per regression map)')
     timecourse = File(
         exists=True, desc='Png file containing result for the spatial '
         'regression')
+    timecourses = File(
+        exists=True, desc='Text file with the time course of each regression '
+        'map (one column per map)')
 
 
 class PETdr(BaseInterface):
@@ -56,73 +78,78 @@ class PETdr(BaseInterface):
         mapname = self.inputs.regression_map
         th = self.inputs.threshold
         binarize = self.inputs.binarize
-        _, base, _ = split_filename(fname)
-        _, base_map, _ = split_filename(mapname)
+        base = self._gen_base()
 
         img = nib.load(fname)
-        data = np.array(img.get_data())
-        spatial_regressor = nib.load(mapname)
-        spatial_regressor = np.array(spatial_regressor.get_data())
-
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
-        mask = spatial_regressor.reshape(n_voxels, 1)
+        map_img = nib.load(mapname)
+        if isdefined(self.inputs.mask):
+            mask = np.asarray(nib.load(self.inputs.mask).dataobj) > 0
+        else:
+            mask = np.ones(img.shape[:3], dtype=bool)
+        # All the maps are regressed at once, restricted to the mask
+        data = load_masked(img, mask)
+        maps = load_masked(map_img, mask)
         if th and not binarize:
-            mask[np.abs(mask) < th] = 0
-            base = base+'_th_{}'.format(str(th))
+            maps[np.abs(maps) < th] = 0
         elif th and binarize:
-            mask[mask < th] = 0
-            mask[mask >= th] = 1
-            base = base+'_bin_th_{}'.format(str(th))
-        timecourse = np.dot(ts.T, mask)
-        sm = np.dot(ts, timecourse)
-        mean = np.mean(sm)
-        std = np.std(sm)
-        sm_zscore = (sm-mean)/std
-
-        im2save = nib.Nifti1Image(
-            sm_zscore.reshape(spatial_regressor.shape), affine=img.affine)
-        nib.save(
-            im2save, '{0}_{1}_GLM_fit_zscore.nii.gz'.format(base, base_map))
-
-        plot.plot(timecourse)
-        plot.savefig('{0}_{1}_timecourse.png'.format(base, base_map))
+            maps = (maps >= th).astype(np.float32)
+        timecourses, zmaps = dual_regression(
+            data, maps, chunk_size=self.inputs.chunk_size)
+
+        out_shape = mask.shape + map_img.shape[3:]
+        spatial_map = np.zeros(out_shape, dtype=np.float32)
+        spatial_map[mask] = zmaps.reshape((-1,) + out_shape[3:])
+        nib.save(nib.Nifti1Image(spatial_map, affine=img.affine),
+                 '{}_GLM_fit_zscore.nii.gz'.format(base))
+        np.savetxt('{}_timecourses.txt'.format(base), timecourses)
+
+        plot.plot(timecourses)
+        plot.savefig('{}_timecourse.png'.format(base))
         plot.close()
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        fname = self.inputs.volume
+        base = self._gen_base()
+        outputs["spatial_map"] = os.path.abspath(
+            '{}_GLM_fit_zscore.nii.gz'.format(base))
+        outputs["timecourse"] = os.path.abspath(
+            '{}_timecourse.png'.format(base))
+        outputs["timecourses"] = os.path.abspath(
+            '{}_timecourses.txt'.format(base))
+
+        return outputs
+
+    def _gen_base(self):
         th = self.inputs.threshold
         binarize = self.inputs.binarize
-        mapname = self.inputs.regression_map
-
-        _, base_map, _ = split_filename(mapname)
-        _, base, _ = split_filename(fname)
+        _, base, _ = split_filename(self.inputs.volume)
+        _, base_map, _ = split_filename(self.inputs.regression_map)
         if th and not binarize:
             base = base+'_th_{}'.format(str(th))
         elif th and binarize:
             base = base+'_bin_th_{}'.format(str(th))
-
-        outputs["spatial_map"] = os.path.abspath(
-            '{0}_{1}_GLM_fit_zscore.nii.gz'.format(base, base_map))
-        outputs["timecourse"] = os.path.abspath(
-            '{0}_{1}_timecourse.png'.format(base, base_map))
-
-        return outputs
+        return '{0}_{1}'.format(base, base_map)
 
 
 class GlobalTrendRemovalInputSpec(BaseInterfaceInputSpec):
 
     volume = File(exists=True, desc='4D input file',
                   mandatory=True)
+    mask = File(exists=True, desc='Brain mask. If given the components are '
+                'found and removed only within it')
+    n_components = traits.Int(
+        1, usedefault=True, desc='Number of leading temporal PCA components '
+        'removed')
+    chunk_size = traits.Int(
+        20000, usedefault=True, desc='Number of voxels processed at once')
 
 
 class GlobalTrendRemovalOutputSpec(TraitedSpec):
 
     detrended_file = File(
-        exists=True, desc='4D file with the first temporal PCA component'
+        exists=True, desc='4D file with the leading temporal PCA components'
         ' removed')
 
 
@@ -137,19 +164,28 @@ class GlobalTrendRemoval(BaseInterface):
         _, base, _ = split_filename(fname)
 
         img = nib.load(fname)
-        data = np.array(img.get_data())
-
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
-        pca = PCA(50)
-        pca.fit(ts)
-        baseline = np.reshape(
-            pca.components_[0, :], (len(pca.components_[0, :]), 1))
-        new_ts = ts.T-np.dot(baseline, np.dot(np.linalg.pinv(baseline), ts.T))
-        im2save = nib.Nifti1Image(
-            new_ts.T.reshape(data.shape), affine=img.affine)
-        nib.save(
-            im2save, '{}_baseline_removed.nii.gz'.format(base))
+        if isdefined(self.inputs.mask):
+            mask = np.asarray(nib.load(self.inputs.mask).dataobj) > 0
+        else:
+            mask = np.ones(img.shape[:3], dtype=bool)
+        ts = load_masked(img, mask)
+        components, _ = temporal_components(
+            ts, self.inputs.n_components, chunk_size=self.inputs.chunk_size)
+        remove_components(ts, components, chunk_size=self.inputs.chunk_size)
+
+        # The voxels outside the mask are copied frame by frame
+        dataobj = memmap_dataobj(img)
+
+        def frames():
+            for t in range(img.shape[3]):
+                frame = np.asarray(dataobj[..., t], dtype=np.float32)
+                frame[mask] = ts[:, t]
+                yield frame
+
+        save_chunks(frames(),
+                    nifti_header(img.shape, np.float32, img.affine,
+                                 xform_code='aligned'),
+                    '{}_baseline_removed.nii.gz'.format(base))
 
         return runtime
 
@@ -167,16 +203,36 @@ class GlobalTrendRemoval(BaseInterface):
 
 class SUVRCalculationInputSpec(BaseInterfaceInputSpec):
 
-    volume = File(exists=True, desc='3D input file',
-                  mandatory=True)
+    volume = File(exists=True, desc='3D input file', mandatory=True,
+                  xor=['volumes'])
+    volumes = traits.List(
+        File(exists=True), desc='3D input files (e.g. of many subjects in '
+        'the same space), all normalised with the same atlas loaded once',
+        mandatory=True, xor=['volume'])
     base_mask = File(exists=True, desc='3D baseline mask',
-                     mandatory=True)
+                     mandatory=True, xor=['atlas'])
+    atlas = File(exists=True, desc='3D label atlas', mandatory=True,
+                 xor=['base_mask'], requires=['reference_labels'])
+    reference_labels = traits.List(
+        traits.Either(traits.Int, traits.List(traits.Int)),
+        desc='Labels of the reference regions in the atlas. A list of labels '
+        'defines a region made of all of them (e.g. the whole cerebellum)')
+    reference_names = traits.List(
+        traits.Str, desc='Names of the reference regions, used in the names '
+        'of the SUVR files (defaults to their labels)')
 
 
 class SUVRCalculationOutputSpec(TraitedSpec):
 
     SUVR_file = File(
-        exists=True, desc='3D SUVR file')
+        exists=True, desc='3D SUVR file (of the first volume and reference '
+        'region)')
+    SUVR_files = traits.List(
+        File(exists=True), desc='3D SUVR files of each volume and reference '
+        'region (in the order of the volumes, then of the regions)')
+    reference_means = traits.List(
+        traits.List(traits.Float), desc='Mean uptake in each reference '
+        'region for each volume')
 
 
 class SUVRCalculation(BaseInterface):
@@ -186,35 +242,90 @@ class SUVRCalculation(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        fname = self.inputs.volume
-        maskname = self.inputs.base_mask
-        _, base, _ = split_filename(fname)
-
-        img = nib.load(fname)
-        data = np.array(img.get_data())
-        mask = nib.load(maskname)
-        mask = np.array(mask.get_data())
-
-        [x, y, z] = np.where(mask > 0)
-        ii = np.arange(x.shape[0])
-        mean_uptake = np.mean(data[x[ii], y[ii], z[ii]])
-        new_data = data / mean_uptake
-        im2save = nib.Nifti1Image(new_data, affine=img.affine)
-        nib.save(im2save, '{}_SUVR.nii.gz'.format(base))
+        if isdefined(self.inputs.atlas):
+            atlas = np.asarray(nib.load(self.inputs.atlas).dataobj)
+            labels = np.rint(atlas).astype(np.intp)
+            labels[labels < 0] = 0
+        else:
+            mask = np.asarray(nib.load(self.inputs.base_mask).dataobj)
+            labels = (mask > 0).astype(np.intp)
+        regions = self._regions()
+        counts = np.bincount(labels.ravel())
+        for region in regions:
+            if not sum(counts[l] for l in region if 0 <= l < len(counts)):
+                raise Exception(
+                    'Reference region with label(s) {} has no voxels in {}'
+                    .format(', '.join(str(l) for l in region),
+                            self.inputs.atlas if isdefined(self.inputs.atlas)
+                            else self.inputs.base_mask))
+        self._reference_means = []
+        for fname, suvr_fnames in zip(self._volumes(), self._gen_fnames()):
+            img = nib.load(fname)
+            data = img.get_fdata(dtype=np.float32)
+            if data.shape != labels.shape:
+                raise Exception(
+                    'Shape of {} ({}) does not match the one of the reference '
+                    'regions ({})'.format(fname, data.shape, labels.shape))
+            # The sum of the uptake in all the labels in a single pass
+            sums = np.bincount(labels.ravel(), weights=data.ravel(),
+                               minlength=len(counts))
+            means = [float(sums[r].sum() / counts[r].sum()) for r in regions]
+            self._reference_means.append(means)
+            suvr = np.empty_like(data)
+            for mean_uptake, suvr_fname in zip(means, suvr_fnames):
+                np.multiply(data, np.float32(1.0 / mean_uptake), out=suvr)
+                nib.save(nib.Nifti1Image(suvr, affine=img.affine), suvr_fname)
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        fname = self.inputs.volume
-
-        _, base, _ = split_filename(fname)
-
-        outputs["SUVR_file"] = os.path.abspath(
-            '{}_SUVR.nii.gz'.format(base))
+        fnames = [os.path.abspath(f) for fnames in self._gen_fnames()
+                  for f in fnames]
+        outputs["SUVR_file"] = fnames[0]
+        outputs["SUVR_files"] = fnames
+        if hasattr(self, '_reference_means'):
+            outputs["reference_means"] = self._reference_means
 
         return outputs
 
+    def _volumes(self):
+        if isdefined(self.inputs.volumes):
+            return self.inputs.volumes
+        return [self.inputs.volume]
+
+    def _regions(self):
+        "The list of labels of each reference region"
+        if not isdefined(self.inputs.atlas):
+            return [[1]]
+        return [[r] if isinstance(r, int) else list(r)
+                for r in self.inputs.reference_labels]
+
+    def _gen_fnames(self):
+        "The SUVR file names of each volume"
+        regions = self._regions()
+        if isdefined(self.inputs.reference_names):
+            names = self.inputs.reference_names
+            if len(names) != len(regions):
+                raise Exception(
+                    'Number of reference names ({}) does not match the number '
+                    'of reference regions ({})'.format(len(names),
+                                                       len(regions)))
+        else:
+            names = ['_'.join(str(l) for l in r) for r in regions]
+        if len(regions) == 1 and not isdefined(self.inputs.reference_names):
+            suffixes = ['SUVR']
+        else:
+            suffixes = ['{}_SUVR'.format(n) for n in names]
+        bases = [split_filename(f)[1] for f in self._volumes()]
+        fnames = []
+        for i, base in enumerate(bases):
+            if bases.count(base) > 1:
+                # Volumes with the same name (e.g. of different subjects)
+                base = '{}_{}'.format(base, i)
+            fnames.append(['{}_{}.nii.gz'.format(base, s) for s in suffixes])
+        return fnames
+
 
 class PrepareUnlistingInputsInputSpec(BaseInterfaceInputSpec):
 
@@ -308,10 +419,119 @@ class PETListModeUnlisting(BaseInterface):
         return outputs
 
 
+class PETListModeFramingInputSpec(BaseInterfaceInputSpec):
+
+    list_inputs = traits.List(
+        mandatory=True, desc='List containing the list-mode file, the '
+        'time_offset and the temporal frame length of each frame, as '
+        'generated by PrepareUnlistingInputs')
+    delays = traits.Bool(
+        False, usedefault=True, desc='If True, the sinogram of the delayed '
+        'events is saved after the one of the prompts in each file (as '
+        'ListModeFraming does with delays_flag=1). Ignored if ssrb is True, '
+        'as only the prompts are rebinned. Default is False.')
+    chunk_size = traits.Int(
+        2 ** 24, usedefault=True, desc='Number of list-mode words (events '
+        'and tags) decoded by each task.')
+    num_workers = traits.Int(
+        1, usedefault=True, desc='Number of chunks of list-mode data that '
+        'are decoded concurrently, each one by a separate process. Default '
+        'is 1 (serial).')
+    ssrb = traits.Bool(
+        False, usedefault=True, desc='If True, the sinograms are rebinned '
+        'in memory (as the SSRB interface does) and only the rebinned '
+        'sinograms of the prompts are saved. Default is False.')
+    num_segments_to_combine = traits.Int(
+        1, usedefault=True, desc='Number of segments combined by SSRB (if '
+        'ssrb is True).')
+    view_mash = traits.Int(
+        36, usedefault=True, desc='Number of views combined by SSRB (if ssrb '
+        'is True).')
+    do_ssrb_norm = traits.Bool(
+        False, usedefault=True, desc='If True (and ssrb is True), the '
+        'rebinned sinograms are divided by the number of sinogram bins '
+        'combined into each bin. Default is False.')
+
+
+class PETListModeFramingOutputSpec(TraitedSpec):
+
+    pet_sinograms = traits.List(File(exists=True),
+                                desc='unlisted sinogram of each frame.')
+
+
+class PETListModeFraming(BaseInterface):
+    """
+    Unlists all the frames generated by PrepareUnlistingInputs in a single
+    pass over the memory-mapped list-mode data, without the ListModeFraming
+    binary used by PETListModeUnlisting (see banana.utils.listmode). The
+    sinograms (span 11) are saved as signed short integers in the order of
+    the Interfile header used by SSRB or, if ssrb is True, rebinned before
+    being saved, so the unlisted sinograms are never written to disk
+    """
+
+    input_spec = PETListModeFramingInputSpec
+    output_spec = PETListModeFramingOutputSpec
+
+    def _run_interface(self, runtime):
+        self.sinograms = []
+        frames = {}
+        for file_path, start, frame_len in self.inputs.list_inputs:
+            frames.setdefault(file_path, []).append((start, frame_len))
+        for file_path, file_frames in frames.items():
+            sinograms = frame_sinograms(
+                file_path, [(st, st + fl) for st, fl in file_frames],
+                chunk_size=self.inputs.chunk_size,
+                num_workers=self.inputs.num_workers)
+            for (start, frame_len), (prompts, delays) in zip(file_frames,
+                                                             sinograms):
+                logger.info('Unlisting Frame {}'.format(str(start/frame_len)))
+                fname = 'Frame{}'.format(
+                    str(int(round(start / frame_len))).zfill(5))
+                if self.inputs.ssrb:
+                    # Only the prompts are rebinned, as SSRB does
+                    self.sinograms.append(save_sinogram(
+                        ssrb(native_to_stir(prompts),
+                             self.inputs.num_segments_to_combine,
+                             self.inputs.view_mash, self.inputs.do_ssrb_norm),
+                        os.path.abspath(fname + '_ssrb.s'), dtype='<f4'))
+                else:
+                    frame_data = [native_to_stir(prompts)]
+                    if self.inputs.delays:
+                        frame_data.append(native_to_stir(delays))
+                    self.sinograms.append(save_sinogram(
+                        np.concatenate(frame_data),
+                        os.path.abspath(fname + '.s')))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+
+        outputs["pet_sinograms"] = self.sinograms
+
+        return outputs
+
+
 class SSRBInputSpec(BaseInterfaceInputSpec):
 
     unlisted_sinogram = File(exists=True, desc='unlisted sinogram, output of '
                              'PETListModeUnlisting.')
+    unlisted_sinograms = traits.List(
+        File(exists=True), desc='unlisted sinograms of all the frames of an '
+        'unlisting run, which are rebinned in a single batch.')
+    num_segments_to_combine = traits.Int(
+        1, usedefault=True, desc='Number of segments combined into each '
+        'rebinned segment (odd). Default is 1.')
+    view_mash = traits.Int(
+        36, usedefault=True, desc='Number of views combined into one. '
+        'Default is 36.')
+    do_ssrb_norm = traits.Bool(
+        False, usedefault=True, desc='If True, the rebinned sinograms are '
+        'divided by the number of sinogram bins combined into each bin. '
+        'Default is False.')
+    batch_size = traits.Int(
+        8, usedefault=True, desc='Number of sinograms rebinned together, '
+        'which are held in memory at the same time. Default is 8.')
 
 
 class SSRBOutputSpec(TraitedSpec):
@@ -319,53 +539,56 @@ class SSRBOutputSpec(TraitedSpec):
     ssrb_sinogram = File(exists=True, desc='Sinogram compressed using SSRB '
                          'algorithm. This will be the input of the PCA method '
                          'for motion detection')
+    ssrb_sinograms = traits.List(
+        File(exists=True), desc='Sinograms compressed using SSRB of all the '
+        'unlisted_sinograms.')
 
 
 class SSRB(BaseInterface):
+    """
+    Single-slice rebinning of unlisted sinograms (span 11, in the order of
+    STIR's Interfile header), computed in memory on the memory-mapped
+    sinograms (see banana.utils.listmode.ssrb) instead of calling STIR's
+    SSRB. The sinograms are stacked and rebinned together in batches of
+    batch_size frames, and the rebinned sinograms are saved as float32
+    """
 
     input_spec = SSRBInputSpec
     output_spec = SSRBOutputSpec
 
     def _run_interface(self, runtime):
 
-        unlisted_sinogram = self.inputs.unlisted_sinogram
-        basename = unlisted_sinogram.split('.')[0]
-        new_ext = '.s'
-        new_name = basename+new_ext
-        os.rename(unlisted_sinogram, new_name)
-        self.gen_interfiles(new_name)
-        num_segs_to_combine = 1
-        view_mash = 36
-        do_ssrb_norm = 0
-        cmd = ('SSRB {0}_ssrb {0}.hs {1} {2} {3}'
-               .format(basename, num_segs_to_combine, view_mash, do_ssrb_norm))
-        sp.check_output(cmd, shell=True)
-        os.remove(basename+'.hs')
+        unlisted_sinograms = []
+        if isdefined(self.inputs.unlisted_sinogram):
+            unlisted_sinograms.append(self.inputs.unlisted_sinogram)
+        if isdefined(self.inputs.unlisted_sinograms):
+            unlisted_sinograms.extend(self.inputs.unlisted_sinograms)
+        self.ssrb_sinograms = []
+        batch_size = max(self.inputs.batch_size, 1)
+        for i in range(0, len(unlisted_sinograms), batch_size):
+            self.ssrb_sinograms.extend(
+                self.rebin(unlisted_sinograms[i:i + batch_size]))
 
         return runtime
 
-    def gen_interfiles(self, sinogram):
-
-        file_pre = sinogram.split('/')[-1].split('.')[0]
-        file_suf = '.hs'
-        print('New file name: ' + file_pre + file_suf)
-        with open(file_pre + file_suf, 'w') as new_file:
-            with open(interfile_path) as old_file:
-                for line in old_file:
-                    new_file.write(
-                        line.replace('name of data file := biograph_mmr.s\n',
-                                     'name of data file := ' +
-                                     sinogram.split('/')[-1]+'\n'))
-
-        new_file.close()
-        old_file.close()
+    def rebin(self, unlisted_sinograms):
+        # Only the prompts are rebinned if the delays are also stored
+        sinograms = np.stack([
+            np.memmap(s, dtype='<i2', mode='r')[:NUM_BINS]
+            for s in unlisted_sinograms])
+        rebinned = ssrb(sinograms, self.inputs.num_segments_to_combine,
+                        self.inputs.view_mash, self.inputs.do_ssrb_norm)
+        return [
+            save_sinogram(r, os.path.abspath(
+                os.path.basename(s).split('.')[0] + '_ssrb.s'), dtype='<f4')
+            for s, r in zip(unlisted_sinograms, rebinned)]
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        unlisted_sinogram = self.inputs.unlisted_sinogram
-        basename = unlisted_sinogram.split('.')[0]
 
-        outputs["ssrb_sinogram"] = basename+'_ssrb.s'
+        if isdefined(self.inputs.unlisted_sinogram):
+            outputs["ssrb_sinogram"] = self.ssrb_sinograms[0]
+        outputs["ssrb_sinograms"] = self.ssrb_sinograms
 
         return outputs
 
@@ -405,6 +628,175 @@ class MergeUnlistingOutputs(BaseInterface):
         return outputs
 
 
+class PETMotionDetectionInputSpec(BaseInterfaceInputSpec):
+
+    sinogram_folder = Directory(
+        exists=True, mandatory=True, desc='Directory with the SSRB sinogram '
+        'of each frame (*.s), as generated by MergeUnlistingOutputs. The '
+        'frames are sorted by file name.')
+    pet_start_time = traits.Str(mandatory=True, desc='PET start time.')
+    time_offset = traits.Float(
+        0, usedefault=True, desc='Time between the PET start time and the '
+        'start of the first frame (in seconds), as given to '
+        'PrepareUnlistingInputs.')
+    temporal_len = traits.Float(
+        mandatory=True, desc='Temporal duration, in seconds, of each frame.')
+    n_components = traits.Int(
+        3, usedefault=True, desc='Number of principal components saved in '
+        'the motion surrogate. The first one is used to detect motion.')
+    batch_size = traits.Int(
+        50, usedefault=True, desc='Number of frames loaded at once to fit '
+        'the incremental PCA.')
+    normalise = traits.Bool(
+        True, usedefault=True, desc='If True, each sinogram is divided by its '
+        'total number of counts before the PCA, so that the decay of the '
+        'count rate is not detected as motion. Default is True.')
+    motion_threshold = traits.Float(
+        5.0, usedefault=True, desc='Every time the change of the motion '
+        'surrogate between consecutive frames is greater than this value '
+        '(in robust standard deviations of these changes), a new frame will '
+        'be initialised. Default is 5.')
+    temporal_threshold = traits.Float(
+        30.0, usedefault=True, desc='Minimum temporal duration (in sec) of '
+        'each detected frame. Default is 30 sec.')
+    binary = traits.Bool(False, usedefault=True, desc='If True, the motion '
+                         'surrogate and the frame start times are saved as '
+                         '.npy files instead of text files.')
+    num_segments_to_combine = traits.Int(
+        1, usedefault=True, desc='Number of segments combined by SSRB when '
+        'the sinograms were rebinned, used to find the number of prompt bins '
+        'in each file (the delays saved after them are not used).')
+    view_mash = traits.Int(
+        36, usedefault=True, desc='Number of views combined by SSRB when the '
+        'sinograms were rebinned.')
+
+
+class PETMotionDetectionOutputSpec(TraitedSpec):
+
+    motion_surrogate = File(
+        exists=True, desc='Scores of the principal components of each '
+        'sinogram (frames x n_components).')
+    sinogram_start_times = File(
+        exists=True, desc='start time of each sinogram in real clock time.')
+    frame_start_times = File(exists=True, desc='start times of each of the '
+                             'detected frame in real clock time.')
+    timestamps_dir = Directory(desc='Directory with the timestamps for all'
+                               ' the detected frames')
+
+
+class PETMotionDetection(BaseInterface):
+    """
+    Data-driven motion detection on the SSRB sinograms of the PET list-mode
+    data. The principal components of the sinograms are fitted with an
+    incremental PCA, loading `batch_size` sinograms at a time, and the scores
+    of the first component are used as motion surrogate. Frames are started
+    where the surrogate changes abruptly, and their start times are saved in
+    the same format as MotionFraming so they can be combined with the motion
+    detected from the MR images
+    """
+
+    input_spec = PETMotionDetectionInputSpec
+    output_spec = PETMotionDetectionOutputSpec
+
+    def _run_interface(self, runtime):
+
+        sinograms = sorted(glob.glob(self.inputs.sinogram_folder+'/*.s'))
+        if not sinograms:
+            raise Exception('No sinograms found in {}'
+                            .format(self.inputs.sinogram_folder))
+        batches = np.array_split(
+            np.arange(len(sinograms)),
+            max(1, len(sinograms) // self.inputs.batch_size))
+        ipca = IncrementalPCA(
+            n_components=min(self.inputs.n_components, len(batches[-1])))
+        for batch in batches:
+            ipca.partial_fit(self.load_sinograms(sinograms, batch))
+        scores = np.concatenate([
+            ipca.transform(self.load_sinograms(sinograms, batch))
+            for batch in batches])
+
+        pet_st = dt.datetime.strptime(self.inputs.pet_start_time,
+                                      '%H%M%S.%f')
+        offsets = (self.inputs.time_offset +
+                   self.inputs.temporal_len * np.arange(len(sinograms) + 1))
+        start_times = [
+            (pet_st + dt.timedelta(seconds=float(o))).strftime('%H%M%S.%f')
+            for o in offsets]
+        boundaries = self.motion_boundaries(scores[:, 0], offsets)
+        save_array('pet_motion_surrogate', scores, binary=self.inputs.binary,
+                   fmt='%.18e')
+        save_array('sinogram_start_times', start_times[:-1],
+                   binary=self.inputs.binary)
+        frame_start_times = [start_times[i] for i in boundaries]
+        save_array('frame_start_times', frame_start_times,
+                   binary=self.inputs.binary)
+        save_timestamps(frame_start_times)
+
+        return runtime
+
+    def load_sinograms(self, sinograms, batch):
+        "Loads the prompts of a batch of sinograms"
+        num_bins = ssrb_num_bins(self.inputs.num_segments_to_combine,
+                                 self.inputs.view_mash)
+        for i in batch:
+            # Prompts only, or prompts followed by the delays
+            size = os.path.getsize(sinograms[i]) // 4
+            if size not in (num_bins, 2 * num_bins):
+                raise Exception(
+                    'Size of {} ({} bins) does not match the one of the '
+                    'sinograms rebinned with num_segments_to_combine={} and '
+                    'view_mash={} ({} bins)'.format(
+                        sinograms[i], size,
+                        self.inputs.num_segments_to_combine,
+                        self.inputs.view_mash, num_bins))
+        data = np.stack([np.fromfile(sinograms[i], dtype='<f4',
+                                     count=num_bins) for i in batch])
+        if self.inputs.normalise:
+            totals = data.sum(axis=1, keepdims=True)
+            data /= np.where(totals > 0, totals, 1)
+        return data
+
+    def motion_boundaries(self, surrogate, offsets):
+        """Returns the indices of the sinograms starting each frame (and the
+        number of sinograms), i.e. where the change of the surrogate is
+        greater than motion_threshold robust standard deviations. The
+        largest changes are taken first, discarding the ones that would
+        create frames shorter than temporal_threshold"""
+        changes = np.abs(np.diff(surrogate))
+        scale = np.median(np.abs(changes - np.median(changes))) * 1.4826
+        if not scale:
+            # Most changes are equal (e.g. a mostly constant surrogate), so
+            # the standard deviation is used instead
+            scale = np.std(changes)
+        if not scale:
+            return [0, len(surrogate)]
+        candidates = np.flatnonzero(
+            changes > self.inputs.motion_threshold * scale) + 1
+        boundaries = [0, len(surrogate)]
+        for i in candidates[np.argsort(-changes[candidates - 1],
+                                       kind='stable')]:
+            pos = np.searchsorted(boundaries, i)
+            if (offsets[i] - offsets[boundaries[pos - 1]] >=
+                    self.inputs.temporal_threshold and
+                    offsets[boundaries[pos]] - offsets[i] >=
+                    self.inputs.temporal_threshold):
+                boundaries.insert(pos, int(i))
+        return boundaries
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+
+        ext = array_ext(self.inputs.binary)
+        outputs["motion_surrogate"] = (
+            os.getcwd()+'/pet_motion_surrogate'+ext)
+        outputs["sinogram_start_times"] = (
+            os.getcwd()+'/sinogram_start_times'+ext)
+        outputs["frame_start_times"] = os.getcwd()+'/frame_start_times'+ext
+        outputs["timestamps_dir"] = os.getcwd()+'/timestamps'
+
+        return outputs
+
+
 class PreparePetDirInputSpec(BaseInterfaceInputSpec):
 
     pet_dir = Directory(exists=True, desc='Directory with the PET images to '
@@ -518,6 +910,9 @@ class PETFovCroppingInputSpec(BaseInterfaceInputSpec):
     y_size = traits.Int()
     z_min = traits.Int()
     z_size = traits.Int()
+    chunk_size = traits.Int(
+        1, usedefault=True, desc='Number of frames (or slices for 3D '
+        'images) read and written at once. Default is 1.')
 
 
 class PETFovCroppingOutputSpec(TraitedSpec):
@@ -547,20 +942,24 @@ class PETFovCropping(BaseInterface):
         new_affine[:3, -1] = (pet.affine[:3, -1]-np.multiply(
             pet.header.get_zooms()[:3], (x_min, y_min, z_min)) *
             np.sign(pet.affine[:3, -1]))
-        pet = pet.get_data()
-        if len(pet.shape) == 3:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size]
-        elif len(pet.shape) == 4:
-            pet_cropped = pet[x_min:x_min+x_size, y_min:y_min+y_size,
-                              z_min:z_min+z_size, :]
+        # Only the cropped box is read from disk (memory-mapped, or through
+        # the array proxy for compressed images), one chunk of frames (or
+        # slices for 3D images) at a time, and each chunk is written before
+        # the next one is read
+        slicer = (slice(x_min, x_min+x_size), slice(y_min, y_min+y_size),
+                  slice(z_min, z_min+z_size))
+        if len(pet.shape) == 4:
+            slicer += (slice(None),)
+        shape = tuple(len(range(*s.indices(n)))
+                      for s, n in zip(slicer, pet.shape))
+        chunks = crop_chunks(memmap_dataobj(pet), slicer,
+                             chunk_size=self.inputs.chunk_size)
+        first = next(chunks)
 #         cmd = 'fslroi {} ref_roi 100 130 100 130 20 100'.format(im)
 #         sp.check_output(cmd, shell=True)
 #         ref = nib.load(ref)
-        im2save = nib.Nifti1Image(pet_cropped, affine=new_affine)
-        im2save.set_qform(new_affine, code='scanner')
-        im2save.set_sform(new_affine, code='scanner')
-        nib.save(im2save, outname)
+        save_chunks(itertools.chain([first], chunks),
+                    nifti_header(shape, first.dtype, new_affine), outname)
 
         return runtime
 
@@ -606,8 +1005,7 @@ class CheckPetMCInputs(BaseInterface):
 
         dct = {}
         pet_data = sorted(glob.glob(self.inputs.pet_data+'/*.nii.gz'))
-        motion_mats = sorted(glob.glob(
-            self.inputs.motion_mats+'/*.txt'))
+        motion_mats = list_mats(self.inputs.motion_mats)
         reference = self.inputs.reference
         if isdefined(self.inputs.corr_factors):
             corr_factors = np.loadtxt(self.inputs.corr_factors).tolist()
@@ -648,18 +1046,9 @@ class CheckPetMCInputs(BaseInterface):
         return runtime
 
     def get_qform(self, image):
-
-        cmd = 'mrinfo {}'.format(image)
-        hd = (sp.check_output(cmd, shell=True)).decode('utf-8')
-        i = [n for n, el in enumerate(hd.split('\n')) if 'Transform' in el][0]
-        mat = []
-        for j in range(3):
-            if j+i == i:
-                mat.append([float(x) for x in hd.split('\n')[j+i].split()[1:]])
-            else:
-                mat.append([float(x) for x in hd.split('\n')[j+i].split()])
-        mat.append([0, 0, 0, 1])
-        return np.asarray(mat)
+        """Returns the transform reported by mrinfo, reading (and caching)
+        the header in-process unless the image can only be read by MRtrix"""
+        return mrtrix_transform(image)
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -682,12 +1071,25 @@ class PetImageMotionCorrectionInputSpec(BaseInterfaceInputSpec):
     corr_factor = traits.Float()
     pet2ref_mat = File(exists=True)
     structural2ref_regmat = File(default=None)
+    resampler = traits.Enum(
+        'flirt', 'scipy', usedefault=True, desc='Tool used to apply the '
+        'motion correction transformation. Either FLIRT (default) or an '
+        'in-process scipy.ndimage resampler (see banana.utils.resample).')
+    defer_correction = traits.Bool(
+        False, usedefault=True, desc='If True, the temporal correction factor'
+        ' is not applied to the images, which are returned as they are (i.e. '
+        'the input PET image for pet_no_mc_image), and it is passed to the '
+        'corr_factor output instead, so that it can be applied by '
+        'StaticPETImageGeneration while summing the frames.')
 
 
 class PetImageMotionCorrectionOutputSpec(TraitedSpec):
 
     pet_mc_image = File(desc='Motin corrected static PET results.')
     pet_no_mc_image = File(desc='Motin corrected static PET results.')
+    corr_factor = traits.Float(desc='Temporal correction factor still to be '
+                               'applied to the images (if defer_correction '
+                               'is True, 1.0 otherwise).')
 
 
 class PetImageMotionCorrection(BaseInterface):
@@ -697,7 +1099,7 @@ class PetImageMotionCorrection(BaseInterface):
 
     def _run_interface(self, runtime):
 
-        motion_mat = np.loadtxt(self.inputs.motion_mat)
+        motion_mat = load_array(self.inputs.motion_mat)
         structural_image = self.inputs.structural_image
         if isdefined(self.inputs.structural2ref_regmat):
             structural2ref_regmat = np.loadtxt(
@@ -723,27 +1125,54 @@ class PetImageMotionCorrection(BaseInterface):
         np.savetxt('transformation.mat', transformation_mat)
 
         if structural_image:
-            self.applyxfm(pet_image, structural_image, 'transformation.mat',
+            ref = structural_image
+        else:
+            ref = pet_image
+        if self.inputs.defer_correction:
+            self.applyxfm(pet_image, ref, 'transformation.mat',
                           outname+'_mc')
+        elif self.inputs.resampler == 'scipy':
+            # The resampled image is corrected before being saved once
+            mc_img = apply_fsl_xfm(self.image_path(pet_image),
+                                   self.image_path(ref), transformation_mat)
+            self.apply_temporal_correction(mc_img, corr_factor,
+                                           outname+'_mc_corr')
         else:
-            self.applyxfm(pet_image, pet_image, 'transformation.mat',
+            self.applyxfm(pet_image, ref, 'transformation.mat',
                           outname+'_mc')
-        self.apply_temporal_correction(outname+'_mc', corr_factor,
-                                       outname+'_mc_corr')
-        self.apply_temporal_correction(pet_image, corr_factor,
-                                       outname+'_no_mc_corr')
+            self.apply_temporal_correction(outname+'_mc', corr_factor,
+                                           outname+'_mc_corr')
+        if not self.inputs.defer_correction:
+            self.apply_temporal_correction(pet_image, corr_factor,
+                                           outname+'_no_mc_corr')
         self.out_basename = out_basename
+        self.outname = outname
 
         return runtime
 
+    def image_path(self, image):
+        "Images can be passed with or without the '.nii.gz' extension"
+        if not os.path.exists(image) and os.path.exists(image + '.nii.gz'):
+            image = image + '.nii.gz'
+        return image
+
     def apply_temporal_correction(self, image, corr_factor, out_name):
 
-        cmd = ('fslmaths {0}.nii.gz -mul {1} {2}'
-               .format(image, corr_factor, out_name))
-        sp.check_output(cmd, shell=True)
+        if not isinstance(image, nib.Nifti1Image):
+            image = nib.load(self.image_path(image))
+        data = image.get_fdata(dtype=np.float32) * np.float32(corr_factor)
+        header = image.header.copy()
+        header.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(data, image.affine, header),
+                 out_name + '.nii.gz')
 
     def applyxfm(self, in_file, ref, mat, outname):
 
+        if self.inputs.resampler == 'scipy':
+            nib.save(apply_fsl_xfm(self.image_path(in_file),
+                                   self.image_path(ref), mat),
+                     outname + '.nii.gz')
+            return
         applyxfm = fsl.FLIRT()
         applyxfm.inputs.in_file = in_file
         applyxfm.inputs.reference = ref
@@ -754,30 +1183,29 @@ class PetImageMotionCorrection(BaseInterface):
 
     def extract_qform(self, image):
 
-        cmd = 'fslhd {}'.format(image)
-        image_info = (sp.check_output(cmd, shell=True)).decode('utf-8')
-        image_info = image_info.strip().split('\n')
-        qform = np.eye(4)
-        for i, line in enumerate(image_info):
-            if 'qto_xyz:1' in line:
-                qform[0, -1] = abs(float(
-                    image_info[i].split(':1')[-1].strip().split()[-1]))
-                qform[1, -1] = abs(float(
-                    image_info[i+1].split(':2')[-1].strip().split()[-1]))
-                qform[2, -1] = abs(float(
-                    image_info[i+2].split(':3')[-1].strip().split()[-1]))
-                break
-
-        return qform
+        qform_trans = np.eye(4)
+        qform_trans[:3, -1] = np.abs(qform(image)[:3, -1])
+        return qform_trans
 
     def _list_outputs(self):
         outputs = self._outputs().get()
 
+        if self.inputs.defer_correction:
+            outputs["pet_mc_image"] = os.path.abspath(
+                self.outname + '_mc.nii.gz')
+            outputs["pet_no_mc_image"] = os.path.abspath(
+                self.image_path(self.inputs.pet_image))
+            if isdefined(self.inputs.corr_factor):
+                outputs["corr_factor"] = self.inputs.corr_factor
+            else:
+                outputs["corr_factor"] = 1.0
+            return outputs
         outputs["pet_mc_image"] = glob.glob(
             os.getcwd()+'/*{}_mc_corr.nii.gz'
             .format(self.out_basename))[0]
         outputs["pet_no_mc_image"] = glob.glob(
             os.getcwd()+'/*no_mc_corr.nii.gz')[0]
+        outputs["corr_factor"] = 1.0
         return outputs
 
 
@@ -785,6 +1213,11 @@ class StaticPETImageGenerationInputSpec(BaseInterfaceInputSpec):
 
     pet_mc_images = traits.List()
     pet_no_mc_images = traits.List()
+    corr_factors = traits.List(
+        traits.Float(), desc='Temporal correction factor of each frame, '
+        'which is applied while summing the frames. Only needed if the '
+        'images have not been corrected yet (i.e. PetImageMotionCorrection '
+        'was run with defer_correction).')
 
 
 class StaticPETImageGenerationOutputSpec(TraitedSpec):
@@ -802,21 +1235,49 @@ class StaticPETImageGeneration(BaseInterface):
 
         pet_mc_images = self.inputs.pet_mc_images
         pet_no_mc_images = self.inputs.pet_no_mc_images
+        if isdefined(self.inputs.corr_factors):
+            corr_factors = self.inputs.corr_factors
+        else:
+            corr_factors = [1.0] * len(pet_mc_images)
+        if not (len(pet_mc_images) == len(pet_no_mc_images) ==
+                len(corr_factors)):
+            raise Exception(
+                'Different number of motion corrected ({}) and not motion '
+                'corrected ({}) frames and correction factors ({}) provided.'
+                .format(len(pet_mc_images), len(pet_no_mc_images),
+                        len(corr_factors)))
 
-        self.frames_sum('mc_corr', pet_mc_images)
-        self.frames_sum('no_mc_corr', pet_no_mc_images)
+        self.frames_sum(
+            zip(pet_mc_images, pet_no_mc_images, corr_factors),
+            ('mc_corr', 'no_mc_corr'))
 
         return runtime
 
-    def frames_sum(self, outname, images):
-
-        cmd = 'fslmaths '
-        for i, frame in enumerate(images):
-            if i != len(images)-1:
-                cmd = cmd + '{0} -add '.format(frame)
-            else:
-                cmd = (cmd+'{0} static_PET_{1}'.format(frame, outname))
-        sp.check_output(cmd, shell=True)
+    def frames_sum(self, frames, outnames):
+        """Sums the (corrected) frames of each series, loading each frame
+        once and accumulating them in float32 buffers, so that all the
+        static images are generated in a single pass"""
+        sums = None
+        for frame in frames:
+            images = [nib.load(f) for f in frame[:-1]]
+            corr_factor = np.float32(frame[-1])
+            if sums is None:
+                ref_images = images
+                sums = [np.zeros(img.shape, dtype=np.float32)
+                        for img in images]
+            for img, frame_sum in zip(images, sums):
+                data = img.get_fdata(dtype=np.float32)
+                if corr_factor != 1:
+                    data *= corr_factor
+                frame_sum += data
+        if sums is None:
+            raise Exception('No PET frames provided to generate the static '
+                            'images.')
+        for img, frame_sum, outname in zip(ref_images, sums, outnames):
+            header = img.header.copy()
+            header.set_data_dtype(np.float32)
+            nib.save(nib.Nifti1Image(frame_sum, img.affine, header),
+                     'static_PET_{}.nii.gz'.format(outname))
 
     def _list_outputs(self):
         outputs = self._outputs().get()
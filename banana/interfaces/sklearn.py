@@ -1,21 +1,41 @@
-
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
                                     traits, File, TraitedSpec)
+from nipype.interfaces.base.traits_extension import isdefined
+import logging
 import nibabel as nib
 import numpy as np
 from sklearn.decomposition import FastICA as fICA
 from nipype.utils.filemanip import split_filename
 import os
+from banana.utils.chunked import load_masked
+from banana.utils.decomposition import (
+    reduce_frames, reduce_voxels, project_voxels)
+
+logger = logging.getLogger('banana')
 
 
 class FastICAInputSpec(BaseInterfaceInputSpec):
 
     volume = File(exists=True, desc='4D file to be decomposed using ICA',
-                  mandatory=True)
+                  mandatory=True, xor=['volumes'])
+    volumes = traits.List(
+        File(exists=True), desc='4D files of several runs (in the same '
+        'space) concatenated in time and decomposed together (group ICA)',
+        mandatory=True, xor=['volume'])
+    mask = File(exists=True, desc='Brain mask. If given only the voxels '
+                'within it are decomposed')
     n_components = traits.Int(desc='Number of ICA components to extract',
                               mandatory=True)
+    n_pca_components = traits.Int(
+        desc='Number of principal components the data are reduced to before '
+        'the ICA (defaults to n_components)')
     ica_type = traits.Str(desc='Type of ICA to run. Possible types are '
                           'spatial (default) and temporal.', default='spatial')
+    chunk_size = traits.Int(
+        20000, usedefault=True, desc='Number of voxels processed at once')
+    random_state = traits.Int(
+        desc='Seed of the random initialisation of the ICA, so that the '
+        'decomposition is reproducible (random by default)')
 
 
 class FastICAOutputSpec(TraitedSpec):
@@ -33,62 +53,69 @@ class FastICA(BaseInterface):
     output_spec = FastICAOutputSpec
 
     def _run_interface(self, runtime):
-        fname = self.inputs.volume
-        img = nib.load(fname)
+        fnames = self._volumes()
+        img = nib.load(fnames[0])
         comp = self.inputs.n_components
-        data = np.array(img.get_data())
-
-        n_voxels = data.shape[0]*data.shape[1]*data.shape[2]
-        ts = data.reshape(n_voxels, data.shape[3])
-        _, base, _ = split_filename(fname)
-
-        if self.inputs.ica_type == 'spatial':
-            ica_input = ts.T
-            outname = 'sICA'
+        if isdefined(self.inputs.n_pca_components):
+            rank = self.inputs.n_pca_components
         else:
-            ica_input = ts
-            outname = 'tICA'
-
-        # Run ICA
-        ica = fICA(n_components=comp)
-        ica.fit(ica_input)
-        S_ = ica.fit_transform(ica_input)
+            rank = comp
+        if isdefined(self.inputs.mask):
+            mask = np.asarray(nib.load(self.inputs.mask).dataobj) > 0
+        else:
+            mask = np.ones(img.shape[:3], dtype=bool)
+        # Runs are concatenated in time
+        ts = np.concatenate(
+            [load_masked(nib.load(f), mask) for f in fnames], axis=1)
+        n_voxels = ts.shape[0]
+        base, outname = self._gen_base()
+
+        # Run ICA (once) on the data reduced to their leading principal
+        # components, and express the components in the original space
+        if isdefined(self.inputs.random_state):
+            random_state = self.inputs.random_state
+        else:
+            random_state = None
+        ica = fICA(n_components=comp, random_state=random_state)
         if self.inputs.ica_type == 'spatial':
-            sm = ica.components_.T[:]
-            tc = S_[:]
+            reduced, weights = reduce_voxels(
+                ts, rank, chunk_size=self.inputs.chunk_size)
+            S_ = ica.fit_transform(reduced)
+            tc = S_
+            sm = project_voxels(ts, np.dot(weights, ica.components_.T),
+                                chunk_size=self.inputs.chunk_size)
         else:
-            sm = S_[:]
-            tc = ica.components_.T[:]
-
-        ica_zscore = np.zeros((data.shape[0], data.shape[1],
-                               data.shape[2], self.inputs.n_components))
-        ica_tc = np.zeros((data.shape[3], self.inputs.n_components))
-        for i in range(self.inputs.n_components):
-            dt = sm[:, i]-np.mean(sm[:, i])
-            num = np.mean(dt**3)
-            denom = (np.mean(dt**2))**1.5
-            s = num / denom
-            print(s)
-            if np.sign(s) == -1:
-                print('Flipping sign of component {}'.format(str(i)))
-                sm[:, i] = -1*sm[:, i]
-                tc[:, i] = -1*tc[:, i]
-
-            pc = sm[:, i].reshape(
-                data.shape[0], data.shape[1], data.shape[2])
-
-            vstd = np.linalg.norm(sm[:, i])/np.sqrt(n_voxels-1)
-            if vstd != 0:
-                pc_zscore = pc/vstd
-            else:
-                print ('Not converting to z-scores as division by zero'
-                       ' warning may occur.')
-                pc_zscore = pc
-            ica_zscore[:, :, :, i] = pc_zscore
-            ica_tc[:, i] = tc[:, i]
+            reduced, components = reduce_frames(
+                ts, rank, chunk_size=self.inputs.chunk_size)
+            S_ = ica.fit_transform(reduced)
+            sm = S_
+            tc = np.dot(components.T, ica.components_.T)
+        del ts, reduced
+
+        # Flip the components with negative skewness
+        dt = sm - sm.mean(axis=0)
+        skew = (np.mean(dt ** 3, axis=0) /
+                np.mean(dt ** 2, axis=0) ** 1.5)
+        del dt
+        flip = np.sign(skew) == -1
+        if flip.any():
+            logger.info('Flipping sign of components {}'.format(
+                ', '.join(str(i) for i in np.flatnonzero(flip))))
+        sm[:, flip] *= -1
+        tc[:, flip] *= -1
+
+        vstd = np.linalg.norm(sm, axis=0) / np.sqrt(n_voxels - 1)
+        if not vstd.all():
+            logger.warning('Not converting components {} to z-scores as '
+                           'division by zero warning may occur.'.format(
+                               ', '.join(str(i) for i in
+                                         np.flatnonzero(vstd == 0))))
+        vstd[vstd == 0] = 1
+        ica_zscore = np.zeros(mask.shape + (comp,), dtype=np.float32)
+        ica_zscore[mask] = sm / vstd.astype(np.float32)
 
         im2save = nib.Nifti1Image(ica_zscore, affine=img.affine)
-        tc2save = nib.Nifti1Image(ica_tc, affine=np.eye(4))
+        tc2save = nib.Nifti1Image(tc, affine=np.eye(4))
         nib.save(
             im2save, '{0}_{1}_results_pc{2}_zscore.nii.gz'
             .format(base, outname, str(self.inputs.n_components)))
@@ -103,12 +130,7 @@ class FastICA(BaseInterface):
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        fname = self.inputs.volume
-        if self.inputs.ica_type == 'spatial':
-            outname = 'sICA'
-        else:
-            outname = 'tICA'
-        _, base, _ = split_filename(fname)
+        base, outname = self._gen_base()
         outputs["ica_decomposition"] = os.path.abspath(
             base+'_{0}_results_pc{1}_zscore.nii.gz'.format(
                 outname, str(self.inputs.n_components)))
@@ -120,3 +142,16 @@ class FastICA(BaseInterface):
                 outname, str(self.inputs.n_components)))
 
         return outputs
+
+    def _volumes(self):
+        if isdefined(self.inputs.volumes):
+            return self.inputs.volumes
+        return [self.inputs.volume]
+
+    def _gen_base(self):
+        if self.inputs.ica_type == 'spatial':
+            outname = 'sICA'
+        else:
+            outname = 'tICA'
+        _, base, _ = split_filename(self._volumes()[0])
+        return base, outname
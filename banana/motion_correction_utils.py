@@ -1,10 +1,11 @@
 import os.path
-import pydicom
 import glob
 import shutil
 import errno
 import subprocess as sp
 from banana.interfaces.custom.dicom import DicomHeaderInfoExtraction
+from banana.utils.dicom_series import index_series, link_file, link_tree
+from banana.utils.header_index import HeaderIndex
 import numpy as np
 import re
 import datetime as dt
@@ -21,8 +22,27 @@ PHASE_IMAGE_TYPE = ['ORIGINAL', 'PRIMARY', 'P', 'ND']
 #     return avail_scans
 
 
+def session_index_path(input_dir):
+    """Path of the header index of the session (see
+    banana.utils.header_index.HeaderIndex), in its working directory"""
+    return os.path.join(input_dir, 'work_dir', 'header_index.sqlite')
+
+
 def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
-                           struct2align=None):
+                           struct2align=None, link='hard', num_workers=None,
+                           header_index=None):
+    """
+    Sets up the working directory for the motion detection, splitting the
+    DICOM files in `input_dir` into one directory per series (or linking the
+    existing series directories). The input files are linked (see
+    banana.utils.dicom_series.link_file) rather than copied, so the working
+    directory does not take additional disk space unless link is 'copy'.
+    The header fields used by the motion detection, including the ones
+    identifying the series, are read once, using `num_workers` processes
+    (defaults to the number of CPUs), into the session header index (see
+    banana.utils.header_index.HeaderIndex), stored in `header_index` or, by
+    default, in the working directory (see `session_index_path`)
+    """
 
     scan_description = []
     dcm_files = sorted(glob.glob(input_dir+'/*.dcm'))
@@ -52,48 +72,36 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
                    'previous process failed. Trying to restart it.')
             working_dir = input_dir+'/work_dir/work_sub_dir/work_session_dir/'
             copy = False
+    if header_index is None:
+        header_index = session_index_path(input_dir)
+    index = HeaderIndex(header_index)
     if dcm:
-        hdr = pydicom.read_file(dcm_files[0])
-        name_scan = (
-            str(hdr.SeriesNumber).zfill(2)+'_'+hdr.SeriesDescription)
-        name_scan = name_scan.replace(" ", "_")
-        scan_description = [name_scan]
-        files = []
-        for i, im in enumerate(dcm_files):
-            hdr = pydicom.read_file(im)
-            name_scan = (
-                str(hdr.SeriesNumber).zfill(2)+'_'+hdr.SeriesDescription)
-            name_scan = name_scan.replace(" ", "_")
-            if name_scan in scan_description[-1]:
-                files.append(im)
-            elif name_scan not in scan_description[-1] and copy:
-                if (os.path.isdir(
-                        working_dir+scan_description[-1]) is False):
-                    os.mkdir(working_dir+scan_description[-1])
-                    for f in files:
-                        shutil.copy(f, working_dir+scan_description[-1])
-                files = [im]
-                scan_description.append(name_scan)
-            elif name_scan not in scan_description[-1] and not copy:
-                files = [im]
-                scan_description.append(name_scan)
-            if i == len(dcm_files)-1 and copy:
-                if (os.path.isdir(working_dir+scan_description[-1]) is
-                        False):
-                    os.mkdir(working_dir+scan_description[-1])
+        series = index_series(dcm_files, num_workers=num_workers,
+                              index=index)
+        scan_description = list(series)
+        if copy:
+            for name, files in series.items():
+                if os.path.isdir(working_dir+name) is False:
+                    os.mkdir(working_dir+name)
                     for f in files:
-                        shutil.copy(f, working_dir+scan_description[-1])
+                        link_file(f, working_dir+name, link=link)
     elif not dcm and copy:
         for s in scan_description:
-            shutil.copytree(input_dir+s, working_dir+'/'+s)
+            link_tree(input_dir+s, working_dir+'/'+s, link=link)
         if pet_dir is not None:
-            shutil.copytree(pet_dir, working_dir+'/pet_data_dir')
+            link_tree(pet_dir, working_dir+'/pet_data_dir', link=link)
         if pet_recon is not None:
-            shutil.copytree(pet_recon, working_dir+'/pet_data_reconstructed')
+            link_tree(pet_recon, working_dir+'/pet_data_reconstructed',
+                      link=link)
         if struct2align is not None:
-            shutil.copy2(struct2align, working_dir+'/')
-
-    phase_image_type, no_dicom = check_image_type(input_dir, scan_description)
+            link_file(struct2align, working_dir+'/', link=link)
+    if not dcm:
+        index.update([f for s in scan_description
+                      for f in sorted(glob.glob(input_dir+s+'/*'))
+                      if os.path.isfile(f)], num_workers=num_workers)
+
+    phase_image_type, no_dicom = check_image_type(input_dir, scan_description,
+                                                  index=index)
     if no_dicom:
         print(('No DICOM files could be found in the following folders '
                'For this reason they will be removed from the analysis.\n{}'
@@ -106,7 +114,8 @@ def local_motion_detection(input_dir, pet_dir=None, pet_recon=None,
                .format('\n'.join(x for x in phase_image_type))))
         scan_description = [x for x in scan_description
                             if x not in phase_image_type]
-    same_start_time = check_image_start_time(input_dir, scan_description)
+    same_start_time = check_image_start_time(input_dir, scan_description,
+                                             header_index=header_index)
     if same_start_time:
         print(('The following scans were found to have the same start time '
                'as other scans provided. For this reason they will be removed'
@@ -201,7 +210,7 @@ def inputs_generation(scan_description, input_dir, siemens=False):
         return ref, ref_type, t1s, epis, t2s, dmris, utes, umaps
 
 
-def guess_scan_type(scans, input_dir):
+def guess_scan_type(scans, input_dir, index=None):
 
     ref = None
     ref_type = None
@@ -211,6 +220,8 @@ def guess_scan_type(scans, input_dir):
     dwi_scans = []
     res_t1 = []
     res_t2 = []
+    if index is None:
+        index = HeaderIndex()
 
     for scan in scans:
         sequence_name = None
@@ -219,17 +230,14 @@ def guess_scan_type(scans, input_dir):
             dcm_files = sorted(glob.glob(input_dir+'/'+scan+'/*.IMA'))
         if not dcm_files:
             continue
-        dicom = dcm_files[0]
-        hd = pydicom.read_file(dicom)
-        with open(dcm_files[0], 'rb') as f:
-            for line in f:
-                try:
-                    line = line[:-1].decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                if 'tSequenceFileName' in line:
-                    sequence_name = line.strip().split('\\')[-1].split('"')[0]
-                    break
+        hd = index[dcm_files[0]]
+        if hd is None:
+            print(('{} is not a DICOM file. Scan {} will be ignored.'
+                   .format(dcm_files[0], scan)))
+            continue
+        sequence_file = hd['protocol'].get('tSequenceFileName')
+        if sequence_file is not None:
+            sequence_name = sequence_file.split('\\')[-1].split('"')[0]
 
         if sequence_name is not None:
             if (('tfl' in sequence_name or
@@ -237,7 +245,7 @@ def guess_scan_type(scans, input_dir):
                     (re.match('.*(t1|T1).*', scan) or
                      re.match('.*(ute|UTE).*', scan))):
                 t1s.append(scan)
-                res_t1.append([scan, float(hd.PixelSpacing[0])])
+                res_t1.append([scan, float(hd['PixelSpacing'][0])])
             elif 'bold' in sequence_name or 'asl' in sequence_name:
                 epis.append(scan)
             elif 'diff' in sequence_name:
@@ -245,8 +253,9 @@ def guess_scan_type(scans, input_dir):
             else:
                 t2s.append(scan)
                 if 'gre' not in sequence_name:
-                    res_t2.append([scan, float(hd.PixelSpacing[0])])
-    dmris, unused_b0 = dwi_type_assignment(input_dir, dwi_scans)
+                    res_t2.append([scan, float(hd['PixelSpacing'][0])])
+    dmris, unused_b0 = dwi_type_assignment(input_dir, dwi_scans,
+                                           header_index=index.path)
     if unused_b0:
         print(('The following b0 images have different phase encoding '
                'direction respect to the main diffusion and/or the ped '
@@ -332,7 +341,7 @@ def guess_scan_type(scans, input_dir):
     return inputs
 
 
-def dwi_type_assignment(input_dir, dmri_images):
+def dwi_type_assignment(input_dir, dmri_images, header_index=None):
 
     main_dwi = []
     b0 = []
@@ -349,6 +358,8 @@ def dwi_type_assignment(input_dir, dmri_images):
                 break
         hd_extraction = DicomHeaderInfoExtraction()
         hd_extraction.inputs.dicom_folder = input_dir+'/'+dwi
+        if header_index is not None:
+            hd_extraction.inputs.header_index = header_index
         dcm_info = hd_extraction.run()
 
         if dcm_info.outputs.pe_angle and dcm_info.outputs.ped:
@@ -393,10 +404,12 @@ def dwi_type_assignment(input_dir, dmri_images):
     return dmris, unused_b0
 
 
-def check_image_type(input_dir, scans):
+def check_image_type(input_dir, scans, index=None):
 
     toremove = []
     nodicom = []
+    if index is None:
+        index = HeaderIndex()
     for scan in scans:
         dcm_file = None
         try:
@@ -407,10 +420,11 @@ def check_image_type(input_dir, scans):
                     input_dir+'/'+scan+'/*.IMA'))[0]
             except IndexError:
                 nodicom.append(scan)
-        if dcm_file is not None:
+        if dcm_file is not None and index[dcm_file] is None:
+            nodicom.append(scan)
+        elif dcm_file is not None:
             try:
-                hd = pydicom.read_file(dcm_file)
-                im_type = hd['0008', '0008'].value
+                im_type = index[dcm_file]['ImageType']
                 if im_type == PHASE_IMAGE_TYPE:
                     toremove.append(scan)
             except:
@@ -420,7 +434,7 @@ def check_image_type(input_dir, scans):
     return toremove, nodicom
 
 
-def check_image_start_time(input_dir, scans):
+def check_image_start_time(input_dir, scans, header_index=None):
 
     start_times = []
     toremove = []
@@ -429,6 +443,8 @@ def check_image_start_time(input_dir, scans):
             scan_number = scan.split('-')[0].zfill(3)
             hd_extraction = DicomHeaderInfoExtraction()
             hd_extraction.inputs.dicom_folder = input_dir+'/'+scan
+            if header_index is not None:
+                hd_extraction.inputs.header_index = header_index
             dcm_info = hd_extraction.run()
             start_times.append([dcm_info.outputs.start_time, scan_number,
                                 scan])
@@ -0,0 +1,235 @@
+import io
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
+
+
+class ScaledMemmap(object):
+    """Memory-mapped data of an uncompressed image that is scaled (as the
+    array proxy of the image does) when it is sliced"""
+
+    def __init__(self, raw, slope, inter):
+        self.raw = raw
+        self.slope = slope
+        self.inter = inter
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    def __getitem__(self, slicer):
+        return apply_read_scaling(np.array(self.raw[slicer]), self.slope,
+                                  self.inter)
+
+
+def memmap_dataobj(img):
+    """
+    Returns the data of an image so that it can be sliced as img.dataobj
+    without reading the rest of the image. The data of uncompressed images is
+    memory-mapped, as slicing the array proxy reads each contiguous run of
+    voxels separately, while the array proxy is returned for compressed
+    images
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        The image (loaded from file)
+
+    Returns
+    -------
+    dataobj : ScaledMemmap | nib.arrayproxy.ArrayProxy
+        The sliceable data of the image
+    """
+    proxy = img.dataobj
+    file_like = getattr(proxy, 'file_like', None)
+    if not isinstance(file_like, str) or not file_like.endswith('.nii'):
+        return proxy
+    raw = proxy.get_unscaled()
+    if not isinstance(raw, np.memmap):
+        return proxy
+    return ScaledMemmap(raw, proxy.slope, proxy.inter)
+
+
+def nifti_header(shape, dtype, affine, xform_code='scanner'):
+    """
+    Returns the header nibabel would write for a NIfTI-1 image with the
+    given shape, data type and affine (set as both qform and sform), without
+    creating the data array
+
+    Parameters
+    ----------
+    shape : tuple(int)
+        Shape of the image
+    dtype : np.dtype
+        Data type of the image
+    affine : np.ndarray (4, 4)
+        Voxel to world transform
+    xform_code : str
+        Code of the qform and sform
+
+    Returns
+    -------
+    header : nib.Nifti1Header
+        The header
+    """
+    img = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                          affine=affine)
+    img.set_qform(affine, code=xform_code)
+    img.set_sform(affine, code=xform_code)
+    bio = io.BytesIO()
+    img.to_file_map({'image': nib.FileHolder(fileobj=bio),
+                     'header': nib.FileHolder(fileobj=bio)})
+    header = nib.Nifti1Header.from_fileobj(io.BytesIO(bio.getvalue()))
+    header.set_data_shape(shape)
+    return header
+
+
+def save_chunks(chunks, header, fname):
+    """
+    Saves a NIfTI-1 image chunk by chunk, so that the whole data array is
+    never held in memory. The chunks must split the image along its last
+    axis (e.g. the frames of a 4D series or slabs of slices of a 3D volume)
+    so that, in the Fortran order of the NIfTI data, each chunk follows the
+    previous one
+
+    Parameters
+    ----------
+    chunks : iterable(np.ndarray)
+        The consecutive chunks of the image along its last axis
+    header : nib.Nifti1Header
+        Header of the image (see `nifti_header`)
+    fname : str
+        Path of the image (.nii or .nii.gz)
+
+    Returns
+    -------
+    fname : str
+        Path of the image
+    """
+    dtype = header.get_data_dtype()
+    with ImageOpener(fname, 'wb') as fileobj:
+        header.write_to(fileobj)
+        fileobj.write(b'\0' * (int(header.get_data_offset()) -
+                               fileobj.tell()))
+        for chunk in chunks:
+            fileobj.write(np.asarray(chunk, dtype=dtype).tobytes(order='F'))
+    return fname
+
+
+def iter_chunks(dataobj, chunk_size=1, start=0, stop=None):
+    """
+    Yields consecutive chunks of the data of an image along its last axis
+    (e.g. the frames of a 4D series). Memory maps and arrays (see
+    `memmap_dataobj`) are sliced, while the data of an array proxy (i.e. of
+    a compressed image) are read in a single sequential pass over the file,
+    as each slice of the proxy would decompress the file from its start
+
+    Parameters
+    ----------
+    dataobj : nib.arrayproxy.ArrayProxy | ScaledMemmap | np.ndarray
+        The data of the image
+    chunk_size : int
+        Number of elements along the last axis of each chunk
+    start : int
+        First element along the last axis
+    stop : int | None
+        Element along the last axis after the last one (defaults to the
+        size of the axis)
+
+    Yields
+    ------
+    chunk : np.ndarray
+        The (scaled) data of the chunk
+    """
+    shape = dataobj.shape
+    if stop is None:
+        stop = shape[-1]
+    if not isinstance(dataobj, nib.arrayproxy.ArrayProxy):
+        for i in range(start, stop, chunk_size):
+            yield np.asarray(
+                dataobj[(Ellipsis, slice(i, min(i + chunk_size, stop)))])
+        return
+    dtype = np.dtype(dataobj.dtype)
+    slab_size = int(np.prod(shape[:-1])) * dtype.itemsize
+    with ImageOpener(dataobj.file_like) as fileobj:
+        fileobj.seek(dataobj.offset + start * slab_size)
+        for i in range(start, stop, chunk_size):
+            num = min(chunk_size, stop - i)
+            raw = np.frombuffer(fileobj.read(slab_size * num), dtype=dtype)
+            yield apply_read_scaling(
+                raw.reshape(shape[:-1] + (num,), order='F'),
+                dataobj.slope, dataobj.inter)
+
+
+def crop_chunks(dataobj, slicer, chunk_size=1):
+    """
+    Yields a sub-box of an image, read through its memory map or array proxy
+    (see `memmap_dataobj` and `iter_chunks`, so only the box, or the file up
+    to the end of the box for compressed images, is read from disk) in
+    chunks of `chunk_size` elements along the last axis (e.g. the frames of
+    a 4D series)
+
+    Parameters
+    ----------
+    dataobj : nib.arrayproxy.ArrayProxy | ScaledMemmap | np.ndarray
+        The data of the image
+    slicer : tuple(slice)
+        Slice of each axis of the image
+    chunk_size : int
+        Number of elements along the last axis read at once
+
+    Yields
+    ------
+    chunk : np.ndarray
+        The chunk of the box
+    """
+    last = range(*slicer[-1].indices(dataobj.shape[len(slicer) - 1]))
+    if (isinstance(dataobj, nib.arrayproxy.ArrayProxy) and
+            len(slicer) == len(dataobj.shape) and last.step > 0):
+        # The slabs are read sequentially and cropped in memory
+        box = tuple(slicer[:-1]) + (slice(None, None, last.step),)
+        for chunk in iter_chunks(dataobj, chunk_size=last.step * chunk_size,
+                                 start=last.start, stop=last.stop):
+            yield chunk[box]
+        return
+    for i in range(0, len(last), chunk_size):
+        sub = last[i:i + chunk_size]
+        yield dataobj[tuple(slicer[:-1]) +
+                      (slice(sub.start, sub.stop, sub.step),)]
+
+
+def load_masked(img, mask=None, dtype=np.float32):
+    """
+    Loads the voxels of a 4D image within a mask as a (voxels, frames)
+    matrix, reading one frame at a time (see `memmap_dataobj` and
+    `iter_chunks`) so that the voxels outside the mask are never held in
+    memory
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        The 4D image
+    mask : np.ndarray (bool) | None
+        3D mask of the voxels to load. If None all the voxels are loaded
+    dtype : np.dtype
+        Data type of the matrix
+
+    Returns
+    -------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel within the mask (in the order of
+        np.flatnonzero(mask))
+    """
+    dataobj = memmap_dataobj(img)
+    if len(img.shape) == 3:
+        frames = [np.asarray(dataobj[...])]
+    else:
+        frames = (chunk[..., 0] for chunk in iter_chunks(dataobj))
+    if mask is None:
+        mask = np.ones(img.shape[:3], dtype=bool)
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+    data = np.empty((int(np.count_nonzero(mask)), n_frames), dtype=dtype)
+    for t, frame in enumerate(frames):
+        data[:, t] = frame[mask]
+    return data
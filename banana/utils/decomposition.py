@@ -0,0 +1,183 @@
+import numpy as np
+
+
+def temporal_covariance(data, chunk_size=20000):
+    """
+    Covariance between the frames of a (voxels, frames) matrix, i.e. of the
+    time series of the voxels centered on the mean of each frame (as
+    sklearn's PCA does), accumulated over chunks of voxels in float64. The
+    data are shifted by the mean of the first chunk to avoid the loss of
+    precision of the one-pass formula when the mean is large
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    cov : np.ndarray (n_frames, n_frames)
+        The (unnormalised) covariance matrix
+    mean : np.ndarray (n_frames,)
+        The mean of each frame over the voxels
+    """
+    n_frames = data.shape[1]
+    gram = np.zeros((n_frames, n_frames))
+    total = np.zeros(n_frames)
+    shift = data[:chunk_size].astype(np.float64).mean(axis=0)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64) - shift
+        gram += np.dot(chunk.T, chunk)
+        total += chunk.sum(axis=0)
+    offset = total / data.shape[0]
+    return (gram - data.shape[0] * np.outer(offset, offset),
+            shift + offset)
+
+
+def temporal_components(data, n_components=1, chunk_size=20000):
+    """
+    Leading temporal principal components of a (voxels, frames) matrix, i.e.
+    the components_ of sklearn's PCA (up to their sign). As there are far
+    fewer frames than voxels they are found from the eigendecomposition of
+    the small frames x frames covariance matrix (see `temporal_covariance`),
+    which only needs a single pass over the data
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    n_components : int
+        Number of components
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    components : np.ndarray (n_components, n_frames)
+        The orthonormal components, by decreasing explained variance
+    variances : np.ndarray (n_components,)
+        The variance explained by each component
+    """
+    cov, _ = temporal_covariance(data, chunk_size=chunk_size)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1][:n_components]
+    return (eigvecs[:, order].T,
+            np.maximum(eigvals[order], 0) / max(data.shape[0] - 1, 1))
+
+
+def remove_components(data, components, chunk_size=20000):
+    """
+    Removes the projection of the time series of each voxel onto orthonormal
+    temporal components, in place and chunk by chunk
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel (modified in place)
+    components : np.ndarray (n_components, n_frames)
+        The orthonormal components (see `temporal_components`)
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    data : np.ndarray (n_voxels, n_frames)
+        The data with the components removed
+    """
+    components = np.asarray(components, dtype=np.float64)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size]
+        coefs = np.dot(chunk, components.T)
+        chunk -= np.dot(coefs, components).astype(data.dtype)
+    return data
+
+
+def reduce_frames(data, rank, chunk_size=20000):
+    """
+    Reduces the time series of each voxel to their coordinates in the
+    leading `rank` temporal principal components, i.e. the PCA of the voxels
+    as samples (see `temporal_covariance`)
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    rank : int
+        Number of principal components kept
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    reduced : np.ndarray (n_voxels, rank) (float32)
+        The centered data in the basis of the components
+    components : np.ndarray (rank, n_frames)
+        The orthonormal temporal components
+    """
+    cov, mean = temporal_covariance(data, chunk_size=chunk_size)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    components = eigvecs[:, np.argsort(eigvals)[::-1][:rank]].T
+    reduced = np.empty((data.shape[0], rank), dtype=np.float32)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64) - mean
+        reduced[start:start + chunk_size] = np.dot(chunk, components.T)
+    return reduced, components
+
+
+def voxel_centered_gram(data, chunk_size=20000):
+    """Gram matrix between the frames of a (voxels, frames) matrix after
+    centering the time series of each voxel on its mean, accumulated over
+    chunks of voxels in float64"""
+    gram = np.zeros((data.shape[1], data.shape[1]))
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64)
+        chunk -= chunk.mean(axis=1)[:, None]
+        gram += np.dot(chunk.T, chunk)
+    return gram
+
+
+def reduce_voxels(data, rank, chunk_size=20000):
+    """
+    Reduces each frame to its coordinates in the leading `rank` spatial
+    principal components, i.e. the PCA of the frames as samples (after
+    centering the time series of each voxel). As there are far fewer frames
+    than voxels the components are found from the eigendecomposition of the
+    frames x frames Gram matrix, without forming them
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    rank : int
+        Number of principal components kept
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    reduced : np.ndarray (n_frames, rank) (float32)
+        The centered frames in the basis of the components
+    weights : np.ndarray (n_frames, rank)
+        The components are the centered data multiplied by the weights (see
+        `project_voxels`)
+    """
+    eigvals, eigvecs = np.linalg.eigh(
+        voxel_centered_gram(data, chunk_size=chunk_size))
+    order = np.argsort(eigvals)[::-1][:rank]
+    sqrt_eigvals = np.sqrt(np.maximum(eigvals[order], np.finfo(float).tiny))
+    return ((eigvecs[:, order] * sqrt_eigvals).astype(np.float32),
+            eigvecs[:, order] / sqrt_eigvals)
+
+
+def project_voxels(data, weights, chunk_size=20000):
+    """Multiplies the time series of each voxel, centered on their mean, by
+    a (frames, n) matrix chunk by chunk, returning a (voxels, n) float32
+    matrix"""
+    projected = np.empty((data.shape[0], weights.shape[1]), dtype=np.float32)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64)
+        chunk -= chunk.mean(axis=1)[:, None]
+        projected[start:start + chunk_size] = np.dot(chunk, weights)
+    return projected
@@ -0,0 +1,155 @@
+import os
+import os.path as op
+import errno
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import pydicom
+
+
+SERIES_TAGS = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription']
+
+LINK_TYPES = ('hard', 'symbolic', 'copy')
+
+
+def series_name(series_number, series_description):
+    """Name of the directory of a series, i.e. its number (zero-padded) and
+    description joined by '_', with spaces replaced by underscores"""
+    return (str(series_number).zfill(2) + '_' +
+            series_description).replace(' ', '_')
+
+
+def read_series_header(fname):
+    """
+    Reads the tags identifying the series a DICOM file belongs to, without
+    reading the rest of the header or the pixel data
+
+    Parameters
+    ----------
+    fname : str
+        Path to the DICOM file
+
+    Returns
+    -------
+    uid : str
+        The series instance UID (the series name if it is missing)
+    name : str
+        The name of the series (see `series_name`)
+    """
+    hdr = pydicom.dcmread(fname, stop_before_pixels=True,
+                          specific_tags=SERIES_TAGS)
+    name = series_name(hdr.SeriesNumber, hdr.get('SeriesDescription', ''))
+    return str(hdr.get('SeriesInstanceUID', name)), name
+
+
+def record_series(record):
+    """The series instance UID and name of a DICOM file (see
+    `read_series_header`) from its record in a header index (see
+    banana.utils.header_index.read_record)"""
+    name = series_name(record['SeriesNumber'],
+                       record.get('SeriesDescription', ''))
+    return str(record.get('SeriesInstanceUID', name)), name
+
+
+def read_series_headers(fnames, num_workers=None):
+    """Reads the tags identifying the series of each file (see
+    `read_series_header`) using a pool of `num_workers` processes"""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers > 1 and len(fnames) > 1:
+        chunksize = max(1, len(fnames) // (num_workers * 4))
+        with ProcessPoolExecutor(num_workers) as pool:
+            headers = list(pool.map(read_series_header, fnames,
+                                    chunksize=chunksize))
+    else:
+        headers = [read_series_header(f) for f in fnames]
+    return headers
+
+
+def index_series(fnames, num_workers=None, index=None):
+    """
+    Groups DICOM files by series in a single pass over their headers, which
+    are read concurrently by a pool of processes
+
+    Parameters
+    ----------
+    fnames : list(str)
+        Paths of the DICOM files
+    num_workers : int | None
+        Number of processes used to read the headers. Defaults to the
+        number of CPUs. If 1 the headers are read serially
+    index : banana.utils.header_index.HeaderIndex | None
+        If provided, the series are found from the records of the files in
+        the index, which are read (and stored) in the same pass if they are
+        not indexed yet, and files that are not DICOMs are skipped.
+        Otherwise only the tags identifying the series are read
+
+    Returns
+    -------
+    series : OrderedDict(str, list(str))
+        The files of each series, with the series named as in `series_name`
+        and in the order they first appear in `fnames`. If different series
+        share the same name, a suffix ('_2', '_3', ...) is appended to the
+        names of the later ones
+    """
+    if index is not None:
+        records = index.records(fnames, num_workers=num_workers)
+        fnames = [f for f, r in zip(fnames, records) if r is not None]
+        headers = [record_series(r) for r in records if r is not None]
+    else:
+        headers = read_series_headers(fnames, num_workers=num_workers)
+    by_uid = OrderedDict()
+    for fname, (uid, name) in zip(fnames, headers):
+        by_uid.setdefault(uid, (name, []))[1].append(fname)
+    series = OrderedDict()
+    for name, files in by_uid.values():
+        unique_name = name
+        n = 1
+        while unique_name in series:
+            n += 1
+            unique_name = '{}_{}'.format(name, n)
+        series[unique_name] = files
+    return series
+
+
+def link_file(src, dst, link='hard'):
+    """
+    Places a file in the working directory without duplicating its data,
+    as a hard link (falling back to a symbolic link if the destination is on
+    a different file system) or a symbolic link. If link is 'copy' the file
+    is copied as shutil.copy2 does
+
+    Parameters
+    ----------
+    src : str
+        Path to the file
+    dst : str
+        Destination path or directory
+    link : str
+        One of 'hard', 'symbolic' or 'copy'
+    """
+    if link not in LINK_TYPES:
+        raise ValueError(
+            "Unrecognised link type '{}', can be one of '{}'"
+            .format(link, "', '".join(LINK_TYPES)))
+    if op.isdir(dst):
+        dst = op.join(dst, op.basename(src))
+    if link == 'hard':
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if link == 'copy':
+        shutil.copy2(src, dst)
+    else:
+        os.symlink(op.abspath(src), dst)
+    return dst
+
+
+def link_tree(src, dst, link='hard'):
+    """Equivalent of shutil.copytree where the files are linked (see
+    `link_file`) instead of being copied"""
+    return shutil.copytree(src, dst,
+                           copy_function=lambda s, d: link_file(s, d, link))
@@ -0,0 +1,99 @@
+import numpy as np
+from scipy.linalg import solve_triangular
+
+
+def spatial_regression(data, maps, chunk_size=20000):
+    """
+    First step of the dual regression: fits the spatial maps to each frame,
+    i.e. solves data = maps . timecourses.T in the least-squares sense. The
+    normal equations are accumulated over chunks of voxels (in float64) so
+    that only one chunk is converted at a time
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    maps : np.ndarray (n_voxels, n_maps)
+        The spatial maps
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    timecourses : np.ndarray (n_frames, n_maps)
+        The time course of each map
+    """
+    n_maps = maps.shape[1]
+    mtm = np.zeros((n_maps, n_maps))
+    mtd = np.zeros((n_maps, data.shape[1]))
+    for start in range(0, data.shape[0], chunk_size):
+        m = maps[start:start + chunk_size].astype(np.float64)
+        mtm += np.dot(m.T, m)
+        mtd += np.dot(m.T, data[start:start + chunk_size])
+    return np.linalg.lstsq(mtm, mtd, rcond=None)[0].T
+
+
+def temporal_regression(data, timecourses, chunk_size=20000):
+    """
+    Second step of the dual regression: fits the time courses to the time
+    series of each voxel, i.e. solves data.T = timecourses . maps.T in the
+    least-squares sense, using the QR decomposition of the time courses
+    computed once for all the chunks of voxels
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel
+    timecourses : np.ndarray (n_frames, n_maps)
+        The time course of each map
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    maps : np.ndarray (n_voxels, n_maps) (float32)
+        The regression coefficients of each voxel
+    """
+    q, r = np.linalg.qr(timecourses)
+    maps = np.empty((data.shape[0], timecourses.shape[1]), dtype=np.float32)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64)
+        maps[start:start + chunk_size] = solve_triangular(
+            r, np.dot(q.T, chunk.T)).T
+    return maps
+
+
+def zscore(maps):
+    """Z-scores each map (column) over the voxels (rows)"""
+    maps = np.asarray(maps, dtype=np.float64)
+    return ((maps - maps.mean(axis=0)) / maps.std(axis=0)).astype(np.float32)
+
+
+def dual_regression(data, maps, chunk_size=20000):
+    """
+    Dual regression of all the spatial maps at once: the time courses of the
+    maps are estimated by spatial regression of the data and then the map of
+    each time course by temporal regression (see `spatial_regression` and
+    `temporal_regression`)
+
+    Parameters
+    ----------
+    data : np.ndarray (n_voxels, n_frames)
+        The time series of each voxel (e.g. only the ones within a brain
+        mask, see banana.utils.chunked.load_masked)
+    maps : np.ndarray (n_voxels, n_maps)
+        The spatial maps of the same voxels
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    timecourses : np.ndarray (n_frames, n_maps)
+        The time course of each map
+    zmaps : np.ndarray (n_voxels, n_maps) (float32)
+        The z-scored map of each time course
+    """
+    timecourses = spatial_regression(data, maps, chunk_size=chunk_size)
+    zmaps = zscore(temporal_regression(data, timecourses,
+                                       chunk_size=chunk_size))
+    return timecourses, zmaps
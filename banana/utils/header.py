@@ -0,0 +1,210 @@
+import os
+import os.path as op
+import subprocess as sp
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+import nibabel as nib
+from nibabel.filebasedimages import ImageFileError
+import pydicom
+from banana.exceptions import BananaUsageError
+
+
+ImageGeometry = namedtuple('ImageGeometry',
+                           ['affine', 'shape', 'zooms', 'qform'])
+ImageGeometry.__doc__ = """
+Geometry of an image read from its header
+
+Parameters
+----------
+affine : np.ndarray (4, 4)
+    Voxel to scanner (RAS) coordinates in mm
+shape : tuple(int)
+    Dimensions of the image
+zooms : tuple(float)
+    Voxel sizes
+qform : np.ndarray (4, 4)
+    The qform matrix stored in the header (same as affine for DICOMs)
+"""
+
+
+def file_signature(path):
+    """Returns a key that changes whenever the file (or the files within the
+    directory) is modified, so that cached headers are never stale"""
+    path = op.realpath(path)
+    stat = os.stat(path)
+    signature = (path, stat.st_size, stat.st_mtime_ns)
+    if op.isdir(path):
+        signature += tuple(
+            (f, s.st_size, s.st_mtime_ns) for f, s in
+            ((f, os.stat(op.join(path, f))) for f in sorted(os.listdir(path))))
+    return signature
+
+
+def header_geometry(path):
+    """
+    Reads the geometry of a NIfTI (or any format supported by nibabel) image
+    or of a DICOM series directory, without loading the data. The results
+    are cached (see `cached_geometry`) so that the same header is only read
+    once by the different interfaces
+
+    Parameters
+    ----------
+    path : str
+        Path to the image file or to the DICOM directory
+
+    Returns
+    -------
+    geometry : ImageGeometry
+        Affine, shape and voxel sizes of the image
+    """
+    return cached_geometry(file_signature(path))
+
+
+@lru_cache(maxsize=1024)
+def cached_geometry(signature):
+    path = signature[0]
+    if op.isdir(path):
+        return dicom_geometry(path)
+    return nifti_geometry(path)
+
+
+def nifti_geometry(path):
+    img = nib.load(path)
+    header = img.header
+    # As in MRtrix (with its default NIfTIUseSform: true), the sform takes
+    # precedence over the qform, and the qform is used if there is no sform
+    affine = header.get_best_affine()
+    return ImageGeometry(np.asarray(affine, dtype=float), img.shape,
+                         header.get_zooms(), header.get_qform())
+
+
+def dicom_geometry(path):
+    """Geometry of a single-frame DICOM series, from the orientation and
+    position of its slices"""
+    slices = []
+    for fname in sorted(os.listdir(path)):
+        fpath = op.join(path, fname)
+        if not op.isfile(fpath):
+            continue
+        try:
+            hdr = pydicom.dcmread(fpath, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        if 'ImagePositionPatient' in hdr:
+            slices.append(hdr)
+    if not slices:
+        raise BananaUsageError(
+            "No DICOM files with geometry information found in {}"
+            .format(path))
+    orient = np.array(slices[0].ImageOrientationPatient, dtype=float)
+    row_dir, col_dir = orient[:3], orient[3:]
+    normal = np.cross(row_dir, col_dir)
+    positions = np.array([s.ImagePositionPatient for s in slices],
+                         dtype=float)
+    # Keep one position per slice (series can contain several volumes)
+    dists, first = np.unique(np.round(np.dot(positions, normal), 4),
+                             return_index=True)
+    first_pos = positions[first[0]]
+    col_spacing, row_spacing = (float(x) for x in slices[0].PixelSpacing)
+    if len(dists) > 1:
+        slice_spacing = (dists[-1] - dists[0]) / (len(dists) - 1)
+    else:
+        slice_spacing = float(getattr(slices[0], 'SliceThickness', 1.0))
+    affine = np.eye(4)
+    affine[:3, 0] = row_dir * row_spacing
+    affine[:3, 1] = col_dir * col_spacing
+    affine[:3, 2] = normal * slice_spacing
+    affine[:3, 3] = first_pos
+    # DICOM patient coordinates are LPS
+    affine = np.dot(np.diag([-1.0, -1.0, 1.0, 1.0]), affine)
+    n_vols = len(slices) // len(dists)
+    shape = (int(slices[0].Columns), int(slices[0].Rows), len(dists))
+    if n_vols > 1:
+        shape += (n_vols,)
+    return ImageGeometry(affine, shape,
+                         (row_spacing, col_spacing, slice_spacing), affine)
+
+
+# Errors raised when an image cannot be read in-process (e.g. its format is
+# only supported by MRtrix or FSL)
+UNREADABLE_ERRORS = (OSError, ImageFileError, BananaUsageError)
+
+
+def realign_transform(geometry):
+    """
+    Returns the transform reported by `mrinfo`, i.e. the voxel to scanner
+    transform without voxel sizes after the image axes have been permuted
+    and flipped to be as close as possible to the scanner axes
+
+    Parameters
+    ----------
+    geometry : ImageGeometry
+        Geometry of the image
+
+    Returns
+    -------
+    transform : np.ndarray (4, 4)
+        The realigned transform
+    """
+    zooms = np.asarray(geometry.zooms[:3], dtype=float)
+    rotation = geometry.affine[:3, :3] / zooms
+    translation = geometry.affine[:3, 3].copy()
+    # Assign image axes to scanner axes, starting from the most aligned ones
+    perm = [None] * 3
+    free_axes = set(range(3))
+    for flat in np.argsort(-np.abs(rotation), axis=None):
+        scanner_axis, image_axis = np.unravel_index(flat, (3, 3))
+        if perm[scanner_axis] is None and image_axis in free_axes:
+            perm[scanner_axis] = image_axis
+            free_axes.remove(image_axis)
+    transform = np.eye(4)
+    for scanner_axis, image_axis in enumerate(perm):
+        column = rotation[:, image_axis]
+        if column[scanner_axis] < 0:
+            translation += ((geometry.shape[image_axis] - 1) *
+                            zooms[image_axis] * column)
+            column = -column
+        # Adding zero avoids negative zeros in the flipped columns
+        transform[:3, scanner_axis] = column + 0.0
+    transform[:3, 3] = translation
+    return transform
+
+
+def mrinfo_transform(path):
+    "Transform of the image as printed by `mrinfo`"
+    hd = sp.check_output('mrinfo {}'.format(path), shell=True).decode('utf-8')
+    lines = hd.split('\n')
+    i = [n for n, el in enumerate(lines) if 'Transform' in el][0]
+    mat = [[float(x) for x in lines[i].split()[1:]]]
+    for j in range(1, 3):
+        mat.append([float(x) for x in lines[i + j].split()])
+    mat.append([0, 0, 0, 1])
+    return np.asarray(mat)
+
+
+def mrtrix_transform(path):
+    """Returns the same transform as `mrinfo` reading the header in-process,
+    falling back to running `mrinfo` if the image cannot be read by nibabel
+    or pydicom"""
+    try:
+        geometry = header_geometry(path)
+    except UNREADABLE_ERRORS:
+        return mrinfo_transform(path)
+    return realign_transform(geometry)
+
+
+def qform(path):
+    """Returns the qform of a NIfTI image, falling back to the one printed
+    by `fslhd` if the image cannot be read by nibabel"""
+    try:
+        return header_geometry(path).qform.copy()
+    except UNREADABLE_ERRORS:
+        hd = sp.check_output('fslhd {}'.format(path),
+                             shell=True).decode('utf-8')
+        mat = np.eye(4)
+        for line in hd.strip().split('\n'):
+            for i in range(3):
+                if line.startswith('qto_xyz:{}'.format(i + 1)):
+                    mat[i] = [float(x) for x in line.split()[1:]]
+        return mat
@@ -0,0 +1,372 @@
+import os
+import os.path as op
+import json
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import pydicom
+import nibabel.nicom.csareader as csareader
+from banana.utils.siemens import (
+    phoenix_protocol, interfile_header, find_value)
+
+
+# Standard DICOM tags stored in the index
+HEADER_TAGS = [
+    'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription',
+    'AcquisitionTime', 'AcquisitionDateTime', 'RepetitionTime', 'EchoTime',
+    'EchoTrainLength', 'ImageOrientationPatient', 'PixelSpacing',
+    'SliceThickness', 'MagneticFieldStrength', 'ImageType',
+    'InPlanePhaseEncodingDirection', 'InstanceNumber']
+# Parameters of the Siemens protocol stored in the index (see
+# banana.utils.siemens.find_value)
+PROTOCOL_PARAMS = [
+    'TotalScan', 'alTR[0]', 'SliceArray.asSlice[0].dInPlaneRot',
+    'lDiffDirections', 'tSequenceFileName']
+# Parameters of the Interfile header of Siemens PET data
+INTERFILE_PARAMS = ['image duration']
+# Tags read to find the echo times of multi-echo series
+ECHO_TAGS = ['EchoTime', 'EchoNumbers']
+
+
+def to_json(value):
+    "Converts pydicom values into types that can be stored as JSON"
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return [to_json(v) for v in value]
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def read_record(fname):
+    """
+    Reads the fields banana needs from the header of a DICOM file (without
+    the pixel data)
+
+    Parameters
+    ----------
+    fname : str
+        Path to the DICOM file
+
+    Returns
+    -------
+    record : dict | None
+        The value of each field in HEADER_TAGS present in the header, plus
+        'PhaseEncodingDirectionPositive' from the CSA image header, and the
+        'protocol' and 'interfile' dictionaries with the parameters in
+        PROTOCOL_PARAMS and INTERFILE_PARAMS that were found. None if the
+        file is not a DICOM
+    """
+    try:
+        hdr = pydicom.dcmread(fname, stop_before_pixels=True)
+    except pydicom.errors.InvalidDicomError:
+        return None
+    record = {}
+    for tag in HEADER_TAGS:
+        value = hdr.get(tag)
+        if value is not None:
+            record[tag] = to_json(value)
+    try:
+        csa = csareader.get_csa_header(hdr, 'image')
+        record['PhaseEncodingDirectionPositive'] = to_json(
+            csa['tags']['PhaseEncodingDirectionPositive']['items'][0])
+    except (csareader.CSAError, KeyError, IndexError, TypeError):
+        pass
+    for key, params, all_params in (
+            ('protocol', PROTOCOL_PARAMS, phoenix_protocol(hdr)),
+            ('interfile', INTERFILE_PARAMS, interfile_header(hdr))):
+        values = ((p, find_value(all_params, p)) for p in params)
+        record[key] = {p: v for p, v in values if v is not None}
+    return record
+
+
+def read_echo(fname):
+    """Reads the echo time of a DICOM file, only reading the tags in
+    ECHO_TAGS from the header. None if the file is not a DICOM"""
+    try:
+        hdr = pydicom.dcmread(fname, stop_before_pixels=True,
+                              specific_tags=ECHO_TAGS)
+    except pydicom.errors.InvalidDicomError:
+        return None
+    echo_time = hdr.get('EchoTime')
+    return float(echo_time) if echo_time is not None else None
+
+
+def echo_samples(num_files, num_echoes):
+    """
+    Positions of the files sampled to find the echo times of a series, in the
+    order they are read. Multi-echo series are either interleaved (the
+    echoes of a slice have consecutive instance numbers) or stored echo by
+    echo, so the first `num_echoes` files are sampled, followed by one file
+    every num_files / num_echoes instances
+
+    Parameters
+    ----------
+    num_files : int
+        Number of files in the series (in instance number order, see
+        `HeaderIndex.echo_times`)
+    num_echoes : int
+        Number of echoes (i.e. the EchoTrainLength)
+
+    Returns
+    -------
+    positions : list(int)
+        The positions of the sampled files (without repetitions)
+    """
+    positions = list(range(min(num_echoes, num_files)))
+    stride = num_files // num_echoes
+    if stride:
+        positions.extend(i * stride for i in range(1, num_echoes))
+    return sorted(set(positions), key=positions.index)
+
+
+def find_echo_times(fnames, num_echoes, num_workers=None, batch_size=64):
+    """
+    Finds the distinct echo times of a multi-echo series, reading only the
+    EchoTime tag of a sample of the files (see `echo_samples`) and then, if
+    not all the echoes were found, of the remaining files in batches read by
+    a pool of processes until `num_echoes` echo times have been found
+
+    Parameters
+    ----------
+    fnames : list(str)
+        Paths of the files of the series, in instance number order (files
+        that are not DICOMs are ignored)
+    num_echoes : int
+        Number of echoes (i.e. the EchoTrainLength)
+    num_workers : int | None
+        Number of processes used to read the remaining headers. Defaults to
+        the number of CPUs. If 1 the headers are read serially
+    batch_size : int
+        Number of files read by each process before checking whether all
+        echo times have been found
+
+    Returns
+    -------
+    echo_times : list(float)
+        The echo times found, in ascending order
+    """
+    echo_times = set()
+    sampled = echo_samples(len(fnames), num_echoes)
+    for i in sampled:
+        echo_times.add(read_echo(fnames[i]))
+        if len(echo_times - {None}) == num_echoes:
+            return sorted(echo_times - {None})
+    sampled = set(sampled)
+    remaining = [f for i, f in enumerate(fnames) if i not in sampled]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers > 1 and len(remaining) > batch_size:
+        step = num_workers * batch_size
+        with ProcessPoolExecutor(num_workers) as pool:
+            for i in range(0, len(remaining), step):
+                echo_times.update(pool.map(read_echo, remaining[i:i + step],
+                                           chunksize=batch_size))
+                if len(echo_times - {None}) >= num_echoes:
+                    break
+    else:
+        for fname in remaining:
+            echo_times.add(read_echo(fname))
+            if len(echo_times - {None}) == num_echoes:
+                break
+    return sorted(echo_times - {None})
+
+
+def file_key(fname):
+    """Identifier of the file (device and inode, so that hard and symbolic
+    links to the same file share the same record), size and modification
+    time"""
+    stat = os.stat(fname)
+    return '{}:{}'.format(stat.st_dev, stat.st_ino), stat.st_size, \
+        stat.st_mtime_ns
+
+
+class HeaderIndex(object):
+    """
+    Persistent index of the DICOM header fields used by banana, stored in a
+    SQLite database. Each record is keyed by the file (i.e. its inode, so
+    links to the file share the record) and is considered stale (and read
+    again) when the size or modification time of the file change, so a
+    single index can be shared by all the pipelines (and processes) that read
+    the same session
+
+    Parameters
+    ----------
+    path : str | None
+        Path to the SQLite file (e.g. in the working directory of the
+        session). If None, or if the file cannot be created, the index is
+        kept in memory (i.e. only for the lifetime of the object)
+    """
+
+    TABLES = [
+        ('headers', '(file TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+         'path TEXT, record TEXT)'),
+        ('echo_times', '(series TEXT PRIMARY KEY, echo_times TEXT)')]
+
+    def __init__(self, path=None):
+        self.path = path
+        self._memory = None
+        if path is not None:
+            try:
+                if not op.exists(op.dirname(op.abspath(path))):
+                    os.makedirs(op.dirname(op.abspath(path)))
+                with self.connect() as conn:
+                    for name, columns in self.TABLES:
+                        conn.execute('CREATE TABLE IF NOT EXISTS {} {}'
+                                     .format(name, columns))
+                return
+            except (OSError, sqlite3.Error):
+                pass
+        self._memory = sqlite3.connect(':memory:', check_same_thread=False)
+        for name, columns in self.TABLES:
+            self._memory.execute('CREATE TABLE {} {}'.format(name, columns))
+
+    @contextmanager
+    def connect(self):
+        """Opens a connection to the database, committing the changes (and
+        closing it) at the end"""
+        if self._memory is not None:
+            with self._memory:
+                yield self._memory
+        else:
+            conn = sqlite3.connect(self.path, timeout=60)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def __getitem__(self, fname):
+        """Returns the record of a file (see `read_record`), reading its
+        header if it is not in the index or has changed"""
+        return self.records([fname], num_workers=1)[0]
+
+    def records(self, fnames, num_workers=None):
+        """
+        Returns the records of a list of files (see `read_record`), reading
+        the headers of the files that are not in the index or that have
+        changed since they were indexed using a pool of processes
+
+        Parameters
+        ----------
+        fnames : list(str)
+            Paths of the DICOM files
+        num_workers : int | None
+            Number of processes used to read the headers. Defaults to the
+            number of CPUs. If 1 the headers are read serially
+
+        Returns
+        -------
+        records : list(dict | None)
+            The record of each file
+        """
+        keys = [file_key(f) for f in fnames]
+        paths = dict(zip(keys, fnames))
+        indexed = self._lookup(set(k[0] for k in keys))
+        stale = sorted(set(
+            k for k in keys if indexed.get(k[0], (None,))[0] != k))
+        if stale:
+            if num_workers is None:
+                num_workers = os.cpu_count() or 1
+            stale_paths = [paths[k] for k in stale]
+            if num_workers > 1 and len(stale) > 1:
+                chunksize = max(1, len(stale) // (num_workers * 4))
+                with ProcessPoolExecutor(num_workers) as pool:
+                    new_records = list(pool.map(read_record, stale_paths,
+                                                chunksize=chunksize))
+            else:
+                new_records = [read_record(p) for p in stale_paths]
+            self._store(list(zip(stale, stale_paths, new_records)))
+            indexed.update(
+                (k[0], (k, r)) for k, r in zip(stale, new_records))
+        return [indexed[k[0]][1] for k in keys]
+
+    def update(self, fnames, num_workers=None):
+        """Indexes the headers of the files that are not in the index or that
+        have changed (see `records`)"""
+        self.records(fnames, num_workers=num_workers)
+
+    def echo_times(self, fnames, num_echoes, num_workers=None):
+        """
+        Returns the echo times of a multi-echo series (see
+        `find_echo_times`). The files are sampled in the order of their
+        InstanceNumber if they are all in the index already (e.g. after
+        `update`), otherwise in the given order, and the files known not to
+        be DICOMs are skipped. The result is stored in the index for the
+        series, i.e. the list of files, and found again only if any of the
+        files changes
+
+        Parameters
+        ----------
+        fnames : list(str)
+            Paths of the files of the series (e.g. sorted by name)
+        num_echoes : int
+            Number of echoes (i.e. the EchoTrainLength)
+        num_workers : int | None
+            Number of processes used if all the headers need to be read
+
+        Returns
+        -------
+        echo_times : list(float)
+            The echo times of the series, in ascending order
+        """
+        series = hashlib.sha1(json.dumps(
+            [file_key(f) for f in fnames]).encode()).hexdigest()
+        with self.connect() as conn:
+            row = conn.execute(
+                'SELECT echo_times FROM echo_times WHERE series = ?',
+                (series,)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        echo_times = find_echo_times(self.instance_order(fnames), num_echoes,
+                                     num_workers=num_workers)
+        try:
+            with self.connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO echo_times VALUES (?, ?)',
+                    (series, json.dumps(echo_times)))
+        except sqlite3.OperationalError:
+            pass  # e.g. the database is locked, the result is not cached
+        return echo_times
+
+    def instance_order(self, fnames):
+        """Sorts files by the InstanceNumber stored in the index, without
+        reading any header, dropping the ones indexed as not being DICOMs.
+        The files are returned in the given order if any of them is not in
+        the index (or has changed since it was indexed)"""
+        keys = [file_key(f) for f in fnames]
+        indexed = self._lookup(set(k[0] for k in keys))
+        records = [indexed[k[0]][1] if indexed.get(k[0], (None,))[0] == k
+                   else {} for k in keys]
+        fnames = [f for f, r in zip(fnames, records) if r is not None]
+        records = [r for r in records if r is not None]
+        if not all('InstanceNumber' in r for r in records):
+            return fnames
+        return [f for _, f in sorted(
+            zip((r['InstanceNumber'] for r in records), fnames))]
+
+    def _lookup(self, files, chunk=500):
+        "Returns the indexed keys and records of the given files"
+        files = list(files)
+        indexed = {}
+        with self.connect() as conn:
+            for i in range(0, len(files), chunk):
+                sub = files[i:i + chunk]
+                for f, size, mtime_ns, record in conn.execute(
+                        'SELECT file, size, mtime_ns, record FROM headers '
+                        'WHERE file IN ({})'.format(','.join('?' * len(sub))),
+                        sub):
+                    indexed[f] = ((f, size, mtime_ns), json.loads(record))
+        return indexed
+
+    def _store(self, rows):
+        try:
+            with self.connect() as conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)',
+                    ((k[0], k[1], k[2], op.abspath(p), json.dumps(r))
+                     for k, p, r in rows))
+        except sqlite3.OperationalError:
+            pass  # e.g. the database is locked, the records are not cached
@@ -0,0 +1,318 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# Geometry of the Biograph mMR span-11 sinograms (the ones sorted by
+# ListModeFraming in mode 4): number of tangential bins and views, and number
+# of axial planes of each segment in the order they are addressed in the
+# list-mode data (segment 0, +1, -1, +2, -2, ...)
+NUM_TANGENTIAL = 344
+NUM_VIEWS = 252
+SEGMENT_PLANES = (127, 115, 115, 93, 93, 71, 71, 49, 49, 27, 27)
+NUM_BINS = NUM_TANGENTIAL * NUM_VIEWS * sum(SEGMENT_PLANES)
+
+# The list-mode data is a sequence of 32-bit little-endian words. Events have
+# bit 31 unset, bit 30 set for prompts (unset for delays) and the sinogram bin
+# in bits 0-29. Tags have bit 31 set, the elapsed time tags (bits 31-29 =
+# 100) storing the milliseconds since the start of the acquisition in bits
+# 0-28
+TAG_BIT = np.uint32(0x80000000)
+PROMPT_BIT = np.uint32(0x40000000)
+BIN_MASK = np.uint32(0x3FFFFFFF)
+TIME_TAG_MASK = np.uint32(0xE0000000)
+TIME_TAG = np.uint32(0x80000000)
+TIME_MASK = np.uint32(0x1FFFFFFF)
+
+
+def read_words(fname):
+    "Memory-maps the words of a list-mode (.bf) file"
+    return np.memmap(fname, dtype='<u4', mode='r')
+
+
+def next_time_tag(words, pos, block=4096):
+    """Returns the position and value (in ms) of the first elapsed time tag
+    at or after `pos`, or (len(words), None) if there is none"""
+    while pos < len(words):
+        found = np.flatnonzero(
+            (words[pos:pos + block] & TIME_TAG_MASK) == TIME_TAG)
+        if found.size:
+            pos += int(found[0])
+            return pos, int(words[pos] & TIME_MASK)
+        pos += block
+    return len(words), None
+
+
+def time_position(words, time_ms):
+    """
+    Finds the position in the list-mode data from which the events happened
+    at or after a given time, i.e. the position of the first elapsed time tag
+    whose value is >= `time_ms`. As the time tags increase through the data
+    the position is bisected, reading only a few blocks of the file
+
+    Parameters
+    ----------
+    words : np.ndarray (uint32)
+        The (memory-mapped) list-mode words
+    time_ms : int
+        Time since the start of the acquisition in milliseconds
+
+    Returns
+    -------
+    pos : int
+        The position of the time tag (len(words) if `time_ms` is after the
+        last time tag)
+    """
+    if time_ms <= 0:
+        return 0
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos, value = next_time_tag(words, mid)
+        if value is None or value >= time_ms:
+            hi = mid
+        else:
+            lo = pos + 1
+    return next_time_tag(words, lo)[0]
+
+
+def count_events(fname, start, end, num_bins=NUM_BINS):
+    """
+    Decodes the events between two positions of a list-mode file
+
+    Parameters
+    ----------
+    fname : str
+        Path to the list-mode file
+    start : int
+        Position of the first word
+    end : int
+        Position after the last word
+    num_bins : int
+        Number of sinogram bins (events with larger bins are ignored)
+
+    Returns
+    -------
+    prompts : tuple(np.ndarray, np.ndarray)
+        The sinogram bins with prompt events and their number of events
+    delays : tuple(np.ndarray, np.ndarray)
+        The same for the delayed events
+    """
+    words = np.array(read_words(fname)[start:end])
+    events = words[(words & TAG_BIT) == 0]
+    is_prompt = (events & PROMPT_BIT) != 0
+    counts = []
+    for selected in (events[is_prompt], events[~is_prompt]):
+        bins, num = np.unique(selected & BIN_MASK, return_counts=True)
+        valid = bins < num_bins
+        counts.append((bins[valid], num[valid]))
+    return tuple(counts)
+
+
+def frame_sinograms(fname, frames, chunk_size=2 ** 24, num_workers=None,
+                    num_bins=NUM_BINS):
+    """
+    Histograms the prompt and delayed events of a list-mode file into a
+    sinogram per frame, in a single pass over the data. The range of words of
+    each frame is found from the time tags (see `time_position`) and split
+    into chunks that are decoded concurrently by a pool of processes (see
+    `count_events`)
+
+    Parameters
+    ----------
+    fname : str
+        Path to the list-mode (.bf) file
+    frames : list(tuple(float, float))
+        Start and end times (in seconds) of each frame
+    chunk_size : int
+        Number of words decoded by each task
+    num_workers : int | None
+        Number of processes decoding the chunks. Defaults to the number of
+        CPUs. If 1 the chunks are decoded serially
+    num_bins : int
+        Number of sinogram bins
+
+    Yields
+    ------
+    prompts : np.ndarray (num_bins,)
+        The number of prompt events in each bin of the sinogram of the frame
+        (in the order they are addressed in the list-mode data)
+    delays : np.ndarray (num_bins,)
+        The number of delayed events in each bin
+    """
+    words = read_words(fname)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(num_workers) if num_workers > 1 else None
+    try:
+        for start_time, end_time in frames:
+            start = time_position(words, int(round(start_time * 1000)))
+            end = time_position(words, int(round(end_time * 1000)))
+            bounds = list(range(start, end, chunk_size)) + [end]
+            starts, ends = bounds[:-1], bounds[1:]
+            if pool is not None and len(starts) > 1:
+                chunks = pool.map(count_events, [fname] * len(starts),
+                                  starts, ends, [num_bins] * len(starts))
+            else:
+                chunks = (count_events(fname, s, e, num_bins)
+                          for s, e in zip(starts, ends))
+            prompts = np.zeros(num_bins, dtype=np.int32)
+            delays = np.zeros(num_bins, dtype=np.int32)
+            for (p_bins, p_num), (d_bins, d_num) in chunks:
+                # The bins of each chunk are unique
+                prompts[p_bins] += p_num.astype(np.int32)
+                delays[d_bins] += d_num.astype(np.int32)
+            yield prompts, delays
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def segment_numbers(num_segments):
+    """Numbers of the segments in the order they are addressed in the
+    list-mode data, i.e. 0, +1, -1, +2, -2, ..."""
+    return [0] + [s * i for i in range(1, num_segments // 2 + 1)
+                  for s in (1, -1)]
+
+
+def native_to_stir(sinogram, segment_planes=SEGMENT_PLANES,
+                   num_views=NUM_VIEWS, num_tangential=NUM_TANGENTIAL):
+    """
+    Reorders a sinogram from the order its bins are addressed in the
+    list-mode data (plane, view, tangential bin, with the segments ordered
+    0, +1, -1, ...) to the order of the STIR Interfile header used by SSRB
+    (segments ordered from the most negative, each one by view, axial
+    position and tangential bin)
+
+    Parameters
+    ----------
+    sinogram : np.ndarray
+        The sinogram in list-mode order
+    segment_planes : tuple(int)
+        Number of planes of each segment (in list-mode order)
+    num_views : int
+        Number of views
+    num_tangential : int
+        Number of tangential bins
+
+    Returns
+    -------
+    sinogram : np.ndarray
+        The flattened sinogram in STIR order
+    """
+    planes = np.split(
+        np.reshape(sinogram, (-1, num_views, num_tangential)),
+        np.cumsum(segment_planes)[:-1])
+    by_segment = dict(zip(segment_numbers(len(segment_planes)), planes))
+    return np.concatenate([by_segment[s].transpose(1, 0, 2).ravel()
+                           for s in sorted(by_segment)])
+
+
+def save_sinogram(sinogram, fname, dtype='<i2'):
+    """Saves a sinogram as signed short integers (saturating the counts), as
+    ListModeFraming does, or with another data type (e.g. '<f4' for the
+    rebinned sinograms, as STIR's SSRB does)"""
+    if np.dtype(dtype).kind == 'i':
+        sinogram = np.minimum(sinogram, np.iinfo(dtype).max)
+    np.asarray(sinogram).astype(dtype).tofile(fname)
+    return fname
+
+
+def segment_groups(num_segments_to_combine, segment_planes=SEGMENT_PLANES):
+    """Groups of segments combined into each rebinned segment by `ssrb`,
+    indexed by the number of the rebinned segment"""
+    half = num_segments_to_combine // 2
+    groups = {}
+    for segment in segment_numbers(len(segment_planes)):
+        groups.setdefault(int(np.floor((segment + half) /
+                                       num_segments_to_combine)),
+                          []).append(segment)
+    return groups
+
+
+def ssrb_num_bins(num_segments_to_combine=1, view_mash=36,
+                  segment_planes=SEGMENT_PLANES, num_views=NUM_VIEWS,
+                  num_tangential=NUM_TANGENTIAL):
+    """Number of bins of a sinogram rebinned by `ssrb` (with the same
+    parameters)"""
+    planes = dict(zip(segment_numbers(len(segment_planes)), segment_planes))
+    groups = segment_groups(num_segments_to_combine, segment_planes)
+    return (sum(max(planes[s] for s in group) for group in groups.values()) *
+            (num_views // view_mash) * num_tangential)
+
+
+def ssrb(sinograms, num_segments_to_combine=1, view_mash=36, normalise=False,
+         segment_planes=SEGMENT_PLANES, num_views=NUM_VIEWS,
+         num_tangential=NUM_TANGENTIAL):
+    """
+    Single-slice rebinning of sinograms in the order of the STIR Interfile
+    header (see `native_to_stir`), as done by STIR's SSRB. Each group of
+    `num_segments_to_combine` consecutive segments is combined into one
+    segment by adding each oblique sinogram to the plane at its mean axial
+    position, and each group of `view_mash` consecutive views is added
+    together
+
+    Parameters
+    ----------
+    sinograms : np.ndarray (num_bins,) | (num_frames, num_bins)
+        The sinograms (e.g. memory-mapped), in STIR order
+    num_segments_to_combine : int
+        Number of segments combined into each rebinned segment (odd). If it
+        is the number of segments, all are rebinned into the direct planes
+    view_mash : int
+        Number of views added together (must divide the number of views)
+    normalise : bool
+        Whether to divide the rebinned sinograms by the number of sinogram
+        bins added into each bin
+    segment_planes : tuple(int)
+        Number of planes of each segment (in list-mode order, see
+        `segment_numbers`)
+    num_views : int
+        Number of views
+    num_tangential : int
+        Number of tangential bins
+
+    Returns
+    -------
+    rebinned : np.ndarray (float32)
+        The rebinned sinograms (with the shape of `sinograms`), in STIR order
+    """
+    if num_segments_to_combine % 2 != 1:
+        raise ValueError(
+            "Number of segments to combine must be odd ({} given)"
+            .format(num_segments_to_combine))
+    if num_views % view_mash:
+        raise ValueError(
+            "View mash ({}) must divide the number of views ({})"
+            .format(view_mash, num_views))
+    sinograms = np.asarray(sinograms)
+    frames = sinograms.reshape(-1, sinograms.shape[-1])
+    num_frames = frames.shape[0]
+    planes = dict(zip(segment_numbers(len(segment_planes)), segment_planes))
+    max_planes = planes[0]
+    groups = segment_groups(num_segments_to_combine, segment_planes)
+    offsets = np.cumsum([0] + [planes[s] * num_views * num_tangential
+                               for s in sorted(planes)])
+    offsets = dict(zip(sorted(planes), offsets))
+    num_mashed = num_views // view_mash
+    rebinned = []
+    for group in sorted(groups):
+        num_out = max(planes[s] for s in groups[group])
+        out_start = (max_planes - num_out) // 2
+        out = np.zeros((num_frames, num_mashed, num_out, num_tangential),
+                       dtype=np.float32)
+        added = np.zeros(num_out)
+        for segment in groups[group]:
+            num_planes = planes[segment]
+            start = (max_planes - num_planes) // 2 - out_start
+            data = frames[:, offsets[segment]:offsets[segment] + num_planes *
+                          num_views * num_tangential].reshape(
+                num_frames, num_mashed, view_mash, num_planes, num_tangential)
+            out[:, :, start:start + num_planes] += data.sum(
+                axis=2, dtype=np.float32)
+            added[start:start + num_planes] += view_mash
+        if normalise:
+            out /= added[:, None].astype(np.float32)
+        rebinned.append(out.reshape(num_frames, -1))
+    rebinned = np.concatenate(rebinned, axis=1)
+    return rebinned.reshape(sinograms.shape[:-1] + rebinned.shape[-1:])
@@ -0,0 +1,160 @@
+import os
+import os.path as op
+import glob
+import numpy as np
+from banana.utils.real_clock import RealClock
+
+
+BINARY_EXTS = ('.npy', '.npz')
+MAT_EXTS = ('.txt', '.mat', '.npy')
+
+
+def array_ext(binary):
+    return '.npy' if binary else '.txt'
+
+
+def save_array(basename, array, binary=False, fmt='%s'):
+    """
+    Saves an array produced by the motion detection pipeline, either in
+    binary (.npy) or in text format
+
+    Parameters
+    ----------
+    basename : str
+        Path of the file to save without extension
+    array : array-like
+        The array to save
+    binary : bool
+        Whether to save the array in .npy format instead of text
+    fmt : str
+        The format passed to np.savetxt when saving in text format
+
+    Returns
+    -------
+    fname : str
+        The path of the saved file
+    """
+    fname = basename + array_ext(binary)
+    if binary:
+        np.save(fname, np.asarray(array))
+    else:
+        np.savetxt(fname, np.asarray(array), fmt=fmt)
+    return fname
+
+
+def load_array(fname, dtype=None, mmap=True):
+    """
+    Loads an array saved by `save_array`. Binary files are memory-mapped
+    (unless mmap is False) so only the parts that are accessed are read from
+    disk, while text files are parsed with np.loadtxt
+
+    Parameters
+    ----------
+    fname : str
+        Path of the .npy or text file
+    dtype : type
+        The type of the array to return. For text files this is passed to
+        np.loadtxt
+    mmap : bool
+        Whether to memory-map binary files
+    """
+    if fname.endswith('.npy'):
+        array = np.load(fname, mmap_mode=('r' if mmap else None))
+        if dtype is not None and array.dtype != np.dtype(dtype):
+            array = array.astype(dtype)
+        return array
+    if dtype is None:
+        dtype = float
+    return np.loadtxt(fname, dtype=dtype)
+
+
+def list_mats(directory):
+    """Returns the sorted list of matrix files (text or .npy) in a
+    directory"""
+    mats = []
+    for ext in MAT_EXTS:
+        mats.extend(glob.glob(op.join(directory, '*' + ext)))
+    return sorted(mats)
+
+
+def export_text(fname, out_fname=None, fmt='%s'):
+    """
+    Exports a binary file saved by the motion detection pipeline into its
+    text equivalent. Real clock intervals (.npz) are saved in the text format
+    of RealClock.save, while plain arrays are saved with np.savetxt
+
+    Parameters
+    ----------
+    fname : str
+        Path of the .npy or .npz file
+    out_fname : str
+        Path of the output text file. Defaults to the input path with a
+        '.txt' extension
+    fmt : str
+        The format passed to np.savetxt for plain arrays
+
+    Returns
+    -------
+    out_fname : str
+        Path to the exported text file
+    """
+    base, ext = op.splitext(fname)
+    if out_fname is None:
+        out_fname = base + '.txt'
+    if ext == '.npz':
+        RealClock.load(fname).save(out_fname)
+    elif ext == '.npy':
+        array = np.load(fname, mmap_mode='r')
+        if array.ndim > 2:
+            array = array.reshape(-1, array.shape[-1])
+        np.savetxt(out_fname, array, fmt=fmt)
+    else:
+        raise ValueError(
+            "Unrecognised binary extension '{}' of {}".format(ext, fname))
+    return out_fname
+
+
+def export_text_dir(directory, out_dir):
+    """Exports all the binary matrices within a directory into text files in
+    `out_dir`, using the default np.savetxt format used for the text
+    matrices"""
+    if not op.isdir(out_dir):
+        os.mkdir(out_dir)
+    out_fnames = []
+    for fname in sorted(os.listdir(directory)):
+        base, ext = op.splitext(fname)
+        if ext in BINARY_EXTS:
+            out_fnames.append(export_text(
+                op.join(directory, fname), op.join(out_dir, base + '.txt'),
+                fmt='%.18e'))
+    return out_fnames
+
+
+def save_timestamps(timestamps, out_dir='timestamps'):
+    """
+    Saves the start times of the frames detected by the motion detection in
+    `out_dir`: all of them in frame_start_times_4PET.txt and the start and
+    end of each frame in timestamps_FrameXXX.txt, which are used to frame the
+    PET data
+
+    Parameters
+    ----------
+    timestamps : list(str)
+        The start times ('%H%M%S.%f') of the frames followed by the end time
+        of the last one
+    out_dir : str
+        The directory to create
+
+    Returns
+    -------
+    out_dir : str
+        Path to the directory
+    """
+    os.mkdir(out_dir)
+    np.savetxt(op.join(out_dir, 'frame_start_times_4PET.txt'),
+               np.asarray(timestamps), fmt='%s')
+    for i in range(len(timestamps)-1):
+        with open(op.join(out_dir, 'timestamps_Frame{}.txt'
+                          .format(str(i).zfill(3))), 'w') as f:
+            f.write(timestamps[i]+'\n'+timestamps[i+1])
+    return op.abspath(out_dir)
@@ -0,0 +1,93 @@
+import os
+import os.path as op
+import glob
+import fnmatch
+import numpy as np
+
+
+class MotionMatStack(object):
+    """
+    Stack of 4x4 motion (affine) matrices stored in a single file, as an
+    alternative to a directory with one text file per volume (i.e. the
+    'motion_mats' format). Each matrix is stored together with the name of
+    the file it would have in the directory format (without extension).
+
+    Parameters
+    ----------
+    mats : array-like (N, 4, 4)
+        The motion matrices
+    names : list(str)
+        Name of each matrix, e.g. 'MAT_0000_motion_mat_inv'
+    """
+
+    EXT = '.mats.npz'
+    MAT_EXT = '.mat'
+
+    def __init__(self, mats, names):
+        self.mats = np.asarray(mats, dtype=float).reshape(-1, 4, 4)
+        self.names = np.asarray(names, dtype=str).reshape(-1)
+        if len(self.mats) != len(self.names):
+            raise ValueError(
+                "Number of matrices ({}) and names ({}) do not match"
+                .format(len(self.mats), len(self.names)))
+
+    def __len__(self):
+        return len(self.mats)
+
+    def __iter__(self):
+        return iter(zip(self.names, self.mats))
+
+    def __getitem__(self, name):
+        try:
+            return self.mats[list(self.names).index(name)]
+        except ValueError:
+            raise KeyError(name)
+
+    def select(self, pattern):
+        """Returns a new stack with the matrices whose name matches the glob
+        pattern, e.g. '*inv' to select the inverse matrices, sorted by name
+        as they would be in the directory format"""
+        indices = [i for i, n in enumerate(self.names)
+                   if fnmatch.fnmatch(n, pattern)]
+        indices = sorted(indices, key=lambda i: self.names[i])
+        return MotionMatStack(self.mats[indices], self.names[indices])
+
+    @classmethod
+    def concatenate(cls, stacks):
+        return cls(np.concatenate([s.mats for s in stacks]),
+                   np.concatenate([s.names for s in stacks]))
+
+    def save(self, fname):
+        """Saves the stack in a single .npz file. The '.mats.npz' extension is
+        appended if `fname` does not already have it"""
+        if not fname.endswith(self.EXT):
+            fname += self.EXT
+        np.savez(fname, mats=self.mats, names=self.names)
+        return fname
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as bundle:
+            return cls(bundle['mats'], bundle['names'])
+
+    @classmethod
+    def from_dir(cls, directory, pattern='*.mat'):
+        """Loads all the text matrices matching `pattern` (default '*.mat')
+        within a directory in the motion_mats format"""
+        fnames = sorted(f for f in glob.glob(op.join(directory, pattern))
+                        if op.isfile(f))
+        mats = [np.loadtxt(f) for f in fnames]
+        names = [op.splitext(op.basename(f))[0] for f in fnames]
+        return cls(mats, names)
+
+    def to_dir(self, directory, fmt='%.18e'):
+        """Saves each matrix in a separate text file within `directory`, i.e.
+        converts the stack into the motion_mats format"""
+        if not op.isdir(directory):
+            os.makedirs(directory)
+        fnames = []
+        for name, mat in self:
+            fname = op.join(directory, name + self.MAT_EXT)
+            np.savetxt(fname, mat, fmt=fmt)
+            fnames.append(fname)
+        return fnames
@@ -0,0 +1,249 @@
+import re
+import datetime as dt
+import numpy as np
+
+
+def time2us(time_str):
+    "Converts a '%H%M%S.%f' time string into microseconds from midnight"
+    t = dt.datetime.strptime(time_str, '%H%M%S.%f')
+    return (((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 +
+            t.microsecond)
+
+
+def seconds2us(seconds):
+    """Converts an array of seconds into integer microseconds, rounding them
+    as datetime.timedelta does. Only the unique values are converted"""
+    unique, inverse = np.unique(seconds, return_inverse=True)
+    unique_us = np.array(
+        [dt.timedelta(seconds=float(x)) // dt.timedelta(microseconds=1)
+         for x in unique], dtype=np.int64)
+    return unique_us[inverse].reshape(np.shape(seconds))
+
+
+class RealClock(object):
+    """
+    Interval-encoded ("run-length") representation of a quantity that is
+    defined for every millisecond of a study, e.g. the mean displacement or
+    the motion parameters. Instead of storing one sample per millisecond,
+    only the interval covered by each scan/volume and the corresponding
+    value are stored. Milliseconds that are not covered by any interval are
+    MR idling time and take the value of the last scanned millisecond before
+    them, as in the dense arrays previously produced by the motion detection
+    pipeline. If two intervals overlap, the later one takes precedence.
+
+    Parameters
+    ----------
+    starts : array-like (N,)
+        Start of each interval in milliseconds from the study start
+    ends : array-like (N,)
+        End (exclusive) of each interval in milliseconds
+    values : array-like (N,) or (N, K)
+        Value(s) associated to each interval
+    length : int
+        Total length of the study in milliseconds. Default is the end of the
+        last interval
+    """
+
+    FILL_VALUE = -1
+
+    def __init__(self, starts, ends, values, length=None):
+        self.starts = np.asarray(starts, dtype=int)
+        self.ends = np.asarray(ends, dtype=int)
+        self.values = np.asarray(values, dtype=float)
+        if length is None:
+            length = int(self.ends.max()) if len(self.ends) else 0
+        self.length = int(length)
+        self._segs = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def ndim(self):
+        return self.values.ndim
+
+    def select(self, columns):
+        "Returns a new RealClock with only the selected value columns"
+        return RealClock(self.starts, self.ends, self.values[:, columns],
+                         length=self.length)
+
+    def segments(self):
+        """Splits the timeline into non-overlapping segments, which are
+        delimited by the start and end points of all the intervals and the
+        study length
+
+        Returns
+        -------
+        seg_starts : np.ndarray (M,)
+            Start of each segment in milliseconds
+        seg_ends : np.ndarray (M,)
+            End (exclusive) of each segment in milliseconds
+        owner : np.ndarray (M,)
+            Index of the interval that defines the value of each segment, or
+            -1 for segments of idling time
+        """
+        if self._segs is None:
+            bounds = np.unique(np.clip(
+                np.concatenate(([0, self.length], self.starts, self.ends)),
+                0, self.length))
+            owner = np.zeros(len(bounds) - 1, dtype=int) - 1
+            first = np.searchsorted(bounds, np.clip(self.starts, 0,
+                                                    self.length))
+            last = np.searchsorted(bounds, np.clip(self.ends, 0,
+                                                   self.length))
+            # Later intervals overwrite earlier ones where they overlap
+            for i, (f, l) in enumerate(zip(first, last)):
+                owner[f:l] = i
+            self._segs = (bounds[:-1], bounds[1:], owner)
+        return self._segs
+
+    def idle_periods(self):
+        """Returns the (start, end) of the periods in milliseconds where the
+        scanner was idling, i.e. not covered by any interval, as an (P, 2)
+        array"""
+        seg_starts, seg_ends, owner = self.segments()
+        idle = owner < 0
+        if not idle.any():
+            return np.zeros((0, 2), dtype=int)
+        # Merge contiguous idle segments
+        idle_starts = seg_starts[idle]
+        idle_ends = seg_ends[idle]
+        new_period = np.ones(len(idle_starts), dtype=bool)
+        new_period[1:] = idle_starts[1:] != idle_ends[:-1]
+        period_ind = np.cumsum(new_period) - 1
+        ends = np.zeros(period_ind[-1] + 1, dtype=int)
+        ends[period_ind] = idle_ends
+        return np.stack((idle_starts[new_period], ends), axis=1)
+
+    def _filled_owner(self):
+        "Owner of each segment after forward-filling the idle segments"
+        _, _, owner = self.segments()
+        pos = np.where(owner >= 0, np.arange(len(owner)), -1)
+        pos = np.maximum.accumulate(pos) if len(pos) else pos
+        return np.where(pos >= 0, owner[np.maximum(pos, 0)], -1)
+
+    def _segment_values(self):
+        filled = self._filled_owner()
+        if self.values.ndim == 1:
+            shape = (len(filled),)
+        else:
+            shape = (len(filled), self.values.shape[1])
+        seg_values = np.full(shape, self.FILL_VALUE, dtype=float)
+        seg_values[filled >= 0] = self.values[filled[filled >= 0]]
+        return seg_values
+
+    def expand(self, start=0, stop=None):
+        """Lazily expands the interval representation into the dense (one
+        sample per millisecond) array for the window [start, stop) only.
+
+        Parameters
+        ----------
+        start : int
+            First millisecond of the window
+        stop : int
+            Millisecond at which the window ends (exclusive). Default is the
+            study length
+
+        Returns
+        -------
+        dense : np.ndarray
+            Array of shape (stop-start,) or (stop-start, K)
+        """
+        if stop is None:
+            stop = self.length
+        start = max(int(start), 0)
+        stop = min(int(stop), self.length)
+        seg_starts, seg_ends, _ = self.segments()
+        first = np.searchsorted(seg_ends, start, side='right')
+        last = np.searchsorted(seg_starts, stop, side='left')
+        repeats = (np.minimum(seg_ends[first:last], stop) -
+                   np.maximum(seg_starts[first:last], start))
+        return np.repeat(self._segment_values()[first:last],
+                         np.maximum(repeats, 0), axis=0)
+
+    def iter_expand(self, chunk_size=600000):
+        """Yields the dense array in chunks of `chunk_size` milliseconds
+        (default 10 minutes) so that it never has to be held in memory in
+        full"""
+        for start in range(0, self.length, chunk_size):
+            yield self.expand(start, start + chunk_size)
+
+    def to_dense(self):
+        """Returns the full dense array with one sample per millisecond, as
+        (length,) or (K, length) to match the layout of the previous
+        mean_displacement_rc and motion_par_rc arrays"""
+        return self.expand().T
+
+    def step_coords(self):
+        """Returns the coordinates needed to plot the real clock timeline as
+        a step function without expanding it
+
+        Returns
+        -------
+        scan_steps : list(tuple(np.ndarray, np.ndarray))
+            (x, y) coordinates for each contiguous block of scanning time
+        idle_steps : list(tuple(np.ndarray, np.ndarray))
+            (x, y) coordinates for each period of idling time, joining the
+            last value before the period with the first value after it
+        """
+        seg_starts, seg_ends, owner = self.segments()
+        seg_values = self._segment_values()
+        scan_steps = []
+        idle_steps = []
+        idle = owner < 0
+        # Split the segments into contiguous blocks of scan and idling time
+        breaks = np.where(idle[1:] != idle[:-1])[0] + 1
+        blocks = np.split(np.arange(len(owner)), breaks)
+        for i, block in enumerate(blocks):
+            if not len(block):
+                continue
+            if not idle[block[0]]:
+                x = np.stack((seg_starts[block],
+                              seg_ends[block] - 1), axis=1).ravel()
+                y = np.repeat(seg_values[block], 2, axis=0)
+                scan_steps.append((x, y))
+            elif block[0] > 0:
+                gap_start = seg_starts[block[0]] - 1
+                gap_end = seg_ends[block[-1]] - 1
+                prev_value = seg_values[block[0] - 1]
+                if i < len(blocks) - 1:
+                    next_block = blocks[i + 1]
+                    x = np.array([gap_start, gap_end, gap_end + 1])
+                    y = np.stack((prev_value, prev_value,
+                                  seg_values[next_block[0]]))
+                else:
+                    x = np.array([gap_start, gap_end])
+                    y = np.stack((prev_value, prev_value))
+                idle_steps.append((x, y))
+        return scan_steps, idle_steps
+
+    def save(self, fname):
+        """Saves the intervals to file. If the file name ends with '.npz' the
+        intervals are saved as a binary NumPy bundle, otherwise in a text
+        file with one row per interval (start, end, value(s)), with the study
+        length stored in the header"""
+        if fname.endswith('.npz'):
+            np.savez(fname, starts=self.starts, ends=self.ends,
+                     values=self.values, length=self.length)
+            return
+        values = self.values.reshape(len(self.values), -1)
+        table = np.column_stack((self.starts, self.ends, values))
+        np.savetxt(fname, table,
+                   fmt=['%d', '%d'] + ['%s'] * values.shape[1],
+                   header='length {}'.format(self.length))
+
+    @classmethod
+    def load(cls, fname):
+        if fname.endswith('.npz'):
+            with np.load(fname) as bundle:
+                return cls(bundle['starts'], bundle['ends'], bundle['values'],
+                           length=int(bundle['length']))
+        with open(fname) as f:
+            header = f.readline()
+        match = re.match(r'#\s*length\s+(\d+)', header)
+        length = int(match.group(1)) if match is not None else None
+        table = np.loadtxt(fname, ndmin=2)
+        values = table[:, 2:]
+        if values.shape[1] == 1:
+            values = values[:, 0]
+        return cls(table[:, 0], table[:, 1], values, length=length)
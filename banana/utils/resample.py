@@ -0,0 +1,154 @@
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+
+INTERP_ORDERS = {'nearestneighbour': 0, 'trilinear': 1}
+
+
+def fsl_scaling_matrix(img):
+    """
+    Returns the matrix mapping voxel indices of an image into the "scaled
+    voxel" coordinates used by FSL matrices (i.e. FLIRT), where voxel indices
+    are multiplied by the voxel sizes and the x-axis is flipped if the
+    voxel-to-world matrix of the image has a positive determinant
+    (neurological orientation)
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        The image the matrix refers to
+
+    Returns
+    -------
+    scaling : np.ndarray (4, 4)
+        The voxel to FSL coordinates matrix
+    """
+    zooms = img.header.get_zooms()[:3]
+    scaling = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scaling = np.dot(scaling, flip)
+    return scaling
+
+
+def fsl2vox(fsl_mat, in_img, ref_img):
+    """
+    Converts an FSL (FLIRT) matrix, mapping the coordinates of `in_img` into
+    the ones of `ref_img`, into the matrix mapping the voxel indices of
+    `ref_img` into the voxel indices of `in_img`, as required by
+    scipy.ndimage.affine_transform. FSL matrices can be chained before
+    converting them, e.g. the matrix of applying A and then B is
+    np.dot(B, A)
+
+    Parameters
+    ----------
+    fsl_mat : np.ndarray (4, 4)
+        The FSL matrix
+    in_img : nibabel.Nifti1Image
+        Image to resample
+    ref_img : nibabel.Nifti1Image
+        Image defining the output space
+
+    Returns
+    -------
+    vox_mat : np.ndarray (4, 4)
+        The voxel-to-voxel matrix from the output to the input image
+    """
+    return np.dot(np.linalg.inv(fsl_scaling_matrix(in_img)),
+                  np.dot(np.linalg.inv(fsl_mat),
+                         fsl_scaling_matrix(ref_img)))
+
+
+def resample(data, vox_mat, out_shape, interp='trilinear'):
+    """
+    Resamples a 3D volume, or each volume of a 4D series, with a voxel-to-voxel
+    matrix. Voxels falling outside of the input field of view are set to 0
+    as in FLIRT. All the volumes are kept in memory.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        3D or 4D array to resample
+    vox_mat : np.ndarray (4, 4)
+        Matrix mapping output voxel indices into input voxel indices (see
+        fsl2vox)
+    out_shape : tuple(int)
+        The shape of the output (3D) volume(s)
+    interp : str
+        Either 'trilinear' or 'nearestneighbour'
+
+    Returns
+    -------
+    resampled : np.ndarray
+        The resampled array, with the same data type as `data`
+    """
+    try:
+        order = INTERP_ORDERS[interp]
+    except KeyError:
+        raise ValueError(
+            "Unrecognised interpolation '{}', can be one of '{}'"
+            .format(interp, "', '".join(INTERP_ORDERS)))
+    out_shape = tuple(out_shape[:3])
+    volumes = data if data.ndim == 4 else data[..., None]
+    resampled = np.empty(out_shape + volumes.shape[3:], dtype=float)
+    for i in range(volumes.shape[3]):
+        ndimage.affine_transform(
+            np.asarray(volumes[..., i], dtype=float), vox_mat[:3, :3],
+            offset=vox_mat[:3, 3], output_shape=out_shape,
+            output=resampled[..., i], order=order, mode='constant', cval=0.0)
+    if data.ndim != 4:
+        resampled = resampled[..., 0]
+    if np.issubdtype(data.dtype, np.integer):
+        resampled = np.rint(resampled)
+    return resampled.astype(data.dtype)
+
+
+def apply_fsl_xfm(in_img, ref_img, fsl_mat, interp='trilinear'):
+    """
+    In-memory equivalent of FLIRT -applyxfm: resamples `in_img` into the space
+    of `ref_img` using an FSL matrix
+
+    Parameters
+    ----------
+    in_img : nibabel.Nifti1Image | str
+        Image (or path to the image) to resample
+    ref_img : nibabel.Nifti1Image | str
+        Image (or path to the image) defining the output space
+    fsl_mat : np.ndarray (4, 4) | str
+        FSL matrix (or path to the text file containing it)
+    interp : str
+        Either 'trilinear' or 'nearestneighbour'
+
+    Returns
+    -------
+    out_img : nibabel.Nifti1Image
+        The resampled image, with the header of the reference image
+    """
+    if isinstance(in_img, str):
+        in_img = nib.load(in_img)
+    if isinstance(ref_img, str):
+        ref_img = nib.load(ref_img)
+    if isinstance(fsl_mat, str):
+        fsl_mat = np.loadtxt(fsl_mat)
+    data = np.asanyarray(in_img.dataobj)
+    resampled = resample(data, fsl2vox(fsl_mat, in_img, ref_img),
+                         ref_img.shape, interp=interp)
+    header = ref_img.header.copy()
+    header.set_data_dtype(resampled.dtype)
+    if resampled.ndim == 4:
+        header.set_data_shape(resampled.shape)
+        header.set_zooms(ref_img.header.get_zooms()[:3] +
+                         in_img.header.get_zooms()[3:4])
+    return nib.Nifti1Image(resampled, ref_img.affine, header)
+
+
+def apply_fsl_xfm_file(in_file, ref_file, mat_file, out_file,
+                       interp='trilinear'):
+    """Resamples an image file and saves the result, so it can be used as a
+    worker function in a process pool"""
+    nib.save(apply_fsl_xfm(in_file, ref_file, mat_file, interp=interp),
+             out_file)
+    return out_file
@@ -0,0 +1,148 @@
+import re
+from collections import OrderedDict
+from functools import lru_cache
+import pydicom
+import nibabel.nicom.csareader as csareader
+from banana.utils.header import file_signature
+
+
+ASCCONV_BEGIN = '### ASCCONV BEGIN'
+ASCCONV_END = '### ASCCONV END'
+INTERFILE_BEGIN = '!INTERFILE'
+
+# Names of the CSA series header element containing the protocol
+PROTOCOL_CSA_NAMES = ('MrPhoenixProtocol', 'MrProtocol')
+# Private groups where the protocol (or the Interfile header of PET data) can
+# be stored as text, e.g. (0021,1019) in XA enhanced DICOMs
+PRIVATE_GROUPS = (0x0021, 0x0029)
+
+
+def read_header(dicom):
+    "Reads the header of a DICOM file without the pixel data"
+    if isinstance(dicom, pydicom.Dataset):
+        return dicom
+    return pydicom.dcmread(dicom, stop_before_pixels=True)
+
+
+def parse_ascconv(text):
+    """
+    Parses the ASCII block ('### ASCCONV BEGIN ###' ... '### ASCCONV END
+    ###') of a Siemens protocol into a dictionary
+
+    Parameters
+    ----------
+    text : str
+        The protocol text
+
+    Returns
+    -------
+    params : OrderedDict(str, str)
+        The (unconverted) value of each parameter, e.g.
+        params['alTR[0]'] = '2000000'
+    """
+    params = OrderedDict()
+    start = text.find(ASCCONV_BEGIN)
+    if start < 0:
+        return params
+    end = text.find(ASCCONV_END, start)
+    if end < 0:
+        end = len(text)
+    for line in text[start:end].splitlines()[1:]:
+        if '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        # Strip trailing comments (but not '#' within strings)
+        value = re.sub(r'\s+#.*$', '', value)
+        params[name.strip()] = value.strip()
+    return params
+
+
+def parse_interfile(text):
+    """Parses an Interfile header (e.g. of Siemens PET list-mode data) into a
+    dictionary of the (unconverted) values of its 'key := value' lines"""
+    params = OrderedDict()
+    for line in text.splitlines():
+        if ':=' not in line:
+            continue
+        name, value = line.split(':=', 1)
+        params[name.strip().lstrip('%!')] = value.strip()
+    return params
+
+
+def private_texts(hdr, marker):
+    """Yields the text of the private elements of the header containing
+    `marker`"""
+    marker = marker.encode('latin-1')
+    for elem in hdr:
+        if elem.tag.group not in PRIVATE_GROUPS:
+            continue
+        value = elem.value
+        if isinstance(value, str):
+            value = value.encode('latin-1', 'replace')
+        if isinstance(value, bytes) and marker in value:
+            yield value.decode('latin-1')
+
+
+def protocol_text(hdr):
+    """Returns the text of the Siemens protocol from the CSA series header
+    or, if it is not there, from the other private elements of the header"""
+    try:
+        csa = csareader.get_csa_header(hdr, 'series')
+    except csareader.CSAError:
+        csa = None
+    if csa is not None:
+        for name in PROTOCOL_CSA_NAMES:
+            try:
+                return csa['tags'][name]['items'][0]
+            except (KeyError, IndexError):
+                pass
+    for text in private_texts(hdr, ASCCONV_BEGIN):
+        return text
+    return ''
+
+
+def phoenix_protocol(dicom):
+    """
+    Reads the parameters of the Siemens MrPhoenixProtocol of a DICOM file,
+    only reading the header. The results are cached so that the protocol of
+    a file is parsed once
+
+    Parameters
+    ----------
+    dicom : str | pydicom.Dataset
+        Path to the DICOM file or its header
+
+    Returns
+    -------
+    params : OrderedDict(str, str)
+        The parameters in the ASCCONV block of the protocol (empty if there
+        is no protocol in the header)
+    """
+    if isinstance(dicom, pydicom.Dataset):
+        return parse_ascconv(protocol_text(dicom))
+    return OrderedDict(cached_protocol(file_signature(dicom)))
+
+
+@lru_cache(maxsize=1024)
+def cached_protocol(signature):
+    return parse_ascconv(protocol_text(read_header(signature[0])))
+
+
+def interfile_header(dicom):
+    """Reads the Interfile header stored in the private elements of a
+    Siemens PET DICOM (e.g. the one accompanying the list-mode data)"""
+    hdr = read_header(dicom)
+    for text in private_texts(hdr, INTERFILE_BEGIN):
+        return parse_interfile(text)
+    return OrderedDict()
+
+
+def find_value(params, name, default=None):
+    """Returns the value of the last parameter whose name contains `name`,
+    e.g. find_value(params, 'TotalScan') returns the value of
+    'lTotalScanTimeSec'"""
+    value = default
+    for key, val in params.items():
+        if name in key:
+            value = val
+    return value
@@ -0,0 +1,382 @@
+import math
+import numpy as np
+
+
+# Radius (mm) of the sphere used by FSL's rmsdiff
+RMS_RADIUS = 80
+
+
+def as_stack(mats):
+    """Returns the matrices as a (N, 4, 4) (or (N, 3, 3)) float array, adding
+    the leading dimension to a single matrix"""
+    mats = np.asarray(mats, dtype=float)
+    if mats.ndim == 2:
+        mats = mats[None]
+    return mats
+
+
+def compose(*mats):
+    """
+    Composes stacks of matrices, i.e. compose(A, B, C) returns A.B.C for each
+    matrix in the stacks. Single (4, 4) matrices are broadcast against the
+    stacks
+
+    Parameters
+    ----------
+    mats : np.ndarray (N, 4, 4) | (4, 4)
+        The stacks of matrices to compose, in the order they are multiplied
+
+    Returns
+    -------
+    composed : np.ndarray (N, 4, 4)
+        The composed matrices
+    """
+    composed = np.asarray(mats[0], dtype=float)
+    for mat in mats[1:]:
+        composed = np.matmul(composed, mat)
+    return composed
+
+
+def invert(mats):
+    "Inverts each matrix of a (N, 4, 4) stack"
+    return np.linalg.inv(mats)
+
+
+def motion_mats(concats, qform):
+    """
+    Calculates the motion matrices (and their inverses) in scanner
+    coordinates from the registration matrices of each volume, as done by
+    MotionMatCalculation
+
+    Parameters
+    ----------
+    concats : np.ndarray (N, 4, 4)
+        The registration (FSL) matrices of each volume
+    qform : np.ndarray (4, 4)
+        The qform of the reference image
+
+    Returns
+    -------
+    mats : np.ndarray (N, 4, 4)
+        The motion matrices
+    mats_inv : np.ndarray (N, 4, 4)
+        Their inverses
+    """
+    mats = np.matmul(qform, invert(as_stack(concats)))
+    return mats, invert(mats)
+
+
+def rmsdiff(cog, T1, T2=None, radius=RMS_RADIUS):
+    """
+    Python implementation of the rmsdiff function in FSL, which calculates
+    the RMS deviation between two stacks of (N, 4, 4) matrices within a sphere
+    centred in the centre of gravity
+
+    Parameters
+    ----------
+    cog : array-like (3,)
+        The centre of gravity of the reference image
+    T1 : np.ndarray (N, 4, 4)
+        The first stack of matrices
+    T2 : np.ndarray (N, 4, 4) | None
+        The second stack of matrices. If not provided the identity is used,
+        i.e. the displacement with respect to the reference is returned
+    radius : float
+        Radius of the sphere in mm
+
+    Returns
+    -------
+    rms : np.ndarray (N,)
+        The RMS deviations
+    """
+    M = invert(as_stack(T1))
+    if T2 is not None:
+        M = np.matmul(T2, M)
+    M = M-np.identity(4)
+    A = M[:, :3, :3]
+    t = M[:, :3, 3]
+    Tr = np.einsum('nii->n', np.matmul(A.transpose(0, 2, 1), A))
+    III = t+np.matmul(A, cog)
+    cost = Tr*radius**2/5
+    return np.sqrt(
+        cost + np.matmul(III[:, None, :], III[:, :, None])[:, 0, 0])
+
+
+def is_rotation(R, tol=1e-4):
+    "Checks whether each matrix of a (N, 3, 3) stack is a rotation matrix"
+    R = as_stack(R)
+    n = np.linalg.norm(np.identity(3)-np.matmul(R.transpose(0, 2, 1), R),
+                       axis=(1, 2))
+    return n < tol
+
+
+def euler_angles(R):
+    """
+    Decomposes a stack of (N, 3, 3) rotation matrices into the (N, 3) rotation
+    angles (in radians) about the x, y and z axes, following the convention
+    of FSL's avscale
+
+    Parameters
+    ----------
+    R : np.ndarray (N, 3, 3)
+        The rotation matrices
+
+    Returns
+    -------
+    angles : np.ndarray (N, 3)
+        The rotations about x, y and z
+    """
+    R = as_stack(R)
+    if not is_rotation(R).all():
+        raise ValueError("Not all the matrices are rotation matrices")
+    # math.atan2 is used instead of np.arctan2, which can differ in the
+    # last bit, so that the angles match the per-matrix calculation
+    atan2 = np.frompyfunc(math.atan2, 2, 1)
+    cy = np.sqrt(R[:, 0, 0]*R[:, 0, 0]+R[:, 0, 1]*R[:, 0, 1])
+    singular = cy < 1e-4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(singular, atan2(-R[:, 2, 1], R[:, 1, 1]),
+                     atan2(R[:, 1, 2]/cy, R[:, 2, 2]/cy))
+        y = np.where(singular, atan2(-R[:, 0, 2], 0.0),
+                     atan2(-R[:, 0, 2], cy))
+        z = np.where(singular, 0.0, atan2(R[:, 0, 1]/cy, R[:, 0, 0]/cy))
+    return np.stack((x, y, z), axis=1).astype(float)
+
+
+def decompose(mats, cog, res=(1, 1, 1)):
+    """
+    Python implementation of the avscale function in FSL for rigid body
+    transformations (i.e. assuming there are no scales or skews). Returns the
+    rotations and the translations about the centre of gravity
+
+    Parameters
+    ----------
+    mats : np.ndarray (N, 4, 4)
+        The rigid body matrices
+    cog : array-like (3,)
+        The centre of gravity (in voxels)
+    res : array-like (3,)
+        The voxel sizes used to convert the centre of gravity into mm
+
+    Returns
+    -------
+    params : np.ndarray (N, 6)
+        Rotations about x, y and z (radians) followed by the translations
+        along x, y and z (mm)
+    """
+    mats = as_stack(mats)
+    centre = np.asarray(cog)*res
+    rot_mats = mats[:, :3, :3]
+    rots = euler_angles(rot_mats)
+    trans = np.matmul(rot_mats, centre)+mats[:, :3, -1]-centre
+    return np.concatenate((rots, trans), axis=1)
+
+
+def params2mat(params, cog):
+    """
+    Creates the rigid body matrices from the motion parameters estimated by
+    eddy, i.e. 3 translations (mm) followed by 3 rotations (radians) about
+    the centre of gravity
+
+    Parameters
+    ----------
+    params : np.ndarray (N, 6)
+        The motion parameters
+    cog : array-like (3,)
+        The centre of gravity in mm
+
+    Returns
+    -------
+    mats : np.ndarray (N, 4, 4)
+        The affine matrices
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=float))[:, :6]
+    n = len(params)
+    cos = np.cos(params[:, 3:])
+    sin = np.sin(params[:, 3:])
+    Rx = np.tile(np.eye(3), (n, 1, 1))
+    Rx[:, 1, 1] = cos[:, 0]
+    Rx[:, 1, 2] = sin[:, 0]
+    Rx[:, 2, 1] = -sin[:, 0]
+    Rx[:, 2, 2] = cos[:, 0]
+    Ry = np.tile(np.eye(3), (n, 1, 1))
+    Ry[:, 0, 0] = cos[:, 1]
+    Ry[:, 0, 2] = -sin[:, 1]
+    Ry[:, 2, 0] = sin[:, 1]
+    Ry[:, 2, 2] = cos[:, 1]
+    Rz = np.tile(np.eye(3), (n, 1, 1))
+    Rz[:, 0, 0] = cos[:, 2]
+    Rz[:, 0, 1] = sin[:, 2]
+    Rz[:, 1, 0] = -sin[:, 2]
+    Rz[:, 1, 1] = cos[:, 2]
+    mats = np.tile(np.eye(4), (n, 1, 1))
+    mats[:, :3, :3] = compose(Rx, Ry, Rz)
+    mats[:, :3, 3] = params[:, :3]
+    # Move the centre of rotation to the centre of gravity
+    T = np.eye(4)
+    T[:3, -1] = cog[:3]
+    mats[:, :3, 3] = np.matmul(T, np.matmul(mats, invert(T)))[:, :3, -1]
+    return mats
+
+
+def rad2degree(alpha_rad):
+    return alpha_rad*180/np.pi
+
+
+def fsl2moco(params):
+    """
+    Converts rigid body motion parameters from the FSL convention (rotations
+    in radians followed by translations, see `decompose`) into the Siemens
+    moco series one (translations followed by rotations in degrees, with
+    x and y swapped)
+
+    Parameters
+    ----------
+    params : np.ndarray (N, 6)
+        Motion parameters in the FSL convention
+
+    Returns
+    -------
+    moco_params : np.ndarray (N, 6)
+        Motion parameters in the moco convention
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    return np.stack((-params[:, 4], params[:, 3], -params[:, 5],
+                     -rad2degree(params[:, 1]), rad2degree(params[:, 0]),
+                     -rad2degree(params[:, 2])), axis=1)
+
+
+def moco2fsl(moco_params):
+    "Inverse of `fsl2moco`"
+    moco_params = np.atleast_2d(np.asarray(moco_params, dtype=float))
+    deg2rad = np.pi/180
+    return np.stack((moco_params[:, 4]*deg2rad, -moco_params[:, 3]*deg2rad,
+                     -moco_params[:, 5]*deg2rad, moco_params[:, 1],
+                     -moco_params[:, 0], -moco_params[:, 2]), axis=1)
+
+
+def rotation2quaternion(R):
+    """
+    Converts a stack of (N, 3, 3) rotation matrices into unit quaternions
+    (w, x, y, z), as the eigenvector with the largest eigenvalue of the
+    symmetric matrix of Bar-Itzhack (2000). This is robust to matrices that
+    are only approximately orthonormal
+
+    Parameters
+    ----------
+    R : np.ndarray (N, 3, 3)
+        The rotation matrices
+
+    Returns
+    -------
+    quaternions : np.ndarray (N, 4)
+        The unit quaternions (the sign is arbitrary)
+    """
+    R = as_stack(R)
+    xx, xy, xz = R[:, 0, 0], R[:, 0, 1], R[:, 0, 2]
+    yx, yy, yz = R[:, 1, 0], R[:, 1, 1], R[:, 1, 2]
+    zx, zy, zz = R[:, 2, 0], R[:, 2, 1], R[:, 2, 2]
+    K = np.stack((
+        np.stack((xx+yy+zz, zy-yz, xz-zx, yx-xy), axis=1),
+        np.stack((zy-yz, xx-yy-zz, yx+xy, xz+zx), axis=1),
+        np.stack((xz-zx, yx+xy, yy-xx-zz, zy+yz), axis=1),
+        np.stack((yx-xy, xz+zx, zy+yz, zz-xx-yy), axis=1)), axis=1) / 3.0
+    return np.linalg.eigh(K)[1][:, :, -1]
+
+
+def quaternion2rotation(q):
+    """Converts a stack of (N, 4) quaternions (w, x, y, z) into (N, 3, 3)
+    rotation matrices"""
+    q = np.atleast_2d(np.asarray(q, dtype=float))
+    q = q/np.linalg.norm(q, axis=1)[:, None]
+    w, x, y, z = q.T
+    return np.stack((
+        np.stack((1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w)), axis=1),
+        np.stack((2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w)), axis=1),
+        np.stack((2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y)), axis=1)),
+        axis=1)
+
+
+def segment_sum(array, bounds):
+    """
+    Sums an array along its first axis within the contiguous segments
+    [bounds[i], bounds[i+1]) using a single np.add.reduceat call
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array to sum, e.g. a (N, 4, 4) stack of matrices
+    bounds : array-like (M+1,)
+        Increasing boundaries of the M segments
+
+    Returns
+    -------
+    sums : np.ndarray
+        The (M, ...) sums. Empty segments sum to 0
+    """
+    bounds = np.asarray(bounds, dtype=int)
+    sums = np.zeros((len(bounds)-1,)+array.shape[1:], dtype=array.dtype)
+    # reduceat does not return 0 for empty segments, so they are skipped.
+    # Since the segments are contiguous each non-empty one ends where the
+    # next one starts
+    nonempty = np.diff(bounds) > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(array[:bounds[-1]],
+                                         bounds[:-1][nonempty], axis=0)
+    return sums
+
+
+def frame_means(mats, bounds, valid=None, rotation_mean='arithmetic'):
+    """
+    Averages the matrices of each frame, i.e. of each contiguous segment
+    [bounds[i], bounds[i+1]) of the stack
+
+    Parameters
+    ----------
+    mats : np.ndarray (N, 4, 4)
+        The matrices to average
+    bounds : array-like (M+1,)
+        Index of the first matrix of each frame, followed by the end of the
+        last frame
+    valid : np.ndarray (N,) | None
+        Mask of the matrices to include in the averages. Frames without
+        valid matrices are set to the identity
+    rotation_mean : str
+        'arithmetic' averages the matrices element-wise. 'quaternion'
+        averages the rotations as quaternions (Markley et al. 2007) and the
+        translations arithmetically, so the averages are still rigid body
+        transformations
+
+    Returns
+    -------
+    means : np.ndarray (M, 4, 4)
+        The average matrix of each frame
+    """
+    mats = as_stack(mats)
+    if valid is None:
+        valid = np.ones(len(mats), dtype=bool)
+    valid = np.asarray(valid, dtype=bool)
+    counts = segment_sum(valid.astype(int), bounds)
+    denom = np.maximum(counts, 1)
+    if rotation_mean == 'arithmetic':
+        means = segment_sum(
+            np.where(valid[:, None, None], mats, 0.0), bounds)
+        means /= denom[:, None, None]
+    elif rotation_mean == 'quaternion':
+        q = rotation2quaternion(mats[:, :3, :3])
+        # The average quaternion is the principal eigenvector of the sum of
+        # the outer products, which does not depend on their signs
+        outer = np.where(valid[:, None, None], q[:, :, None]*q[:, None, :],
+                         0.0)
+        avg_q = np.linalg.eigh(segment_sum(outer, bounds))[1][:, :, -1]
+        means = np.tile(np.eye(4), (len(counts), 1, 1))
+        means[:, :3, :3] = quaternion2rotation(avg_q)
+        means[:, :3, 3] = segment_sum(
+            np.where(valid[:, None], mats[:, :3, 3], 0.0),
+            bounds)/denom[:, None]
+    else:
+        raise ValueError(
+            "Unrecognised rotation mean '{}', can be either 'arithmetic' or "
+            "'quaternion'".format(rotation_mean))
+    means[counts == 0] = np.eye(4)
+    return means
@@ -5,7 +5,9 @@ import errno
 # from arcana.processor import MultiProcProcessor
 from arcana.repository.simple import DirectoryRepository
 from banana.motion_correction_utils import (
-    guess_scan_type, local_motion_detection, inputs_generation)
+    guess_scan_type, local_motion_detection, inputs_generation,
+    session_index_path)
+from banana.utils.header_index import HeaderIndex
 import argparse
 import pickle as pkl
 from arcana.processor.linear import LinearProcessor
@@ -81,7 +83,9 @@ class RunMotionCorrection:
             scans = local_motion_detection(input_dir, pet_dir=pet_dir,
                                            pet_recon=pet_recon,
                                            struct2align=struct2align)
-            list_inputs = guess_scan_type(scans, input_dir)
+            list_inputs = guess_scan_type(
+                scans, input_dir,
+                index=HeaderIndex(session_index_path(input_dir)))
             if not list_inputs:
                 ref, ref_type, t1s, epis, t2s, dmris = (
                     inputs_generation(scans, input_dir, siemens=True))
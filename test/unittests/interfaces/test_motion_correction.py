@@ -0,0 +1,174 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import datetime as dt
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from banana.interfaces.custom.motion_correction import (
+    MeanDisplacementCalculation, MotionFraming, UmapAlign2Reference,
+    FixedBinning, CreateMocoSeries)
+from banana.utils.real_clock import time2us
+
+
+def random_rigid_mats(n_mats, seed=0):
+    rng = np.random.RandomState(seed)
+    mats = np.tile(np.eye(4), (n_mats, 1, 1))
+    for i in range(n_mats):
+        rx, ry, rz = rng.normal(scale=0.05, size=3)
+        Rx = np.array([[1, 0, 0], [0, np.cos(rx), np.sin(rx)],
+                       [0, -np.sin(rx), np.cos(rx)]])
+        Ry = np.array([[np.cos(ry), 0, -np.sin(ry)], [0, 1, 0],
+                       [np.sin(ry), 0, np.cos(ry)]])
+        Rz = np.array([[np.cos(rz), np.sin(rz), 0],
+                       [-np.sin(rz), np.cos(rz), 0], [0, 0, 1]])
+        mats[i, :3, :3] = np.dot(np.dot(Rx, Ry), Rz)
+        mats[i, :3, 3] = rng.normal(scale=3, size=3)
+    return mats
+
+
+class TestMeanDisplacementBatch(TestCase):
+
+    cog = np.array([90.3, 110.7, 70.1])
+
+    def setUp(self):
+        self.md_calc = MeanDisplacementCalculation()
+        self.mats = random_rigid_mats(200)
+
+    def test_rmsdiff(self):
+        ref = [self.md_calc.rmsdiff(self.cog, m, np.eye(4))
+               for m in self.mats]
+        consec = [self.md_calc.rmsdiff(self.cog, m1, m2)
+                  for m1, m2 in zip(self.mats[:-1], self.mats[1:])]
+        np.testing.assert_array_equal(
+            self.md_calc.rmsdiff_batch(self.cog, self.mats), ref)
+        np.testing.assert_array_equal(
+            self.md_calc.rmsdiff_batch(self.cog, self.mats[:-1],
+                                       self.mats[1:]), consec)
+
+    def test_avscale(self):
+        motion_par = [self.md_calc.avscale(m, self.cog) for m in self.mats]
+        np.testing.assert_array_equal(
+            self.md_calc.avscale_batch(self.mats, self.cog), motion_par)
+
+
+class TestMotionFramingTimes(TestCase):
+
+    def setUp(self):
+        self.framing = MotionFraming()
+        start = dt.datetime(1900, 1, 1, 10, 0, 0)
+        self.start_times = [
+            (start + dt.timedelta(seconds=0.7 * i)).strftime('%H%M%S.%f')
+            for i in range(500)]
+        self.start_us = np.array(
+            [time2us(t) for t in self.start_times])
+
+    def test_duration(self):
+        scan_duration = [
+            (dt.datetime.strptime(self.start_times[i], '%H%M%S.%f') -
+             dt.datetime.strptime(self.start_times[i-1], '%H%M%S.%f')
+             ).total_seconds() for i in range(1, len(self.start_times))]
+        np.testing.assert_array_equal(np.diff(self.start_us) / 1e6,
+                                      scan_duration)
+        cum_duration = np.concatenate(([0.0], np.cumsum(scan_duration)))
+        for start, end in ((0, 43), (10, 53), (100, 499), (5, 5)):
+            for threshold in (0.0, 30.1, np.sum(scan_duration[start:end])):
+                duration = self.framing.duration(
+                    np.asarray(scan_duration), cum_duration, start, end,
+                    threshold)
+                self.assertEqual(
+                    duration > threshold,
+                    np.sum(scan_duration[start:end]) > threshold)
+
+    def test_volume_before(self):
+        time_us = self.start_us[123] + 300000
+        self.assertEqual(
+            self.framing.volume_before(self.start_us, time_us), 123)
+        # Unsorted start times, as if the session crossed midnight
+        self.assertEqual(
+            self.framing.volume_before(np.concatenate(
+                (self.start_us[200:], self.start_us[:200])), time_us), 423)
+
+
+class TestUmapAlign2ReferenceMats(TestCase):
+
+    def test_ref_to_ute_mats(self):
+        mats = random_rigid_mats(40)
+        ute_regmat, ute_qform_mat = random_rigid_mats(2, seed=1)
+        ref_to_ute, ref_to_ute_inv = UmapAlign2Reference().ref_to_ute_mats(
+            mats, ute_regmat, ute_qform_mat)
+        for mat, r2u, r2u_inv in zip(mats, ref_to_ute, ref_to_ute_inv):
+            expected = np.dot(np.linalg.inv(ute_qform_mat),
+                              np.dot(mat, ute_regmat))
+            np.testing.assert_array_equal(r2u, expected)
+            np.testing.assert_array_equal(r2u_inv, np.linalg.inv(expected))
+
+
+class TestFixedBinningLocateBins(TestCase):
+
+    def test_locate_bins(self):
+        start_points = np.array([10, 20, 30, 40]) * 1000000
+        pet_bins = np.array([5, 15, 20, 33, 38, 45]) * 1000000
+        indxs, weights = FixedBinning().locate_bins(pet_bins, start_points)
+        np.testing.assert_array_equal(
+            indxs, [[0, 1], [0, 1], [2, 3], [2, 3], [2, 3], [2, 3]])
+        np.testing.assert_allclose(
+            weights, [[1, 0], [0.5, 0.5], [1, 0], [0.7, 0.3], [0.2, 0.8],
+                      [0, 1]])
+
+
+class TestCreateMocoSeries(TestCase):
+
+    n_vols = 7
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        file_meta = Dataset()
+        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        hd = FileDataset('template.IMA', {}, file_meta=file_meta,
+                         preamble=b'\0' * 128)
+        hd.is_little_endian = True
+        hd.is_implicit_VR = False
+        hd.SeriesInstanceUID = pydicom.uid.generate_uid()
+        hd.AcquisitionTime = '100000.000000'
+        hd.add_new((0x19, 0x0010), 'LO', 'SIEMENS MR HEADER')
+        hd.add_new((0x19, 0x1025), 'FD', [0.0, 0.0, 0.0])
+        hd.add_new((0x19, 0x1026), 'FD', [0.0, 0.0, 0.0])
+        hd.save_as('template.IMA')
+        rng = np.random.RandomState(0)
+        self.motion_par = np.hstack((rng.normal(scale=0.02, size=(7, 3)),
+                                     rng.normal(size=(7, 3))))
+        np.savetxt('motion_par.txt', self.motion_par)
+        self.start_times = ['1000{:02d}.000000'.format(i * 2)
+                            for i in range(self.n_vols + 1)]
+        np.savetxt('start_times.txt', self.start_times, fmt='%s')
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_moco_series(self):
+        result = CreateMocoSeries(
+            moco_template='template.IMA', motion_par='motion_par.txt',
+            start_times='start_times.txt', num_workers=3).run()
+        out_dir = result.outputs.modified_moco
+        fnames = sorted(os.listdir(out_dir))
+        self.assertEqual(len(fnames), self.n_vols)
+        moco_par = CreateMocoSeries().fsl2moco(self.motion_par[0])
+        uids = set()
+        for i, fname in enumerate(fnames):
+            hd = pydicom.dcmread(op.join(out_dir, fname))
+            self.assertEqual(int(hd.InstanceNumber), i + 1)
+            self.assertEqual(hd.AcquisitionTime, self.start_times[i])
+            uids.add(hd.SeriesInstanceUID)
+            if i == 0:
+                np.testing.assert_allclose(
+                    list(hd[0x19, 0x1025].value) +
+                    list(hd[0x19, 0x1026].value), moco_par)
+        self.assertEqual(len(uids), 1)
@@ -0,0 +1,389 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from sklearn.decomposition import PCA
+from banana.interfaces.custom.pet import (
+    StaticPETImageGeneration, PETMotionDetection, PETFovCropping, PETdr,
+    GlobalTrendRemoval, SUVRCalculation, PetImageMotionCorrection)
+
+
+class TestStaticPETImageGeneration(TestCase):
+
+    n_frames = 4
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(0)
+        self.frames = {}
+        for series in ('mc', 'no_mc'):
+            self.frames[series] = []
+            for i in range(self.n_frames):
+                fname = op.join(self.tmp_dir,
+                                '{}_{}.nii.gz'.format(series, i))
+                nib.save(nib.Nifti1Image(
+                    rng.rand(6, 5, 4).astype(np.float32), np.eye(4)), fname)
+                self.frames[series].append(fname)
+        self.corr_factors = list(rng.rand(self.n_frames))
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frames_sum(self):
+        result = StaticPETImageGeneration(
+            pet_mc_images=self.frames['mc'],
+            pet_no_mc_images=self.frames['no_mc'],
+            corr_factors=self.corr_factors).run()
+        for series, out_file in (('mc', result.outputs.static_mc),
+                                 ('no_mc', result.outputs.static_no_mc)):
+            expected = sum(
+                nib.load(f).get_fdata(dtype=np.float32) * np.float32(c)
+                for f, c in zip(self.frames[series], self.corr_factors))
+            np.testing.assert_allclose(nib.load(out_file).get_fdata(),
+                                       expected, rtol=1e-6)
+
+    def test_no_frames(self):
+        with self.assertRaisesRegex(Exception, 'No PET frames'):
+            StaticPETImageGeneration(pet_mc_images=[],
+                                     pet_no_mc_images=[]).run()
+
+
+class TestPETMotionDetection(TestCase):
+
+    n_frames = 120
+    motion_frame = 70
+    # All the segments and views combined by SSRB
+    ssrb_kwargs = dict(num_segments_to_combine=11, view_mash=252)
+    num_bins = 127 * 344
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        os.mkdir('sinograms')
+        rng = np.random.RandomState(0)
+        # The activity distribution changes after motion_frame, while the
+        # count rate decays
+        activity = rng.rand(2, self.num_bins) * 20
+        for i in range(self.n_frames):
+            sinogram = rng.poisson(activity[int(i >= self.motion_frame)] *
+                                   np.exp(-i / 200.0))
+            # Followed by (random) delays, which are ignored
+            np.concatenate([sinogram, rng.poisson(
+                20, self.num_bins)]).astype('<f4').tofile(
+                op.join('sinograms', 'Frame{:05d}_ssrb.s'.format(i)))
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_motion_detection(self):
+        result = PETMotionDetection(
+            sinogram_folder='sinograms', pet_start_time='101500.000000',
+            time_offset=10, temporal_len=1, batch_size=25,
+            **self.ssrb_kwargs).run()
+        surrogate = np.loadtxt(result.outputs.motion_surrogate)
+        self.assertEqual(surrogate.shape, (self.n_frames, 3))
+        start_times = np.loadtxt(result.outputs.sinogram_start_times,
+                                 dtype=str)
+        self.assertEqual(start_times[0], '101510.000000')
+        self.assertEqual(start_times[-1], '101709.000000')
+        # Frames start at the beginning, when the activity moves and end at
+        # the end of the last sinogram
+        self.assertEqual(
+            list(np.loadtxt(result.outputs.frame_start_times, dtype=str)),
+            ['101510.000000', '101620.000000', '101710.000000'])
+        with open(op.join(result.outputs.timestamps_dir,
+                          'timestamps_Frame001.txt')) as f:
+            self.assertEqual(f.read().split(),
+                             ['101620.000000', '101710.000000'])
+
+    def test_sinogram_size(self):
+        with self.assertRaisesRegex(Exception, 'does not match'):
+            PETMotionDetection(
+                sinogram_folder='sinograms', pet_start_time='101500.000000',
+                temporal_len=1).run()
+
+    def test_constant_surrogate(self):
+        # The changes are mostly zero, so their MAD is zero
+        surrogate = np.zeros(100)
+        surrogate[50:] = 1
+        surrogate[20] = 1e-6
+        detection = PETMotionDetection(temporal_threshold=5)
+        self.assertEqual(
+            detection.motion_boundaries(surrogate, np.arange(101.0)),
+            [0, 50, 100])
+        self.assertEqual(
+            detection.motion_boundaries(np.zeros(100), np.arange(101.0)),
+            [0, 100])
+
+
+class TestPETFovCropping(TestCase):
+
+    affine = np.array([[-2., 0, 0, 170], [0, 2, 0, -160], [0, 0, 2, -80],
+                       [0, 0, 0, 1]])
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cropping(self):
+        rng = np.random.RandomState(0)
+        for shape in ((20, 22, 15), (20, 22, 15, 4)):
+            for ext in ('.nii', '.nii.gz'):
+                data = rng.randint(0, 1000, shape).astype(np.int16)
+                img = nib.Nifti1Image(data, self.affine)
+                img.header.set_slope_inter(0.5, 2.0)
+                in_file = op.join(self.tmp_dir, 'pet{}'.format(ext))
+                nib.save(img, in_file)
+                result = PETFovCropping(
+                    pet_image=in_file, x_min=3, x_size=10, y_min=5,
+                    y_size=30, z_min=2, z_size=7, chunk_size=3).run()
+                cropped = nib.load(result.outputs.pet_cropped)
+                np.testing.assert_array_equal(
+                    cropped.get_fdata(),
+                    data[3:13, 5:, 2:9] * 0.5 + 2.0)
+                np.testing.assert_array_equal(
+                    cropped.affine[:3, 3], [164, -150, -76])
+                self.assertEqual(cropped.header['sform_code'], 1)
+
+
+class TestPETdr(TestCase):
+
+    shape = (8, 7, 6)
+    n_frames = 20
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(0)
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.mask[1:-1, 1:-1, 1:-1] = True
+        self.maps = rng.rand(*(self.shape + (3,))).astype(np.float32)
+        self.timecourses = rng.rand(self.n_frames, 3)
+        data = np.dot(self.maps, self.timecourses.T)
+        data += 0.01 * rng.randn(*data.shape)
+        data[~self.mask] = 100  # Outside the brain
+        self.volume = op.join(self.tmp_dir, 'pet.nii')
+        nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                 self.volume)
+        self.regression_map = op.join(self.tmp_dir, 'ica.nii.gz')
+        nib.save(nib.Nifti1Image(self.maps, np.eye(4)), self.regression_map)
+        self.mask_file = op.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.mask.astype(np.uint8), np.eye(4)),
+                 self.mask_file)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dual_regression(self):
+        result = PETdr(volume=self.volume,
+                       regression_map=self.regression_map,
+                       mask=self.mask_file, chunk_size=50).run()
+        np.testing.assert_array_almost_equal(
+            np.loadtxt(result.outputs.timecourses), self.timecourses,
+            decimal=2)
+        zmaps = nib.load(result.outputs.spatial_map).get_fdata()
+        self.assertEqual(zmaps.shape, self.shape + (3,))
+        self.assertFalse(zmaps[~self.mask].any())
+        np.testing.assert_array_almost_equal(zmaps[self.mask].mean(axis=0),
+                                             0, decimal=5)
+        np.testing.assert_array_almost_equal(zmaps[self.mask].std(axis=0),
+                                             1, decimal=5)
+        self.assertTrue(op.exists(result.outputs.timecourse))
+
+    def test_single_map(self):
+        map_file = op.join(self.tmp_dir, 'map.nii.gz')
+        nib.save(nib.Nifti1Image(self.maps[..., 0], np.eye(4)), map_file)
+        result = PETdr(volume=self.volume, regression_map=map_file,
+                       threshold=0.5, binarize=True).run()
+        self.assertEqual(op.basename(result.outputs.spatial_map),
+                         'pet_bin_th_0.5_map_GLM_fit_zscore.nii.gz')
+        # Matches the projection of the data onto the binarised map
+        ts = nib.load(self.volume).get_fdata().reshape(-1, self.n_frames)
+        sm = np.dot(ts, np.dot(ts.T, (self.maps[..., 0] >= 0.5).ravel()))
+        np.testing.assert_array_almost_equal(
+            nib.load(result.outputs.spatial_map).get_fdata().ravel(),
+            (sm - sm.mean()) / sm.std(), decimal=4)
+
+
+class TestGlobalTrendRemoval(TestCase):
+
+    shape = (10, 9, 8, 12)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(0)
+        trend = np.linspace(1, 3, self.shape[3])
+        self.data = (rng.rand(*(self.shape[:3] + (1,))) * 100 * trend +
+                     rng.randn(*self.shape)).astype(np.float32)
+        self.volume = op.join(self.tmp_dir, 'pet.nii')
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)), self.volume)
+        self.mask = np.zeros(self.shape[:3], dtype=bool)
+        self.mask[2:-2, 2:-2, 2:-2] = True
+        self.mask_file = op.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.mask.astype(np.uint8), np.eye(4)),
+                 self.mask_file)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def detrended(self, ts, n_components):
+        components = PCA(n_components).fit(ts).components_
+        return ts - np.dot(np.dot(ts, components.T), components)
+
+    def test_trend_removal(self):
+        result = GlobalTrendRemoval(volume=self.volume, chunk_size=100).run()
+        detrended = nib.load(result.outputs.detrended_file).get_fdata()
+        ts = self.data.reshape(-1, self.shape[3]).astype(np.float64)
+        np.testing.assert_allclose(
+            detrended.reshape(-1, self.shape[3]), self.detrended(ts, 1),
+            atol=1e-3)
+        # Restricted to the brain, with two components
+        result = GlobalTrendRemoval(volume=self.volume, mask=self.mask_file,
+                                    n_components=2, chunk_size=100).run()
+        detrended = nib.load(result.outputs.detrended_file).get_fdata()
+        np.testing.assert_allclose(
+            detrended[self.mask], self.detrended(
+                self.data[self.mask].astype(np.float64), 2),
+            atol=1e-3)
+        np.testing.assert_array_equal(detrended[~self.mask],
+                                      self.data[~self.mask])
+
+
+class TestSUVRCalculation(TestCase):
+
+    shape = (9, 8, 7)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(0)
+        self.atlas = rng.randint(0, 5, self.shape)
+        self.atlas_file = op.join(self.tmp_dir, 'atlas.nii.gz')
+        nib.save(nib.Nifti1Image(self.atlas.astype(np.int16), np.eye(4)),
+                 self.atlas_file)
+        self.data = []
+        self.volumes = []
+        for subject in ('a', 'b'):
+            data = rng.rand(*self.shape).astype(np.float32) + 0.5
+            fname = op.join(self.tmp_dir, '{}_pet.nii.gz'.format(subject))
+            nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+            self.data.append(data)
+            self.volumes.append(fname)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_base_mask(self):
+        mask_file = op.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image((self.atlas == 2).astype(np.uint8),
+                                 np.eye(4)), mask_file)
+        result = SUVRCalculation(volume=self.volumes[0],
+                                 base_mask=mask_file).run()
+        self.assertEqual(op.basename(result.outputs.SUVR_file),
+                         'a_pet_SUVR.nii.gz')
+        suvr = nib.load(result.outputs.SUVR_file)
+        self.assertEqual(suvr.get_data_dtype(), np.float32)
+        np.testing.assert_array_almost_equal(
+            suvr.get_fdata(),
+            self.data[0] / self.data[0][self.atlas == 2].mean())
+
+    def test_atlas(self):
+        result = SUVRCalculation(
+            volumes=self.volumes, atlas=self.atlas_file,
+            reference_labels=[2, [3, 4]],
+            reference_names=['pons', 'cerebellum']).run()
+        self.assertEqual(
+            [op.basename(f) for f in result.outputs.SUVR_files],
+            ['a_pet_pons_SUVR.nii.gz', 'a_pet_cerebellum_SUVR.nii.gz',
+             'b_pet_pons_SUVR.nii.gz', 'b_pet_cerebellum_SUVR.nii.gz'])
+        regions = [self.atlas == 2, (self.atlas == 3) | (self.atlas == 4)]
+        for i, data in enumerate(self.data):
+            means = [data[r].mean() for r in regions]
+            np.testing.assert_array_almost_equal(
+                result.outputs.reference_means[i], means)
+            for j, mean in enumerate(means):
+                np.testing.assert_array_almost_equal(
+                    nib.load(result.outputs.SUVR_files[2 * i + j]).get_fdata(),
+                    data / mean)
+
+    def test_same_names(self):
+        volumes = []
+        for subject, data in zip(('a', 'b'), self.data):
+            os.mkdir(op.join(self.tmp_dir, subject))
+            fname = op.join(self.tmp_dir, subject, 'pet.nii.gz')
+            nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+            volumes.append(fname)
+        result = SUVRCalculation(volumes=volumes, atlas=self.atlas_file,
+                                 reference_labels=[2]).run()
+        self.assertEqual(
+            [op.basename(f) for f in result.outputs.SUVR_files],
+            ['pet_0_SUVR.nii.gz', 'pet_1_SUVR.nii.gz'])
+        for fname, data, means in zip(result.outputs.SUVR_files, self.data,
+                                      result.outputs.reference_means):
+            np.testing.assert_array_almost_equal(
+                nib.load(fname).get_fdata(), data / means[0])
+
+    def test_invalid_references(self):
+        for kwargs, message in (
+                (dict(reference_labels=[7]), 'label\\(s\\) 7 has no'),
+                (dict(reference_labels=[1, 2], reference_names=['cb']),
+                 'Number of reference names')):
+            with self.assertRaisesRegex(Exception, message):
+                SUVRCalculation(volume=self.volumes[0], atlas=self.atlas_file,
+                                **kwargs).run()
+        # A label with no voxels
+        atlas = np.where(self.atlas == 3, 0, self.atlas)
+        nib.save(nib.Nifti1Image(atlas.astype(np.int16), np.eye(4)),
+                 self.atlas_file)
+        with self.assertRaisesRegex(Exception, 'label\\(s\\) 3 has no'):
+            SUVRCalculation(volume=self.volumes[0], atlas=self.atlas_file,
+                            reference_labels=[3]).run()
+
+
+class TestPetImageMotionCorrection(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.data = np.random.RandomState(0).rand(6, 5, 4).astype(np.float32)
+        nib.save(nib.Nifti1Image(self.data, np.eye(4)),
+                 op.join(self.tmp_dir, 'frame.nii.gz'))
+        for mat in ('motion.mat', 'pet2ref.mat'):
+            np.savetxt(op.join(self.tmp_dir, mat), np.eye(4))
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_deferred_scipy(self):
+        # The PET image is given without its extension
+        result = PetImageMotionCorrection(
+            pet_image=op.join(self.tmp_dir, 'frame'),
+            motion_mat=op.join(self.tmp_dir, 'motion.mat'),
+            pet2ref_mat=op.join(self.tmp_dir, 'pet2ref.mat'),
+            corr_factor=2.0, resampler='scipy', defer_correction=True).run()
+        self.assertEqual(result.outputs.corr_factor, 2.0)
+        np.testing.assert_allclose(
+            nib.load(result.outputs.pet_mc_image).get_fdata(), self.data,
+            atol=1e-5)
@@ -0,0 +1,73 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.interfaces.sklearn import FastICA
+
+
+class TestFastICA(TestCase):
+
+    shape = (12, 11, 10)
+    n_frames = 40
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        rng = np.random.RandomState(0)
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.mask[1:-1, 1:-1, 1:-1] = True
+        # Sparse (positively skewed) spatial sources
+        self.maps = rng.exponential(size=self.shape + (2,)) ** 3
+        self.maps[~self.mask] = 0
+        self.volumes = []
+        for run in range(2):
+            timecourses = rng.randn(self.n_frames, 2)
+            data = np.dot(self.maps, timecourses.T)
+            data[self.mask] += 0.01 * rng.randn(self.mask.sum(),
+                                                self.n_frames)
+            fname = op.join(self.tmp_dir, 'run{}.nii'.format(run))
+            nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                     fname)
+            self.volumes.append(fname)
+        self.mask_file = op.join(self.tmp_dir, 'mask.nii.gz')
+        nib.save(nib.Nifti1Image(self.mask.astype(np.uint8), np.eye(4)),
+                 self.mask_file)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_maps_found(self, fname):
+        zmaps = nib.load(fname).get_fdata()
+        self.assertEqual(zmaps.shape, self.shape + (2,))
+        self.assertFalse(zmaps[~self.mask].any())
+        corr = np.corrcoef(zmaps[self.mask].T,
+                           self.maps[self.mask].T)[:2, 2:]
+        # Each map is found (with its positive sign)
+        self.assertGreater(corr.max(axis=1).min(), 0.99)
+
+    def test_temporal_group(self):
+        result = FastICA(volumes=self.volumes, mask=self.mask_file,
+                         n_components=2, n_pca_components=4,
+                         ica_type='temporal', random_state=0).run()
+        self.assert_maps_found(result.outputs.ica_decomposition)
+        self.assertEqual(
+            nib.load(result.outputs.ica_timeseries).shape,
+            (2 * self.n_frames, 2))
+        self.assertEqual(np.loadtxt(result.outputs.mixing_mat).shape,
+                         (self.mask.sum(), 2))
+
+    def test_spatial(self):
+        result = FastICA(volume=self.volumes[0], mask=self.mask_file,
+                         n_components=2, ica_type='spatial',
+                         random_state=0).run()
+        self.assertEqual(op.basename(result.outputs.ica_decomposition),
+                         'run0_sICA_results_pc2_zscore.nii.gz')
+        tc = nib.load(result.outputs.ica_timeseries).get_fdata()
+        self.assertEqual(tc.shape, (self.n_frames, 2))
+        np.testing.assert_array_almost_equal(
+            np.loadtxt(result.outputs.mixing_mat), tc, decimal=5)
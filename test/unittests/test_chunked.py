@@ -0,0 +1,55 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.utils.chunked import (
+    memmap_dataobj, iter_chunks, crop_chunks, load_masked)
+
+
+class TestChunked(TestCase):
+
+    shape = (9, 8, 7, 40)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        raw = rng.randint(0, 1000, self.shape).astype(np.int16)
+        self.data = raw * 0.5 + 2.0
+        self.fnames = []
+        for ext in ('.nii', '.nii.gz'):
+            img = nib.Nifti1Image(raw, np.eye(4))
+            img.header.set_slope_inter(0.5, 2.0)
+            fname = op.join(self.tmp_dir, 'pet' + ext)
+            nib.save(img, fname)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_iter_chunks(self):
+        for fname in self.fnames:
+            dataobj = memmap_dataobj(nib.load(fname))
+            chunks = list(iter_chunks(dataobj, chunk_size=3, start=5,
+                                      stop=36))
+            self.assertEqual([c.shape[-1] for c in chunks],
+                             [3] * 10 + [1])
+            np.testing.assert_array_equal(np.concatenate(chunks, axis=-1),
+                                          self.data[..., 5:36])
+
+    def test_crop_chunks(self):
+        slicer = (slice(1, 7), slice(2, None), slice(None, None, 2),
+                  slice(3, 38, 3))
+        for fname in self.fnames:
+            dataobj = memmap_dataobj(nib.load(fname))
+            chunks = list(crop_chunks(dataobj, slicer, chunk_size=1))
+            self.assertEqual(len(chunks), 12)
+            np.testing.assert_array_equal(np.concatenate(chunks, axis=-1),
+                                          self.data[slicer])
+
+    def test_load_masked(self):
+        mask = self.data[..., 0] > 250
+        for fname in self.fnames:
+            np.testing.assert_array_equal(
+                load_masked(nib.load(fname), mask), self.data[mask])
@@ -0,0 +1,79 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from banana.utils.dicom_series import index_series, link_file, link_tree
+from banana.utils.header_index import HeaderIndex, file_key
+
+
+class TestDicomSeries(TestCase):
+
+    # Series number, description and UID of each file. The last series has
+    # the same number and description as the first one
+    series = [(1, 'localizer', '1.1')] * 3 + [(2, 't1 mprage', '1.2')] * 4 + [
+        (1, 'localizer', '1.3')] * 2
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fnames = []
+        for i, (number, description, uid) in enumerate(self.series):
+            fname = op.join(self.tmp_dir, '{:04d}.dcm'.format(i))
+            file_meta = Dataset()
+            file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+            file_meta.MediaStorageSOPInstanceUID = '1.4.{}'.format(i)
+            file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+            hd = FileDataset(fname, {}, file_meta=file_meta,
+                             preamble=b'\0' * 128)
+            hd.is_little_endian = True
+            hd.is_implicit_VR = False
+            hd.SeriesNumber = number
+            hd.SeriesDescription = description
+            hd.SeriesInstanceUID = uid
+            hd.PixelData = b'\0' * 64
+            hd.save_as(fname)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_series(self):
+        for num_workers in (1, 2):
+            series = index_series(self.fnames, num_workers=num_workers)
+            self.assertEqual(list(series),
+                             ['01_localizer', '02_t1_mprage', '01_localizer_2'])
+            self.assertEqual(list(series.values()),
+                             [self.fnames[:3], self.fnames[3:7],
+                              self.fnames[7:]])
+
+    def test_index_series_records(self):
+        not_dicom = op.join(self.tmp_dir, 'notes.dcm')
+        with open(not_dicom, 'w') as f:
+            f.write('not a DICOM')
+        index = HeaderIndex()
+        series = index_series(self.fnames + [not_dicom], num_workers=1,
+                              index=index)
+        self.assertEqual(list(series),
+                         ['01_localizer', '02_t1_mprage', '01_localizer_2'])
+        self.assertEqual(sum(series.values(), []), self.fnames)
+        # The headers were indexed in the same pass
+        indexed = index._lookup(file_key(f)[0] for f in self.fnames)
+        self.assertEqual(len(indexed), len(self.fnames))
+
+    def test_link(self):
+        for link in ('hard', 'symbolic', 'copy'):
+            out_dir = op.join(self.tmp_dir, link)
+            os.mkdir(out_dir)
+            dst = link_file(self.fnames[0], out_dir, link=link)
+            self.assertEqual(op.islink(dst), link == 'symbolic')
+            self.assertEqual(os.lstat(dst).st_nlink,
+                             2 if link == 'hard' else 1)
+            with open(dst, 'rb') as f, open(self.fnames[0], 'rb') as f2:
+                self.assertEqual(f.read(), f2.read())
+        tree = op.join(self.tmp_dir, 'tree')
+        link_tree(op.join(self.tmp_dir, 'hard'), tree)
+        self.assertEqual(os.stat(op.join(tree, '0000.dcm')).st_nlink, 3)
+        self.assertRaises(ValueError, link_file, self.fnames[1], tree,
+                          link='unknown')
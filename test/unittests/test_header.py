@@ -0,0 +1,79 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.utils.header import (
+    header_geometry, cached_geometry, mrtrix_transform, qform)
+
+
+class TestHeader(TestCase):
+
+    shape = (64, 60, 30)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, affine, name='image.nii.gz'):
+        fname = op.join(self.tmp_dir, name)
+        img = nib.Nifti1Image(np.zeros(self.shape, dtype=np.int16), affine)
+        img.set_qform(affine, code=1)
+        nib.save(img, fname)
+        return fname
+
+    def test_radiological(self):
+        affine = np.array([[-2.0, 0, 0, 100],
+                           [0, 2.0, 0, -100],
+                           [0, 0, 3.0, -50],
+                           [0, 0, 0, 1]])
+        fname = self.save(affine)
+        expected = np.eye(4)
+        expected[:3, 3] = [100 - 63 * 2.0, -100, -50]
+        np.testing.assert_allclose(mrtrix_transform(fname), expected,
+                                   atol=1e-5)
+        np.testing.assert_allclose(qform(fname), affine, atol=1e-5)
+
+    def test_sagittal(self):
+        # Image axes (y, z, -x) in scanner space
+        affine = np.array([[0, 0, -1.0, 20],
+                           [1.0, 0, 0, -30],
+                           [0, 1.0, 0, -40],
+                           [0, 0, 0, 1]])
+        fname = self.save(affine)
+        expected = np.eye(4)
+        expected[:3, 3] = [20 - 29 * 1.0, -30, -40]
+        np.testing.assert_allclose(mrtrix_transform(fname), expected,
+                                   atol=1e-5)
+
+    def test_sform_precedence(self):
+        fname = op.join(self.tmp_dir, 'image.nii.gz')
+        qform_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        sform_affine = np.array([[2.0, 0, 0, 10],
+                                 [0, 2.0, 0, -20],
+                                 [0, 0, 2.0, 30],
+                                 [0, 0, 0, 1]])
+        img = nib.Nifti1Image(np.zeros(self.shape, dtype=np.int16),
+                              sform_affine)
+        img.set_qform(qform_affine, code=1)
+        img.set_sform(sform_affine, code=1)
+        nib.save(img, fname)
+        # As MRtrix, the sform is used, while the qform is still reported
+        expected = np.eye(4)
+        expected[:3, 3] = [10, -20, 30]
+        np.testing.assert_allclose(mrtrix_transform(fname), expected,
+                                   atol=1e-5)
+        np.testing.assert_allclose(qform(fname), qform_affine, atol=1e-5)
+
+    def test_cache(self):
+        fname = self.save(np.eye(4))
+        cached_geometry.cache_clear()
+        header_geometry(fname)
+        header_geometry(fname)
+        self.assertEqual(cached_geometry.cache_info().hits, 1)
+        # Modifying the file invalidates the cached header
+        self.save(np.diag([2.0, 2.0, 2.0, 1.0]))
+        self.assertEqual(header_geometry(fname).zooms, (2.0, 2.0, 2.0))
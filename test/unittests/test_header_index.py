@@ -0,0 +1,177 @@
+import os
+import os.path as op
+import glob
+import tempfile
+import shutil
+from unittest import TestCase
+import pydicom
+from banana.utils.header_index import (
+    HeaderIndex, read_record, echo_samples, find_echo_times)
+from banana.interfaces.custom.dicom import DicomHeaderInfoExtraction
+from .test_siemens import save_dicom, PROTOCOL, INTERFILE
+
+
+class TestHeaderIndex(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fnames = []
+        for i in range(4):
+            fname = op.join(self.tmp_dir, '{:04d}.dcm'.format(i))
+            save_dicom(fname, protocol=PROTOCOL, interfile=INTERFILE)
+            self.fnames.append(fname)
+        self.index = HeaderIndex(op.join(self.tmp_dir, 'index.sqlite'))
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_record(self):
+        record = read_record(self.fnames[0])
+        self.assertEqual(record['EchoTime'], 2.5)
+        self.assertEqual(record['PixelSpacing'], [1, 1])
+        self.assertEqual(record['AcquisitionTime'], '101500.250000')
+        self.assertEqual(record['protocol']['alTR[0]'], '2000000')
+        self.assertEqual(record['protocol']['lDiffDirections'], '30')
+        self.assertEqual(record['interfile'], {'image duration': '3600'})
+        not_dicom = op.join(self.tmp_dir, 'listmode.bf')
+        with open(not_dicom, 'wb') as f:
+            f.write(b'\0' * 256)
+        self.assertIsNone(read_record(not_dicom))
+
+    def test_records(self):
+        for num_workers in (1, 2):
+            records = self.index.records(self.fnames, num_workers=num_workers)
+            self.assertEqual(records, [read_record(f) for f in self.fnames])
+        # The records are shared by links to the files and persist in the
+        # database
+        link = op.join(self.tmp_dir, 'link.dcm')
+        os.link(self.fnames[0], link)
+        index = HeaderIndex(self.index.path)
+        index._store = None  # Nothing should need to be read again
+        self.assertEqual(index[link], records[0])
+
+    def test_update(self):
+        self.index.update(self.fnames)
+        self.assertEqual(self.index[self.fnames[1]]['EchoTime'], 2.5)
+        hd = pydicom.dcmread(self.fnames[1])
+        hd.EchoTime = 5.0
+        hd.save_as(self.fnames[1])
+        stat = os.stat(self.fnames[1])
+        os.utime(self.fnames[1], ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(
+            [r['EchoTime'] for r in self.index.records(self.fnames)],
+            [2.5, 5.0, 2.5, 2.5])
+
+    def save_echoes(self, echo_times):
+        fnames = []
+        for i, echo_time in enumerate(echo_times):
+            fname = op.join(self.tmp_dir, 'echo{:04d}.dcm'.format(i))
+            save_dicom(fname)
+            hd = pydicom.dcmread(fname)
+            hd.EchoTime = echo_time
+            hd.InstanceNumber = i + 1
+            hd.save_as(fname)
+            fnames.append(fname)
+        return fnames
+
+    def test_echo_samples(self):
+        self.assertEqual(echo_samples(12, 3), [0, 1, 2, 4, 8])
+        self.assertEqual(echo_samples(2, 3), [0, 1])
+        self.assertEqual(echo_samples(6, 2), [0, 1, 3])
+
+    def test_find_echo_times(self):
+        tes = [3.0, 1.0, 2.0]
+        interleaved = self.save_echoes(tes * 10)
+        self.assertEqual(find_echo_times(interleaved, 3), [1.0, 2.0, 3.0])
+        # Each echo stored consecutively is found by the strided sample
+        blocked = self.save_echoes([t for t in tes for _ in range(10)])
+        self.assertEqual(find_echo_times(blocked, 3), [1.0, 2.0, 3.0])
+        # The last echo is only found by the scan of the remaining files
+        irregular = self.save_echoes([1.0] * 150 + [2.0])
+        for num_workers in (1, 2):
+            self.assertEqual(
+                find_echo_times(irregular, 2, num_workers=num_workers,
+                                batch_size=8), [1.0, 2.0])
+        self.assertEqual(find_echo_times(irregular[:-1], 2), [1.0])
+
+    def test_echo_times(self):
+        fnames = self.save_echoes([1.0, 2.0] * 4)
+        self.assertEqual(self.index.echo_times(fnames, 2), [1.0, 2.0])
+        with self.index.connect() as conn:
+            self.assertEqual(
+                conn.execute('SELECT COUNT(*) FROM echo_times').fetchone(),
+                (1,))
+        # The echo times are found again when one of the files changes
+        hd = pydicom.dcmread(fnames[0])
+        hd.EchoTime = 1.5
+        hd.save_as(fnames[0])
+        stat = os.stat(fnames[0])
+        os.utime(fnames[0], ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.index.echo_times(fnames, 2), [1.5, 2.0])
+
+    def test_memory_fallback(self):
+        # A file cannot be created inside another file
+        index = HeaderIndex(op.join(self.fnames[0], 'index.sqlite'))
+        self.assertIsNotNone(index._memory)
+        self.assertEqual(index[self.fnames[2]], read_record(self.fnames[2]))
+        # Without a path nothing is written to disk
+        contents = sorted(os.listdir(self.tmp_dir))
+        index = HeaderIndex()
+        self.assertIsNotNone(index._memory)
+        index.update(self.fnames)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), contents)
+
+    def test_header_info_extraction(self):
+        scan_dir = op.join(self.tmp_dir, 'scan')
+        os.mkdir(scan_dir)
+        for fname in self.fnames:
+            os.link(fname, op.join(scan_dir, op.basename(fname)))
+        self.index.update(self.fnames)
+        result = DicomHeaderInfoExtraction(
+            dicom_folder=scan_dir, header_index=self.index.path).run()
+        self.assertEqual(result.outputs.echo_times, [0.0025])
+        self.assertEqual(result.outputs.voxel_sizes, [1.0, 1.0, 1.0])
+        self.assertEqual(result.outputs.start_time, 101500.25)
+
+    def test_not_dicom(self):
+        scan_dir = op.join(self.tmp_dir, 'scan')
+        os.mkdir(scan_dir)
+        # A sidecar sorted before the DICOM files is skipped
+        with open(op.join(scan_dir, '0000.json'), 'w') as f:
+            f.write('{}')
+        extraction = DicomHeaderInfoExtraction(dicom_folder=scan_dir)
+        self.assertRaisesRegex(Exception, 'No DICOM files found',
+                               extraction.run)
+        os.link(self.fnames[0], op.join(scan_dir, '0001.dcm'))
+        result = DicomHeaderInfoExtraction(dicom_folder=scan_dir).run()
+        self.assertEqual(result.outputs.start_time, 101500.25)
+
+    def test_instance_order(self):
+        fnames = self.save_echoes([1.0, 2.0, 3.0])[::-1]
+        # Not indexed yet
+        self.assertEqual(self.index.instance_order(fnames), fnames)
+        self.index.update(fnames)
+        self.assertEqual(self.index.instance_order(fnames), fnames[::-1])
+
+    def test_multi_echo_sidecar(self):
+        scan_dir = op.join(self.tmp_dir, 'scan')
+        os.mkdir(scan_dir)
+        for i, echo_time in enumerate([1.0, 2.0] * 3):
+            fname = op.join(scan_dir, '{:04d}.dcm'.format(i))
+            save_dicom(fname, protocol=PROTOCOL)
+            hd = pydicom.dcmread(fname)
+            hd.EchoTrainLength = 2
+            hd.EchoTime = echo_time
+            hd.InstanceNumber = i + 1
+            hd.save_as(fname)
+        with open(op.join(scan_dir, 'f000.json'), 'w') as f:
+            f.write('{}')
+        fnames = sorted(glob.glob(op.join(scan_dir, '*')))
+        self.assertEqual(find_echo_times(fnames, 3), [1.0, 2.0])
+        result = DicomHeaderInfoExtraction(dicom_folder=scan_dir).run()
+        self.assertEqual(result.outputs.echo_times, [0.001, 0.002])
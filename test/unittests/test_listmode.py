@@ -0,0 +1,104 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+from banana.utils.listmode import (
+    read_words, time_position, frame_sinograms, native_to_stir,
+    save_sinogram, ssrb, TIME_TAG, PROMPT_BIT)
+
+
+class TestListMode(TestCase):
+
+    num_bins = 50
+    duration_ms = 3000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = op.join(self.tmp_dir, 'listmode.bf')
+        rng = np.random.RandomState(1)
+        words = []
+        self.events = []  # time (ms), bin and whether it is a prompt
+        for time_ms in range(self.duration_ms):
+            if time_ms:
+                words.append(TIME_TAG | np.uint32(time_ms))
+            # Another (non-time) tag, which is ignored
+            words.append(np.uint32(0xA0000000))
+            for _ in range(rng.randint(5)):
+                bin_ = rng.randint(self.num_bins)
+                prompt = bool(rng.randint(3))
+                words.append(np.uint32(bin_) | (PROMPT_BIT if prompt else 0))
+                self.events.append((time_ms, bin_, prompt))
+        np.array(words, dtype='<u4').tofile(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def expected(self, start, end, prompt):
+        return np.bincount(
+            [b for t, b, p in self.events
+             if start * 1000 <= t < end * 1000 and p == prompt],
+            minlength=self.num_bins)
+
+    def test_time_position(self):
+        words = read_words(self.fname)
+        self.assertEqual(time_position(words, 0), 0)
+        for time_ms in (1, 17, 1500, self.duration_ms - 1):
+            pos = time_position(words, time_ms)
+            self.assertEqual(words[pos], TIME_TAG | np.uint32(time_ms))
+        self.assertEqual(time_position(words, self.duration_ms), len(words))
+
+    def test_frame_sinograms(self):
+        frames = [(0, 0.5), (0.5, 1.0), (1.25, 2.0), (2.0, 5.0)]
+        for num_workers in (1, 2):
+            sinograms = list(frame_sinograms(
+                self.fname, frames, chunk_size=100, num_workers=num_workers,
+                num_bins=self.num_bins))
+            self.assertEqual(len(sinograms), len(frames))
+            for (start, end), (prompts, delays) in zip(frames, sinograms):
+                np.testing.assert_array_equal(
+                    prompts, self.expected(start, end, True))
+                np.testing.assert_array_equal(
+                    delays, self.expected(start, end, False))
+
+    def test_native_to_stir(self):
+        segment_planes = (3, 2, 2)
+        sinogram = np.arange(7 * 4 * 5)
+        stir = native_to_stir(sinogram, segment_planes=segment_planes,
+                              num_views=4, num_tangential=5)
+        native = sinogram.reshape(7, 4, 5)
+        # Segments -1, 0 and +1, each one by view, plane and tangential bin
+        np.testing.assert_array_equal(
+            stir, np.concatenate([native[5:7].transpose(1, 0, 2).ravel(),
+                                  native[:3].transpose(1, 0, 2).ravel(),
+                                  native[3:5].transpose(1, 0, 2).ravel()]))
+        fname = save_sinogram(np.array([1, 40000]), op.join(self.tmp_dir,
+                                                            'Frame00000.s'))
+        np.testing.assert_array_equal(np.fromfile(fname, dtype='<i2'),
+                                      [1, 32767])
+
+    def test_ssrb(self):
+        # Segments -1, 0 and +1 with 1, 3 and 1 planes, 4 views and 5
+        # tangential bins
+        kwargs = dict(segment_planes=(3, 1, 1), num_views=4, num_tangential=5)
+        sinograms = np.random.RandomState(2).randint(0, 5, (2, 100))
+        np.testing.assert_array_equal(
+            ssrb(sinograms, 1, 1, **kwargs), sinograms)
+        segments = [s.reshape(2, 4, -1, 5)
+                    for s in np.split(sinograms, [20, 80], axis=1)]
+        direct = segments[1].copy()
+        direct[:, :, 1:2] += segments[0] + segments[2]
+        direct = direct.reshape(2, 2, 2, 3, 5).sum(axis=2)
+        np.testing.assert_array_almost_equal(
+            ssrb(sinograms, 3, 2, **kwargs), direct.reshape(2, -1))
+        normalised = ssrb(sinograms, 3, 2, normalise=True, **kwargs)
+        np.testing.assert_array_almost_equal(
+            normalised.reshape(2, 2, 3, 5),
+            direct / np.array([2, 6, 2])[:, None])
+        # Views mashed within each segment
+        mashed = ssrb(sinograms[0], 1, 4, **kwargs)
+        self.assertEqual(mashed.shape, (25,))
+        np.testing.assert_array_almost_equal(
+            mashed[:5], segments[0][0].sum(axis=0).ravel())
+        self.assertRaises(ValueError, ssrb, sinograms, 2, 1, **kwargs)
+        self.assertRaises(ValueError, ssrb, sinograms, 1, 3, **kwargs)
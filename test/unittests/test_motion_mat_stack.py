@@ -0,0 +1,43 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+from banana.utils.motion_mat_stack import MotionMatStack
+
+
+class TestMotionMatStack(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.mats = np.tile(np.eye(4), (6, 1, 1))
+        self.mats[:, :3, :] += rng.rand(6, 3, 4)
+        self.names = ['vol_{}_motion_mat{}'.format(str(i // 2).zfill(4),
+                                                   '_inv' if i % 2 else '')
+                      for i in range(6)]
+        self.stack = MotionMatStack(self.mats, self.names)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        fname = self.stack.save(op.join(self.tmp_dir, 'motion_mats'))
+        self.assertTrue(fname.endswith(MotionMatStack.EXT))
+        loaded = MotionMatStack.load(fname)
+        np.testing.assert_array_equal(loaded.mats, self.mats)
+        self.assertEqual(list(loaded.names), self.names)
+
+    def test_dir_round_trip(self):
+        out_dir = op.join(self.tmp_dir, 'motion_mats')
+        self.stack.to_dir(out_dir)
+        loaded = MotionMatStack.from_dir(out_dir)
+        np.testing.assert_array_equal(loaded.mats, self.mats)
+        self.assertEqual(list(loaded.names), self.names)
+
+    def test_select(self):
+        inv = self.stack.select('*inv')
+        self.assertEqual(len(inv), 3)
+        np.testing.assert_array_equal(inv.mats, self.mats[1::2])
+        np.testing.assert_array_equal(inv['vol_0001_motion_mat_inv'],
+                                      self.mats[3])
@@ -0,0 +1,54 @@
+import os.path as op
+import tempfile
+import shutil
+from unittest import TestCase
+import numpy as np
+from banana.utils.real_clock import RealClock
+
+
+class TestRealClock(TestCase):
+
+    starts = [0, 2000, 4000, 10000, 13000]
+    ends = [2000, 4000, 6000, 12500, 15000]
+    length = 16000
+
+    def setUp(self):
+        self.values = np.arange(len(self.starts) * 2,
+                                dtype=float).reshape(-1, 2)
+        self.real_clock = RealClock(self.starts, self.ends, self.values,
+                                    length=self.length)
+
+    def dense(self):
+        "Dense array as created by the original per-millisecond loops"
+        dense = np.zeros((self.length, 2)) - 1
+        for s, e, v in zip(self.starts, self.ends, self.values):
+            dense[s:e] = v
+        for i in range(1, self.length):
+            if dense[i, 0] == -1 and dense[i - 1, 0] != -1:
+                dense[i] = dense[i - 1]
+        return dense
+
+    def test_expand(self):
+        dense = self.dense()
+        np.testing.assert_array_equal(self.real_clock.expand(), dense)
+        np.testing.assert_array_equal(self.real_clock.expand(5500, 13500),
+                                      dense[5500:13500])
+        np.testing.assert_array_equal(
+            np.concatenate(list(self.real_clock.iter_expand(3000))), dense)
+
+    def test_idle_periods(self):
+        np.testing.assert_array_equal(
+            self.real_clock.idle_periods(),
+            [[6000, 10000], [12500, 13000], [15000, 16000]])
+
+    def test_save_load(self):
+        for ext in ('.txt', '.npz'):
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                fname = op.join(tmp_dir, 'real_clock' + ext)
+                self.real_clock.save(fname)
+                loaded = RealClock.load(fname)
+            finally:
+                shutil.rmtree(tmp_dir)
+            self.assertEqual(len(loaded), self.length)
+            np.testing.assert_array_equal(loaded.expand(), self.dense())
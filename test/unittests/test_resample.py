@@ -0,0 +1,64 @@
+from unittest import TestCase
+import numpy as np
+import nibabel as nib
+from banana.utils.resample import apply_fsl_xfm, fsl_scaling_matrix
+
+
+class TestResample(TestCase):
+
+    shape = (12, 10, 8)
+    zooms = (2.0, 2.5, 3.0)
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = rng.rand(*self.shape).astype(np.float32)
+        # Radiological (negative determinant) and neurological affines
+        self.rad_affine = np.diag([-self.zooms[0], self.zooms[1],
+                                   self.zooms[2], 1.0])
+        self.neuro_affine = np.diag(list(self.zooms) + [1.0])
+
+    def image(self, affine, data=None):
+        return nib.Nifti1Image(self.data if data is None else data, affine)
+
+    def translation(self, n_vox):
+        mat = np.eye(4)
+        mat[0, 3] = n_vox * self.zooms[0]
+        return mat
+
+    def test_scaling_matrix(self):
+        rad = fsl_scaling_matrix(self.image(self.rad_affine))
+        neuro = fsl_scaling_matrix(self.image(self.neuro_affine))
+        np.testing.assert_array_equal(np.dot(rad, [1, 1, 1, 1]),
+                                      [2.0, 2.5, 3.0, 1.0])
+        np.testing.assert_array_equal(np.dot(neuro, [1, 1, 1, 1]),
+                                      [20.0, 2.5, 3.0, 1.0])
+
+    def test_identity(self):
+        for affine in (self.rad_affine, self.neuro_affine):
+            img = self.image(affine)
+            for interp in ('trilinear', 'nearestneighbour'):
+                resampled = apply_fsl_xfm(img, img, np.eye(4), interp=interp)
+                np.testing.assert_allclose(resampled.get_fdata(), self.data,
+                                           rtol=1e-6)
+
+    def test_translation(self):
+        rad = apply_fsl_xfm(self.image(self.rad_affine),
+                            self.image(self.rad_affine),
+                            self.translation(2)).get_fdata()
+        np.testing.assert_allclose(rad[2:], self.data[:-2], rtol=1e-6)
+        self.assertTrue((rad[:2] == 0).all())
+        # The x-axis of FSL coordinates is flipped in neurological images
+        neuro = apply_fsl_xfm(self.image(self.neuro_affine),
+                              self.image(self.neuro_affine),
+                              self.translation(2)).get_fdata()
+        np.testing.assert_allclose(neuro[:-2], self.data[2:], rtol=1e-6)
+
+    def test_multiple_volumes(self):
+        data = np.stack((self.data, self.data * 2), axis=-1)
+        img = self.image(self.rad_affine, data)
+        resampled = apply_fsl_xfm(img, self.image(self.rad_affine),
+                                  self.translation(1),
+                                  interp='nearestneighbour')
+        self.assertEqual(resampled.shape, self.shape + (2,))
+        np.testing.assert_allclose(resampled.get_fdata()[1:, ..., 1],
+                                   data[:-1, ..., 1])
@@ -0,0 +1,122 @@
+import os
+import os.path as op
+import struct
+import tempfile
+import shutil
+from unittest import TestCase
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from banana.utils.siemens import (
+    parse_ascconv, phoenix_protocol, interfile_header, find_value)
+from banana.interfaces.custom.dicom import (
+    DicomHeaderInfoExtraction, PetTimeInfo)
+
+
+PROTOCOL = """<XProtocol>
+{
+  <ParamLong."TotalScanTimeSec">  { 600  }
+}
+### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=41340006 ###
+ulVersion                                = 0x14b44b6
+tSequenceFileName                        = ""%SiemensSeq%\\tfl""
+alTR[0]                                  = 2000000
+sSliceArray.asSlice[0].dInPlaneRot       = 1.570796327
+sDiffusion.lDiffDirections               = 30	# comment
+lTotalScanTimeSec                        = 317
+### ASCCONV END ###
+"""
+
+INTERFILE = """!INTERFILE:=
+%comment:=SMS-MI header
+image duration (sec):=3600
+"""
+
+
+def csa2_header(tags):
+    "Encodes a dictionary of string items as a CSA2 header"
+    csa = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(tags), 77)
+    for name, item in tags.items():
+        item = item.encode('latin-1') + b'\0'
+        csa += struct.pack('<64si4s3i', name.encode(), 1, b'UT', 0, 1, 77)
+        csa += struct.pack('<4i', len(item), len(item), 77, len(item))
+        csa += item + b'\0' * (-len(item) % 4)
+    return csa
+
+
+def save_dicom(fname, protocol=None, interfile=None):
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    file_meta.MediaStorageSOPInstanceUID = '1.2.3'
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    hd = FileDataset(fname, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    hd.is_little_endian = True
+    hd.is_implicit_VR = False
+    hd.AcquisitionTime = '101500.250000'
+    hd.EchoTrainLength = 1
+    hd.EchoTime = 2.5
+    hd.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    hd.PixelSpacing = [1, 1]
+    hd.SliceThickness = 1
+    hd.MagneticFieldStrength = 3
+    hd.add_new((0x29, 0x10), 'LO', 'SIEMENS CSA HEADER')
+    if protocol is not None:
+        hd.add_new((0x29, 0x1020), 'OB',
+                   csa2_header({'MrPhoenixProtocol': protocol}))
+    if interfile is not None:
+        hd.add_new((0x29, 0x1010), 'OB', interfile.encode('latin-1'))
+    # The values are not found in the pixel data, which is not read
+    hd.PixelData = b'alTR[0] = 1\n' * 16
+    hd.save_as(fname)
+
+
+class TestSiemensHeader(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_dir = os.getcwd()
+        os.chdir(self.tmp_dir)
+        os.mkdir('scan')
+        save_dicom(op.join('scan', '0001.dcm'), protocol=PROTOCOL)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_ascconv(self):
+        params = parse_ascconv(PROTOCOL)
+        self.assertEqual(len(params), 6)
+        self.assertEqual(params['alTR[0]'], '2000000')
+        self.assertEqual(params['sDiffusion.lDiffDirections'], '30')
+        self.assertEqual(find_value(params, 'TotalScan'), '317')
+        self.assertIsNone(find_value(params, 'lRepetitions'))
+
+    def test_phoenix_protocol(self):
+        params = phoenix_protocol(op.join('scan', '0001.dcm'))
+        self.assertEqual(params, parse_ascconv(PROTOCOL))
+        save_dicom('no_protocol.dcm')
+        self.assertEqual(phoenix_protocol('no_protocol.dcm'), {})
+
+    def test_interfile_header(self):
+        save_dicom('pet.dcm', interfile=INTERFILE)
+        self.assertEqual(
+            find_value(interfile_header('pet.dcm'), 'image duration'), '3600')
+
+    def test_header_info_extraction(self):
+        result = DicomHeaderInfoExtraction(dicom_folder='scan').run()
+        # alTR[0] is in microseconds
+        self.assertAlmostEqual(result.outputs.tr * 1000, 2.0)
+        self.assertEqual(result.outputs.total_duration, 317.0)
+        self.assertEqual(result.outputs.real_duration, 317.0)
+        self.assertEqual(result.outputs.ped, 'ROW')
+        result = DicomHeaderInfoExtraction(dicom_folder='scan',
+                                           multivol=True).run()
+        self.assertEqual(result.outputs.real_duration, 60.0)
+
+    def test_pet_time_info(self):
+        os.mkdir('pet')
+        save_dicom(op.join('pet', 'listmode.dcm'), interfile=INTERFILE)
+        with open(op.join('pet', 'listmode.bf'), 'wb') as f:
+            f.write(b'\0' * 16)
+        result = PetTimeInfo(pet_data_dir='pet').run()
+        self.assertEqual(result.outputs.pet_duration, 3600)
+        self.assertEqual(result.outputs.pet_end_time, '111500.250000')
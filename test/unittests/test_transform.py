@@ -0,0 +1,83 @@
+from unittest import TestCase
+import numpy as np
+from banana.utils import transform
+
+
+class TestTransform(TestCase):
+
+    cog = np.array([90.3, 110.7, 70.1])
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.params = np.hstack((rng.normal(scale=3, size=(100, 3)),
+                                 rng.normal(scale=0.05, size=(100, 3))))
+        self.mats = transform.params2mat(self.params, self.cog)
+
+    def test_params2mat(self):
+        # The rotations are about the centre of gravity, which is therefore
+        # only translated
+        cog = np.append(self.cog, 1)
+        np.testing.assert_allclose(
+            np.matmul(self.mats, cog)[:, :3] - self.cog, self.params[:, :3],
+            atol=1e-10)
+        self.assertTrue(transform.is_rotation(self.mats[:, :3, :3]).all())
+
+    def test_decompose(self):
+        params = transform.decompose(self.mats, np.zeros(3))
+        # Eddy parameters are translations followed by rotations
+        rebuilt = transform.params2mat(
+            np.hstack((params[:, 3:], params[:, :3])), np.zeros(3))
+        np.testing.assert_allclose(rebuilt, self.mats, atol=1e-10)
+        # The rotations are the same whatever the centre of gravity
+        np.testing.assert_array_equal(
+            transform.decompose(self.mats, self.cog)[:, :3], params[:, :3])
+
+    def test_compose_invert(self):
+        composed = transform.compose(self.mats, transform.invert(self.mats))
+        np.testing.assert_allclose(composed, np.tile(np.eye(4), (100, 1, 1)),
+                                   atol=1e-10)
+        np.testing.assert_allclose(transform.rmsdiff(self.cog, composed), 0,
+                                   atol=1e-5)
+
+    def test_moco(self):
+        params = transform.decompose(self.mats, self.cog)
+        moco = transform.fsl2moco(params)
+        np.testing.assert_array_equal(moco[:, :3], np.stack(
+            (-params[:, 4], params[:, 3], -params[:, 5]), axis=1))
+        np.testing.assert_allclose(transform.moco2fsl(moco), params)
+
+    def test_not_rotation(self):
+        mats = self.mats.copy()
+        mats[0, :3, :3] *= 2
+        self.assertRaises(ValueError, transform.decompose, mats, self.cog)
+
+    def test_segment_sum(self):
+        bounds = [3, 10, 10, 42, 100]
+        sums = transform.segment_sum(self.mats, bounds)
+        self.assertEqual(sums.shape, (4, 4, 4))
+        np.testing.assert_array_equal(sums[1], 0)
+        for s, b1, b2 in zip(sums, bounds[:-1], bounds[1:]):
+            np.testing.assert_allclose(s, self.mats[b1:b2].sum(axis=0),
+                                       atol=1e-12)
+
+    def test_frame_means(self):
+        bounds = [0, 20, 20, 55, 100]
+        valid = np.ones(100, dtype=bool)
+        valid[20:40] = False
+        arith = transform.frame_means(self.mats, bounds, valid=valid)
+        quat = transform.frame_means(self.mats, bounds, valid=valid,
+                                     rotation_mean='quaternion')
+        for means in (arith, quat):
+            np.testing.assert_array_equal(means[1], np.eye(4))
+        np.testing.assert_allclose(
+            arith[2], self.mats[40:55].mean(axis=0), atol=1e-12)
+        np.testing.assert_allclose(quat[:, :3, 3], arith[:, :3, 3],
+                                   atol=1e-12)
+        # Only the quaternion mean is guaranteed to be a rotation
+        self.assertTrue(transform.is_rotation(quat[:, :3, :3], 1e-10).all())
+        np.testing.assert_allclose(quat[:, :3, :3], arith[:, :3, :3],
+                                   atol=1e-2)
+        # The quaternion mean of identical rotations is the rotation itself
+        same = transform.frame_means(np.repeat(self.mats[:1], 10, axis=0),
+                                     [0, 10], rotation_mean='quaternion')
+        np.testing.assert_allclose(same[0], self.mats[0], atol=1e-12)